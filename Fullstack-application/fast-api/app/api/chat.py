@@ -6,11 +6,18 @@ Optimized Chat endpoint using the hybrid approach:
    - extract_entities_with_gemini for entity/intent recognition
    - generate_response_with_gemini for natural language generation
 4. Structured product data processing for frontend display
+5. Streaming (Server-Sent Events) variant that sends recommendations first and the reply as it is generated
+6. WebSocket channel that authenticates once per connection and keeps the conversation context server-side
+7. Batch replays of stored queries for offline evaluation (run_chat_batch)
+8. Fair admission of AI turns across tenants (see app/services/admission.py); a turn that
+   can't get a slot in time gets a 503 with Retry-After
 """
 
+import os
 import logging
-from typing import Dict, List, Optional, Any
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, status
+from typing import Dict, List, Optional, Any, Tuple
+from fastapi import APIRouter, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Query, Header
+from fastapi.responses import StreamingResponse
 from datetime import datetime, timezone
 import uuid
 from app.utils.mongo import serialize_mongo_doc, get_db, get_conversations_collection, get_human_chat_collection
@@ -20,19 +27,53 @@ from motor.motor_asyncio import AsyncIOMotorClient
 from app.utils.logging_config import get_module_logger
 import re # Import regex for extracting order number/email
 from app.services.knowledge_base import KnowledgeBase
-from app.services.ai_service import AIService
+from app.services.ai_service import AIService, AI_FUSED_MODE, DRAFT_REPLY_INTENTS
+from app.services.llm_client import LatencyBudget
+from app.services.retrieval import gather_within, retrieval_timeout, SpeculativeRetrieval, SPECULATIVE_RETRIEVAL
+from app.utils.stage_timing import stage, mark_request_start, current_timer, start_request_timer
+from app.utils.ttl_cache import TTLCache
+from app.utils.keyword_matcher import KeywordHits, KEYWORD_LANGUAGES
+from app.services.quota import get_conversation_quota, QuotaExceededError, resolve_tier
+from app.services.admission import get_admission_scheduler, AdmissionRejectedError, AdmissionTicket
+from app.services.order_status import get_order_status_service, order_status_summary
+from app.services.idempotency import get_idempotency_store, request_fingerprint, IdempotencyKeyMismatchError
+from app.services.intent_classifier import (
+    classify_query, get_classifier_evaluator, get_tenant_threshold, should_shadow_check, PRECLASSIFIER_THRESHOLD
+)
 # Use verify_widget_origin for auth/origin check
-from app.utils.dependencies import verify_widget_origin
+from app.utils.dependencies import verify_widget_origin, get_current_active_customer
+# WebSocket connections are tracked by the same manager as human chat
+from app.api.human_chat import manager as connection_manager
 # Import user model and mongo utils for limit checking
 from app.models.user import SubscriptionTier
 # Import get_user_collection and get_orders_collection
 from app.utils.mongo import get_user_collection, get_orders_collection, serialize_mongo_doc
 from datetime import timedelta # Import timedelta for month check
 import json # Import json for debug logging
+import asyncio
+from pydantic import BaseModel, Field, ValidationError
 
 router = APIRouter()
 logger = get_module_logger(__name__)
 
+# Headers for the Server-Sent Events stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no" # Disable proxy buffering (nginx) so chunks reach the widget immediately
+}
+
+# Messages a WebSocket client may send ahead of the reply it is waiting for
+WS_CHAT_MAX_PIPELINED = int(os.getenv("WS_CHAT_MAX_PIPELINED", "8"))
+# How long (seconds) a WebSocket conversation context is kept for reconnects
+WS_CHAT_CONTEXT_TTL = 1800
+
+# Concurrent items of a batch replay (see run_chat_batch)
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+CHAT_BATCH_MAX_CONCURRENCY = 32
+
+# Conversation contexts of WebSocket conversations: (owner user id, conversation id) -> context
+_ws_contexts = TTLCache("ws_chat_contexts", maxsize=10000, ttl=WS_CHAT_CONTEXT_TTL)
+
 # Singletons for services
 _knowledge_base = None
 _ai_service = None
@@ -57,397 +98,156 @@ async def get_ai_service():
 @router.post("/chat/message", response_model=ChatResponse)
 async def handle_message(
     request: ChatRequest,
-    background_tasks: BackgroundTasks,
     # Use the new dependency for authentication and origin check
     current_user: Dict = Depends(verify_widget_origin), # User associated with the API Key
     conversations_db = Depends(get_conversations_collection),
-    orders_collection = Depends(get_orders_collection), # Inject orders collection
-    ai_service = Depends(get_ai_service)
+    ai_service = Depends(get_ai_service),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ) -> ChatResponse:
     """
     Process chat messages, including handling order status requests.
     Uses a hybrid approach where Gemini handles NLU and response generation,
     while our code manages tenant isolation, database interactions, and business rules.
+
+    With an `Idempotency-Key` header, retries of the same request get the first
+    request's response (see app/services/idempotency.py) instead of running again.
     """
+    # user_id associated with the API Key (website owner)
+    owner_user_id = current_user["id"]
+    mark_request_start(owner_user_id)
+    if not idempotency_key:
+        return await _answer_message(request, current_user, conversations_db, ai_service)
+
+    # Fingerprint before the pipeline normalizes the request
+    fingerprint = request_fingerprint(request.model_dump())
+    try:
+        return await get_idempotency_store().run(
+            owner_user_id, idempotency_key, fingerprint,
+            lambda: _answer_message(request, current_user, conversations_db, ai_service)
+        )
+    except IdempotencyKeyMismatchError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+async def _answer_message(request: ChatRequest, current_user: Dict, conversations_db: Any, ai_service: AIService) -> ChatResponse:
+    """Answer one /chat/message request (the body of handle_message)."""
     try:
-        # user_id associated with the API Key (website owner)
         owner_user_id = current_user["id"]
-        user_collection = await get_user_collection() # Get user collection
-
-        # --- Order Status Intent Check ---
-        # (Keeping this as is - critical business functionality)
-        query_lower = request.query.lower()
-        order_keywords = ["order", "objednávk", "tracking", "track", "zásilk", "balik", "package", "delivery", "doručení"]
-        is_order_query = any(keyword in query_lower for keyword in order_keywords)
-
-        # Simple extraction (can be improved with NLP/regex)
-        order_number_match = re.search(r'#?([a-zA-Z0-9\-]+)', query_lower) # Look for order number like patterns
-        email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', query_lower) # Basic email regex
-
-        extracted_order_number = order_number_match.group(1) if order_number_match else None
-        extracted_email = email_match.group(0) if email_match else None
-
-        logger.debug(f"Order Query Check: is_order_query={is_order_query}, order#={extracted_order_number}, email={extracted_email}")
-
-        if is_order_query:
-            if extracted_order_number and extracted_email:
-                logger.info(f"Handling order status query for order '{extracted_order_number}' and email '{extracted_email}' for owner {owner_user_id}")
-                # Query the database using owner_user_id, customer_email, and platform_order_id
-                order = await orders_collection.find_one({
-                    "user_id": owner_user_id, # Filter by the website owner
-                    "customer_email": extracted_email.lower(), # Filter by customer email
-                    "$or": [ # Match either platform_order_id or order_number
-                         {"platform_order_id": extracted_order_number},
-                         {"order_number": extracted_order_number}
-                    ]
-                })
 
-                if order:
-                    order_data = serialize_mongo_doc(order)
-                    order_status = order_data.get("status", "unknown") # Renamed local variable
-                    tracking = order_data.get("tracking_number")
-                    carrier = order_data.get("carrier")
-                    est_delivery = order_data.get("estimated_delivery_date")
-                    platform_order_id = order_data.get("platform_order_id", "N/A")
-
-                    response_text = f"Order #{platform_order_id}: Status is '{order_status}'." # Use renamed variable
-                    if tracking:
-                        response_text += f" Tracking: {tracking}"
-                        if carrier:
-                            response_text += f" (Carrier: {carrier})"
-                        response_text += "."
-                    if est_delivery:
-                        try:
-                            # Format date nicely
-                            est_delivery_dt = datetime.fromisoformat(est_delivery.replace('Z', '+00:00'))
-                            response_text += f" Estimated delivery: {est_delivery_dt.strftime('%d.%m.%Y')}."
-                        except:
-                            response_text += f" Estimated delivery: {est_delivery}." # Fallback
-
-                    # Populate order_details with the found order data
-                    # The reply can be a simpler confirmation message now
-                    return ChatResponse(
-                        reply=f"Here's the status for order #{platform_order_id}:", # Simpler text reply
-                        source="order_status_lookup",
-                        confidence_score=1.0, # High confidence as it's a direct lookup
-                        conversation_id=request.context.conversation_id if request.context else str(uuid.uuid4()),
-                        followup_questions=[],
-                        metadata={},
-                        personalized_recommendations=[],
-                        order_details=Order(**order_data) # Pass the structured order data
-                    )
-                else:
-                    logger.warning(f"Order not found for owner {owner_user_id}, email {extracted_email}, order# {extracted_order_number}")
-                    response_text = "I couldn't find an order matching that email and order number. Please double-check the details."
-                    return ChatResponse(
-                        reply=response_text,
-                        source="order_status_not_found",
-                        confidence_score=1.0,
-                        conversation_id=request.context.conversation_id if request.context else str(uuid.uuid4()),
-                        followup_questions=["Would you like to try a different order number or email?"],
-                        metadata={},
-                        personalized_recommendations=[]
-                    )
-            else:
-                # Ask for missing details
-                missing = []
-                if not extracted_email: missing.append("your email address")
-                if not extracted_order_number: missing.append("your order number")
-                response_text = f"To check your order status, please provide {' and '.join(missing)}."
-                return ChatResponse(
-                    reply=response_text,
-                    source="order_status_clarification",
-                    confidence_score=1.0,
-                    conversation_id=request.context.conversation_id if request.context else str(uuid.uuid4()),
-                    followup_questions=[],
-                    metadata={},
-                    personalized_recommendations=[]
-                )
-        # --- End Order Status Intent Check ---
+        hits = await _match_keywords(request, owner_user_id)
+        with stage("order_lookup"):
+            order_response = await _handle_order_status_query(request, owner_user_id, hits)
+        if order_response is not None:
+            return order_response
 
         # --- Proceed with normal AI processing if not an order query ---
         logger.debug("Not an order query, proceeding with standard AI processing.")
+        ticket = await _admit_turn(current_user)
+        try:
+            budget = LatencyBudget() # Time this turn may spend waiting on Gemini (queueing excluded)
+            is_new_conversation = await _prepare_chat_request(request, current_user)
+
+            # --- New Hybrid AI Flow ---
+            # 1. Extract Entities, 2. Retrieve Relevant Data, 3. Apply Business Logic
+            turn = await _run_retrieval_pipeline(
+                request, owner_user_id, ai_service, budget, classifier_threshold=get_tenant_threshold(current_user), hits=hits,
+                is_new_conversation=is_new_conversation
+            )
 
-        # Ensure we have a valid conversation context before checking limits or accessing attributes
-        # Convert dict to the Pydantic model instance if necessary
-        if isinstance(request.context, dict):
-            request.context = EnhancedConversationContext(**request.context)
-        elif request.context is None:
-             request.context = EnhancedConversationContext()
-        # Now request.context is guaranteed to be an EnhancedConversationContext object
-
-        # --- Check and Update Monthly Conversation Limit ---
-        is_new_conversation = not request.context.conversation_id
-        if is_new_conversation:
-            now = datetime.now(timezone.utc)
-            usage_start = current_user.get("usage_period_start_date")
-            needs_reset = False
-
-            if usage_start is None:
-                needs_reset = True
-            else:
-                # Make usage_start timezone-aware (assuming it's UTC)
-                if usage_start.tzinfo is None:
-                    usage_start = usage_start.replace(tzinfo=timezone.utc)
-
-                # Check if more than ~30 days have passed
-                if now > usage_start + timedelta(days=30): # Approximation for a month
-                    needs_reset = True
-
-            if needs_reset:
-                await user_collection.update_one(
-                    {"id": owner_user_id},
-                    {"$set": {"conversation_count_current_month": 0, "usage_period_start_date": now}}
-                )
-                current_user["conversation_count_current_month"] = 0 # Update local copy
-                current_user["usage_period_start_date"] = now
-                logger.info(f"Reset monthly conversation count for user {owner_user_id}")
-
-            # Check limit before incrementing
-            tier_str = current_user.get("subscription_tier", "free")
-
-            # --- Temporary Fix: Map known Price ID to tier name ---
-            # Ideally, the webhook should store the tier name directly.
-            price_id_to_tier_map = {
-                "price_1RAIdbr4qkX0uO0aXoszn1Fs2": "basic"
-                # Add other Price IDs and their corresponding tier names here if needed
-            }
-            if tier_str in price_id_to_tier_map:
-                tier_str = price_id_to_tier_map[tier_str]
-                logger.debug(f"Mapped Price ID {current_user.get('subscription_tier')} to tier '{tier_str}' for limit check.")
-            # --- End Temporary Fix ---
-
-            try:
-                tier = SubscriptionTier(tier_str)
-            except ValueError:
-                logger.warning(f"Invalid or unrecognized subscription_tier value '{tier_str}' for user {owner_user_id}. Defaulting to FREE.")
-                tier = SubscriptionTier.FREE
-
-            limits = {
-                SubscriptionTier.FREE: 0, # Limit for free tier
-                SubscriptionTier.BASIC: 500,
-                SubscriptionTier.PREMIUM: 1500,
-                SubscriptionTier.ENTERPRISE: float('inf') # Unlimited
-            }
-            max_convos = limits.get(tier, 0)
-            current_convo_count = current_user.get("conversation_count_current_month", 0)
-
-            if current_convo_count >= max_convos:
-                logger.warning(f"User {owner_user_id} (Tier: {tier.value}) tried to start new conversation but reached monthly limit ({max_convos})")
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail=f"Monthly conversation limit ({max_convos}) reached for your '{tier.value}' plan."
-                )
-
-            # Increment count for the new conversation
-            await user_collection.update_one(
-                {"id": owner_user_id},
-                {"$inc": {"conversation_count_current_month": 1}}
+            # 4. Generate Response using simplified AI Service method (unless the fused draft already answers it)
+            response_text = turn["draft_reply"] or await ai_service.generate_response_with_gemini(
+                query=request.query,
+                analysis=turn["analysis"],
+                relevant_data=turn["processed_data"], # Pass the processed, tenant-specific data
+                context=request.context,
+                language=request.language,
+                budget=budget
             )
-            logger.info(f"Incremented monthly conversation count for user {owner_user_id} (New count: {current_convo_count + 1})")
-        # --- End Limit Check ---
-
-        # Correct language code if needed
-        if request.language == "cze":
-            request.language = "cs"
-
-        # Assign new conversation ID if not present
-        if request.context.conversation_id is None:
-            request.context.conversation_id = str(uuid.uuid4())
-
-        request.context.user_id = owner_user_id
-        request.user_id = owner_user_id # Also add to request object if needed elsewhere
-
-        # --- New Hybrid AI Flow ---
-        # 1. Extract Entities using simplified AI Service method
-        analysis = await ai_service.extract_entities_with_gemini(
-            query=request.query,
-            context=request.context,
-            language=request.language
-        )
-        intent = analysis.get("intent", "general_question")
-        entities = analysis.get("entities", {})
-        logger.debug(f"Initial Extracted Analysis: Intent={intent}, Entities={entities}")
-
-        # --- Intent Override Fallback ---
-        # If Gemini classified as general but query seems product-related, override intent.
-        # Added more keywords and check query_lower
-        product_keywords_cs = ["produkt", "zboží", "sortiment", "nabídk", "máte", "prodáváte"]
-        product_keywords_en = ["product", "goods", "assortment", "offer", "have", "sell", "inventory", "items"]
-        product_keywords = product_keywords_cs if request.language == "cs" else product_keywords_en
-        if intent == "general_question" and any(keyword in query_lower for keyword in product_keywords):
-            logger.warning(f"Overriding intent from 'general_question' to 'product_recommendation' based on keywords for query: '{request.query}'")
-            intent = "product_recommendation"
-            analysis["intent"] = intent # Update analysis dict as well
-
-        # Update conversation context with potentially overridden intent/entities
-        await request.context.update_context(
-            request.query,
-            intent=intent,
-            entities=entities
-        )
+            # Note: Follow-up questions might be included in response_text by Gemini now, or omitted.
+
+            # 5. Structure Final Response
+            conversation_entry = _build_conversation_entry(request, owner_user_id, turn, response_text)
+
+            # Save conversation in background, from this task rather than the request's BackgroundTasks:
+            # with an Idempotency-Key this runs detached and the first client may already be gone
+            _spawn_background(save_conversation_entry(conversations_db, conversation_entry))
+
+            # Human chat availability was looked up during retrieval
+            human_chat_available = turn["human_chat_available"]
+
+            # Prepare and return final response
+            return ChatResponse(
+                reply=response_text,
+                source="ai_hybrid",
+                confidence_score=turn["analysis"].get("confidence", 0.8),
+                conversation_id=turn["conversation_id"],
+                followup_questions=[], # Follow-ups are now part of the main reply or omitted
+                metadata=_build_response_metadata(request, turn, human_chat_available),
+                personalized_recommendations=turn["personalized_recommendations"]
+            )
+        finally:
+            ticket.release()
 
-        # 2. Retrieve Relevant Data from KnowledgeBase (using owner_user_id)
-        knowledge_base = await get_knowledge_base()
-        relevant_products = []
-        qa_items = []
-
-        # Prioritize fetching based on specific entities first
-        if entities.get("products"):
-            for name in entities["products"]:
-                found = await knowledge_base.find_products_by_name(name, user_id=owner_user_id, limit=3) # Limit slightly higher for direct name match
-                relevant_products.extend(found)
-        elif entities.get("categories"):
-            # Use the first category for simplicity, could be expanded
-            found = await knowledge_base.find_products_by_category(entities["categories"][0], user_id=owner_user_id, limit=5)
-            relevant_products.extend(found)
-        # Add logic to search by features/price if needed
-        elif entities.get("features") or entities.get("price_range"):
-             search_query = {}
-             if entities.get("features"):
-                 search_query["features"] = {"$all": entities["features"]}
-             if entities.get("price_range"):
-                 price_filter = {}
-                 if entities["price_range"].get("min") is not None: price_filter["$gte"] = entities["price_range"]["min"]
-                 if entities["price_range"].get("max") is not None: price_filter["$lte"] = entities["price_range"]["max"]
-                 if price_filter: search_query["price"] = price_filter
-             if search_query:
-                 found = await knowledge_base.find_products_by_query(search_query, user_id=owner_user_id, limit=5)
-                 relevant_products.extend(found)
-
-        # --- Fetch General Recommendations if Intent is Recommendation AND no specific products were found via entities ---
-        if intent == "product_recommendation" and not relevant_products:
-             logger.info(f"Intent is product_recommendation but no specific entities led to products. Fetching general recommendations for user {owner_user_id}.")
-             recommended_fallback = await knowledge_base.get_recommended_products(user_id=owner_user_id, limit=3) # Fetch top 3 general
-             relevant_products.extend(recommended_fallback)
-
-        # Fetch QA items for service intents (can run in parallel with product fetching if complex)
-        if intent in ["customer_service", "shipping_payment", "store_navigation"]:
-             # Use keywords related to intent or extracted entities to find QA
-             search_term = request.query.split()[0] # Simple keyword extraction
-             qa_items = await knowledge_base.find_qa_items_by_keyword(search_term, user_id=owner_user_id, limit=3) # Assuming QA might be tenant specific? If not, remove user_id
-
-        # Remove duplicates just in case
-        relevant_products = list({p['_id']: p for p in relevant_products}.values())
-        logger.debug(f"Retrieved {len(relevant_products)} relevant products and {len(qa_items)} QA items.")
-
-        # 3. Apply Business Logic / Process Data (Keep relevant parts)
-        processed_data = []
-        score_map = {} # Store both score and components
-        if intent == "product_recommendation" and relevant_products:
-            # Use the existing scoring logic
-            scored_products = await ai_service._score_products_for_recommendation(relevant_products, entities, request.context)
-            scored_products.sort(key=lambda x: x["score"], reverse=True)
-            top_products = scored_products[:3]
-            processed_data = [ai_service._format_product_data(p["product"]) for p in top_products] # Format for Gemini prompt
-            # Store score and components for later use
-            for p_data in top_products:
-                 p_id = str(p_data["product"]["_id"])
-                 score_map[p_id] = {"score": p_data["score"], "components": p_data["score_components"]} # Store both
-        elif relevant_products:
-             # Format top products for context, even if not recommendation
-             processed_data = [ai_service._format_product_data(p) for p in relevant_products[:3]]
-        elif qa_items:
-             # Format QA items for context
-             processed_data = [{"question": q.get("question"), "answer": q.get("answer")} for q in qa_items]
-
-        # 4. Generate Response using simplified AI Service method
-        response_text = await ai_service.generate_response_with_gemini(
-            query=request.query,
-            analysis=analysis,
-            relevant_data=processed_data, # Pass the processed, tenant-specific data
-            context=request.context,
-            language=request.language
-        )
-        # Note: Follow-up questions might be included in response_text by Gemini now, or omitted.
-
-        # 5. Structure Final Response
-        conv_id = request.context.conversation_id or str(uuid.uuid4()) # Ensure ID exists
-        conversation_entry = ConversationEntry(
-            conversation_id=conv_id,
-            timestamp=datetime.now(timezone.utc),
-            query=request.query,
-            response=response_text, # Use the text generated by Gemini
-            source="ai_hybrid", # Indicate the new source
-            language=request.language,
-            user_id=owner_user_id,
-            confidence_score=analysis.get("confidence", 0.8), # Use confidence from entity extraction
-            metadata={ # Store analysis results and client context
-                "intent": intent,
-                "entities": entities,
-                "client_metadata": request.context.model_dump()
-                # Removed old complex metadata structure
+    except HTTPException as http_exception:
+        raise http_exception
+    except Exception as e:
+        logger.error(f"Error handling message: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": "internal_server_error",
+                "message": str(e)
             }
         )
 
-        # Save conversation in background
-        background_tasks.add_task(save_conversation_entry, conversations_db, conversation_entry)
-
-        # Check human chat availability
-        human_chat_available = await is_human_chat_available(conv_id, owner_user_id)
-
-        # Generate personalized recommendations whenever relevant products were found and processed,
-        # especially if the intent was recommendation or if specific products were mentioned/found.
-        personalized_recommendations = []
-        # Check if processed_data contains product info (check for 'product_id' or similar key)
-        # and if the intent suggests products OR if specific products were found initially.
-        if relevant_products and processed_data and isinstance(processed_data[0], dict) and "id" in processed_data[0]:
-             logger.info(f"Generating personalized recommendations for intent '{intent}' as relevant products were found.")
-             # Use score_map if intent was recommendation, otherwise use default scores/explanations
-             for product in relevant_products: # Iterate through originally found products
-                 p_id = str(product["_id"])
-                 # Find corresponding formatted data in processed_data (used for Gemini prompt)
-                 formatted_product_data = next((item for item in processed_data if item.get("id") == p_id), None)
-                 if not formatted_product_data:
-                     # logger.warning(f"Product ID {p_id} from relevant_products not found in processed_data. Skipping recommendation.") # Keep warning commented for now
-                     continue # Skip if not in top processed
-
-                 score_components = {}
-                 match_score = 0.7 # Default score
-                 explanation = _generate_simple_explanation(product, request.context) # Default explanation
-
-                 if p_id in score_map: # If scoring was done (recommendation intent)
-                     score_data = score_map[p_id]
-                     score_components = score_data["components"]
-                     match_score = score_data["score"]
-                     explanation = _generate_recommendation_explanation(product, score_components, request.context)
-
-                 personalized_recommendations.append({
-                     "product_id": p_id,
-                         "name": product.get("product_name", ""),
-                         "explanation": explanation,
-                         "match_score": match_score, # Use the correct score
-                         "image_url": product.get("image_url", "/static/images/default.jpg"),
-                         "url": product.get("url", "#"),
-                         "price": _format_price(product.get("pricing", {})), # Use existing helper
-                         "category": product.get("category", ""),
-                         "features": product.get("features", [])[:5],
-                         "score_components": score_components
-                     })
-             # Sort recommendations by score before returning
-             personalized_recommendations.sort(key=lambda x: x["match_score"], reverse=True)
-             # logger.debug(f"Final personalized_recommendations before return: {json.dumps(personalized_recommendations, default=str)}") # Keep debug commented
-
-        # Prepare and return final response
-        return ChatResponse(
-            reply=response_text,
-            source="ai_hybrid",
-            confidence_score=analysis.get("confidence", 0.8),
-            conversation_id=conv_id,
-            followup_questions=[], # Follow-ups are now part of the main reply or omitted
-            metadata={ # Simplified metadata
-                "intent": intent,
-                "entities": entities,
-                "human_chat_available": human_chat_available,
-                "client_context": serialize_mongo_doc(request.context.model_dump())
-            },
-            personalized_recommendations=personalized_recommendations # Use the generated list
+@router.post("/chat/message/stream")
+async def handle_message_stream(
+    request: ChatRequest,
+    current_user: Dict = Depends(verify_widget_origin),
+    conversations_db = Depends(get_conversations_collection),
+    ai_service = Depends(get_ai_service)
+) -> StreamingResponse:
+    """
+    Streaming variant of /chat/message using Server-Sent Events.
+
+    Auth, admission, usage limits, NLU and retrieval run before the response starts, so
+    errors still surface as regular HTTP status codes. The stream then emits:
+    - `metadata`: conversation id, intent/entities and personalized_recommendations
+    - `delta`: reply text chunks as Gemini produces them
+    - `done`: the full reply and confidence score
+    - `error`: only if generation fails after the stream has started
+    """
+    ticket = None
+    try:
+        owner_user_id = current_user["id"]
+        mark_request_start(owner_user_id)
+
+        hits = await _match_keywords(request, owner_user_id)
+        with stage("order_lookup"):
+            order_response = await _handle_order_status_query(request, owner_user_id, hits)
+        if order_response is not None:
+            return StreamingResponse(
+                _sse_stream(_static_response_events(order_response)),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS
+            )
+
+        # The admission slot is held until the reply has been streamed (see event_stream)
+        ticket = await _admit_turn(current_user)
+        budget = LatencyBudget()
+        is_new_conversation = await _prepare_chat_request(request, current_user)
+        turn = await _run_retrieval_pipeline(
+            request, owner_user_id, ai_service, budget, classifier_threshold=get_tenant_threshold(current_user), hits=hits,
+            is_new_conversation=is_new_conversation
         )
 
     except HTTPException as http_exception:
+        if ticket is not None:
+            ticket.release()
         raise http_exception
     except Exception as e:
-        logger.error(f"Error handling message: {str(e)}", exc_info=True)
+        if ticket is not None:
+            ticket.release()
+        logger.error(f"Error preparing streamed message: {str(e)}", exc_info=True)
         raise HTTPException(
             status_code=500,
             detail={
@@ -455,389 +255,862 @@ async def handle_message(
                 "message": str(e)
             }
         )
-        owner_user_id = current_user["id"]
-        user_collection = await get_user_collection() # Get user collection
-
-        # --- Order Status Intent Check ---
-        query_lower = request.query.lower()
-        order_keywords = ["order", "objednávk", "tracking", "track", "zásilk", "balik", "package", "delivery", "doručení"]
-        is_order_query = any(keyword in query_lower for keyword in order_keywords)
-
-        # Simple extraction (can be improved with NLP/regex)
-        order_number_match = re.search(r'#?([a-zA-Z0-9\-]+)', query_lower) # Look for order number like patterns
-        email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', query_lower) # Basic email regex
-
-        extracted_order_number = order_number_match.group(1) if order_number_match else None
-        extracted_email = email_match.group(0) if email_match else None
-
-        logger.debug(f"Order Query Check: is_order_query={is_order_query}, order#={extracted_order_number}, email={extracted_email}")
-
-        if is_order_query:
-            if extracted_order_number and extracted_email:
-                logger.info(f"Handling order status query for order '{extracted_order_number}' and email '{extracted_email}' for owner {owner_user_id}")
-                # Query the database using owner_user_id, customer_email, and platform_order_id
-                order = await orders_collection.find_one({
-                    "user_id": owner_user_id, # Filter by the website owner
-                    "customer_email": extracted_email.lower(), # Filter by customer email
-                    "$or": [ # Match either platform_order_id or order_number
-                         {"platform_order_id": extracted_order_number},
-                         {"order_number": extracted_order_number}
-                    ]
-                })
 
-                if order:
-                    order_data = serialize_mongo_doc(order)
-                    order_status = order_data.get("status", "unknown") # Renamed local variable
-                    tracking = order_data.get("tracking_number")
-                    carrier = order_data.get("carrier")
-                    est_delivery = order_data.get("estimated_delivery_date")
-                    platform_order_id = order_data.get("platform_order_id", "N/A")
-
-                    response_text = f"Order #{platform_order_id}: Status is '{order_status}'." # Use renamed variable
-                    if tracking:
-                        response_text += f" Tracking: {tracking}"
-                        if carrier:
-                            response_text += f" (Carrier: {carrier})"
-                        response_text += "."
-                    if est_delivery:
-
-                        try:
-                            # Format date nicely
-                            est_delivery_dt = datetime.fromisoformat(est_delivery.replace('Z', '+00:00'))
-                            response_text += f" Estimated delivery: {est_delivery_dt.strftime('%d.%m.%Y')}."
-                        except:
-                            response_text += f" Estimated delivery: {est_delivery}." # Fallback
-
-                    # Populate order_details with the found order data
-                    # The reply can be a simpler confirmation message now
-                    return ChatResponse(
-                        reply=f"Here's the status for order #{platform_order_id}:", # Simpler text reply
-                        source="order_status_lookup",
-                        confidence_score=1.0, # High confidence as it's a direct lookup
-                        conversation_id=request.context.conversation_id if request.context else str(uuid.uuid4()),
-                        followup_questions=[],
-                        metadata={},
-                        personalized_recommendations=[],
-                        order_details=Order(**order_data) # Pass the structured order data
-                    )
-                else:
-                    logger.warning(f"Order not found for owner {owner_user_id}, email {extracted_email}, order# {extracted_order_number}")
-                    response_text = "I couldn't find an order matching that email and order number. Please double-check the details."
-                    return ChatResponse(
-                        reply=response_text,
-                        source="order_status_not_found",
-                        confidence_score=1.0,
-                        conversation_id=request.context.conversation_id if request.context else str(uuid.uuid4()),
-                        followup_questions=["Would you like to try a different order number or email?"],
-                        metadata={},
-                        personalized_recommendations=[]
-                    )
+    # The timer is finished by event_stream, so generation and persistence are part of the total
+    timer = current_timer()
+    if timer is not None:
+        timer.deferred = True
+
+    async def event_stream():
+        try:
+            async for event, data in _turn_events(request, owner_user_id, turn, ai_service, conversations_db, budget):
+                yield _sse_event(event, data)
+        finally:
+            ticket.release()
+            if timer is not None:
+                timer.finish()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@router.websocket("/ws/chat")
+async def chat_websocket(
+    websocket: WebSocket,
+    api_key: Optional[str] = Query(None),
+    conversation_id: Optional[str] = Query(None),
+    language: str = Query("cs")
+):
+    """
+    WebSocket variant of /chat/message/stream for the widget.
+
+    The API key and Origin are verified once, when the socket connects (browsers can't set
+    headers on WebSocket requests, so the key may come as the `api_key` query parameter).
+    The conversation context stays on the server between messages and for
+    WS_CHAT_CONTEXT_TTL after a disconnect, so reconnecting with `conversation_id` resumes
+    the conversation. The socket is registered in the human chat ConnectionManager under
+    the conversation id.
+
+    Client messages:
+    - {"type": "message", "id": ..., "query": ..., "language": ...}; messages may be sent
+      before the previous reply is complete and are answered in order
+    - {"type": "ping"}, answered with `pong`
+
+    Server events are the SSE stream events (`metadata`, `delta`, `done`, `error`) as
+    {"type": event, "id": message id, ...data}.
+    """
+    db = await get_db()
+    try:
+        current_user = await verify_widget_origin(websocket, api_key or websocket.headers.get("x-api-key"), db)
+    except HTTPException as e:
+        logger.warning(f"Chat WebSocket rejected: {e.detail}")
+        await websocket.close(code=1008, reason=str(e.detail))
+        return
+
+    owner_user_id = current_user["id"]
+    ai_service = await get_ai_service()
+    conversations_db = await get_conversations_collection()
+
+    context = _ws_contexts.get((owner_user_id, conversation_id)) if conversation_id else None
+    if context is None:
+        context = EnhancedConversationContext(conversation_id=conversation_id)
+    # A conversation started on this socket is counted against the limit with its first message
+    channel_id = conversation_id or str(uuid.uuid4())
+
+    await connection_manager.connect(websocket, channel_id, owner_user_id)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=WS_CHAT_MAX_PIPELINED)
+
+    async def answer_messages():
+        while True:
+            message = await queue.get()
+            message_id = message.get("id")
+            timer = start_request_timer("WS /api/ws/chat")
+            timer.tenant = owner_user_id
+            try:
+                if context.conversation_id is None:
+                    with stage("usage_limit"):
+                        await _enforce_conversation_limit(current_user)
+                    context.conversation_id = channel_id
+                request = ChatRequest(query=message.get("query", ""), language=message.get("language", language))
+                request.context = context
+                async for event, data in _ws_turn_events(request, current_user, ai_service, conversations_db):
+                    await websocket.send_text(_ws_event(event, message_id, data))
+                _ws_contexts.set((owner_user_id, channel_id), context)
+            except ValidationError as e:
+                await websocket.send_text(_ws_event("error", message_id, {"error": "invalid_message", "message": str(e)}))
+            except HTTPException as e:
+                error = {"error": "request_failed", "status_code": e.status_code, "message": e.detail}
+                if e.headers and "Retry-After" in e.headers:
+                    error["retry_after"] = int(e.headers["Retry-After"])
+                await websocket.send_text(_ws_event("error", message_id, error))
+                if e.status_code == status.HTTP_403_FORBIDDEN:
+                    await websocket.close(code=1008, reason="Conversation limit reached")
+                    return
+            except Exception as e:
+                logger.error(f"Error answering WebSocket message for conversation {channel_id}: {str(e)}", exc_info=True)
+                await websocket.send_text(_ws_event("error", message_id, {"error": "internal_server_error", "message": str(e)}))
+            finally:
+                timer.finish()
+
+    worker = asyncio.create_task(answer_messages())
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            try:
+                message = json.loads(raw)
+            except json.JSONDecodeError:
+                await websocket.send_text(_ws_event("error", None, {"error": "invalid_json"}))
+                continue
+
+            if message.get("type") == "message":
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    await websocket.send_text(_ws_event("error", message.get("id"), {
+                        "error": "too_many_pipelined_messages",
+                        "message": f"At most {WS_CHAT_MAX_PIPELINED} messages may wait for a reply."
+                    }))
+            elif message.get("type") == "ping":
+                await websocket.send_text(_ws_event("pong", message.get("id"), {}))
             else:
-                # Ask for missing details
-                missing = []
-                if not extracted_email: missing.append("your email address")
-                if not extracted_order_number: missing.append("your order number")
-                response_text = f"To check your order status, please provide {' and '.join(missing)}."
-                return ChatResponse(
-                    reply=response_text,
-                    source="order_status_clarification",
-                    confidence_score=1.0,
-                    conversation_id=request.context.conversation_id if request.context else str(uuid.uuid4()),
-                    followup_questions=[],
-                    metadata={},
-                    personalized_recommendations=[]
-                )
-        # --- End Order Status Intent Check ---
+                await websocket.send_text(_ws_event("error", message.get("id"), {"error": "unknown_message_type"}))
+    except WebSocketDisconnect:
+        logger.info(f"Chat WebSocket for conversation {channel_id} disconnected")
+    except Exception as e:
+        logger.error(f"Chat WebSocket error for conversation {channel_id}: {str(e)}")
+    finally:
+        worker.cancel()
+        connection_manager.disconnect(websocket)
+
+@router.get("/chat/quota")
+async def get_conversation_quota_status(
+    current_user: Dict = Depends(get_current_active_customer)
+) -> Dict[str, Any]:
+    """Monthly conversation limit, usage and remaining quota of the current tenant."""
+    return await get_conversation_quota().status(current_user)
+
+class PreclassifierThresholdUpdate(BaseModel):
+    threshold: float = Field(..., ge=0.0, le=1.0)
+
+@router.get("/chat/preclassifier/report")
+async def get_preclassifier_report(
+    current_user: Dict = Depends(get_current_active_customer)
+) -> Dict[str, Any]:
+    """
+    Per-intent precision/recall of the local pre-classifier against Gemini for the current
+    tenant, at several thresholds, so the threshold can be tuned.
+    """
+    report = get_classifier_evaluator().report(current_user["id"])
+    report["current_threshold"] = get_tenant_threshold(current_user)
+    return report
+
+@router.put("/chat/preclassifier/threshold")
+async def update_preclassifier_threshold(
+    update: PreclassifierThresholdUpdate,
+    current_user: Dict = Depends(get_current_active_customer)
+) -> Dict[str, Any]:
+    """Set the tenant's minimum pre-classifier confidence for skipping the Gemini NLU call."""
+    user_collection = await get_user_collection()
+    await user_collection.update_one(
+        {"id": current_user["id"]},
+        {"$set": {"preclassifier_threshold": update.threshold}}
+    )
+    logger.info(f"User {current_user['id']} set pre-classifier threshold to {update.threshold}")
+    return {"threshold": update.threshold}
+
+# --- Batch replays (offline evaluation) ---
+
+class ChatBatchItem(BaseModel):
+    user_id: str # Tenant (website owner) the query is answered for
+    query: str
+    language: str = "cs"
+    context: Dict[str, Any] = Field(default_factory=dict)
+    id: Optional[str] = None # Caller's reference, echoed in the result
+
+async def run_chat_batch(items: List[ChatBatchItem], concurrency: int = CHAT_BATCH_CONCURRENCY, use_response_cache: bool = False):
+    """
+    Answer many stored queries, yielding one result per item as items finish.
 
-        # --- Proceed with normal AI processing if not an order query ---
-        logger.debug("Not an order query, proceeding with standard AI processing.")
+    Items run through the same pipeline as /chat/message and share the KnowledgeBase,
+    retrieval and system prompt caches, but they are not counted against the monthly
+    conversation limit and nothing is persisted. Replies are generated fresh unless
+    use_response_cache is set, so replays reflect prompt changes.
 
-        # Ensure we have a valid conversation context before checking limits or accessing attributes
-        # Convert dict to the Pydantic model instance if necessary
-        if isinstance(request.context, dict):
-            request.context = EnhancedConversationContext(**request.context)
-        elif request.context is None:
-             request.context = EnhancedConversationContext()
-        # Now request.context is guaranteed to be an EnhancedConversationContext object
+    Args:
+        items: Queries to answer
+        concurrency: Items processed at the same time (capped at CHAT_BATCH_MAX_CONCURRENCY)
+        use_response_cache: Serve replies from the response cache when possible
 
-        # --- Check and Update Monthly Conversation Limit ---
-        is_new_conversation = not request.context.conversation_id
-        if is_new_conversation:
-            now = datetime.now(timezone.utc)
-            usage_start = current_user.get("usage_period_start_date")
-            needs_reset = False
+    Yields:
+        Result dicts with index, id, user_id, query, reply, source, intent, entities,
+        product_ids, timings_ms (per stage), total_ms and error (on failure)
+    """
+    ai_service = await get_ai_service()
+    user_collection = await get_user_collection()
+    user_ids = list({item.user_id for item in items})
+    users = {user["id"]: user async for user in user_collection.find({"id": {"$in": user_ids}})}
+    semaphore = asyncio.Semaphore(max(1, min(concurrency, CHAT_BATCH_MAX_CONCURRENCY)))
 
-            if usage_start is None:
-                needs_reset = True
-            else:
-                # Make usage_start timezone-aware (assuming it's UTC)
-                if usage_start.tzinfo is None:
-                    usage_start = usage_start.replace(tzinfo=timezone.utc)
-
-                # Check if more than ~30 days have passed
-                if now > usage_start + timedelta(days=30): # Approximation for a month
-                    needs_reset = True
-
-            if needs_reset:
-                await user_collection.update_one(
-                    {"id": owner_user_id},
-                    {"$set": {"conversation_count_current_month": 0, "usage_period_start_date": now}}
-                )
-                current_user["conversation_count_current_month"] = 0 # Update local copy
-                current_user["usage_period_start_date"] = now
-                logger.info(f"Reset monthly conversation count for user {owner_user_id}")
-
-            # Check limit before incrementing
-            tier_str = current_user.get("subscription_tier", "free")
-
-            # --- Temporary Fix: Map known Price ID to tier name ---
-            # Ideally, the webhook should store the tier name directly.
-            price_id_to_tier_map = {
-                "price_1RAIdbr4qkX0uO0aXoszn1Fs2": "basic"
-                # Add other Price IDs and their corresponding tier names here if needed
-            }
-            if tier_str in price_id_to_tier_map:
-                tier_str = price_id_to_tier_map[tier_str]
-                logger.debug(f"Mapped Price ID {current_user.get('subscription_tier')} to tier '{tier_str}' for limit check.")
-            # --- End Temporary Fix ---
+    async def run(index: int, item: ChatBatchItem) -> Dict[str, Any]:
+        async with semaphore:
+            return await _answer_batch_item(index, item, users.get(item.user_id), ai_service, use_response_cache)
 
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _answer_batch_item(index: int, item: ChatBatchItem, user: Optional[Dict], ai_service: AIService, use_response_cache: bool) -> Dict[str, Any]:
+    """Answer one batch item, recording its stage timings (kept out of the live latency metrics)."""
+    result = {"index": index, "id": item.id, "user_id": item.user_id, "query": item.query}
+    # The timer is never finished, so replays don't show up in the stage histograms
+    timer = start_request_timer("BATCH chat")
+    timer.tenant = item.user_id
+    try:
+        if user is None:
+            raise ValueError(f"Unknown user {item.user_id}")
+        request = ChatRequest(query=item.query, language=item.language)
+        request.context = EnhancedConversationContext(**item.context)
+        # With a conversation id the request is treated as an existing conversation (not counted)
+        is_new_conversation = request.context.conversation_id is None
+        if is_new_conversation:
+            request.context.conversation_id = f"batch-{uuid.uuid4()}"
+
+        hits = await _match_keywords(request, item.user_id)
+        with stage("order_lookup"):
+            order_response = await _handle_order_status_query(request, item.user_id, hits)
+        if order_response is not None:
+            result.update({"reply": order_response.reply, "source": order_response.source})
+        else:
+            # Replays queue for admission like live turns of the tenant (a rejection fails the item)
+            with stage("admission"):
+                ticket = await get_admission_scheduler().acquire(item.user_id, resolve_tier(user))
             try:
-                tier = SubscriptionTier(tier_str)
-            except ValueError:
-                logger.warning(f"Invalid or unrecognized subscription_tier value '{tier_str}' for user {owner_user_id}. Defaulting to FREE.")
-                tier = SubscriptionTier.FREE
-
-            limits = {
-                SubscriptionTier.FREE: 0, # Limit for free tier
-                SubscriptionTier.BASIC: 500,
-                SubscriptionTier.PREMIUM: 1500,
-                SubscriptionTier.ENTERPRISE: float('inf') # Unlimited
-            }
-            max_convos = limits.get(tier, 0)
-            current_convo_count = current_user.get("conversation_count_current_month", 0)
-
-            if current_convo_count >= max_convos:
-                logger.warning(f"User {owner_user_id} (Tier: {tier.value}) tried to start new conversation but reached monthly limit ({max_convos})")
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail=f"Monthly conversation limit ({max_convos}) reached for your '{tier.value}' plan."
+                budget = LatencyBudget()
+                await _prepare_chat_request(request, user)
+                turn = await _run_retrieval_pipeline(
+                    request, item.user_id, ai_service, budget, classifier_threshold=get_tenant_threshold(user), hits=hits,
+                    is_new_conversation=is_new_conversation, evaluate_classifier=False
+                )
+                reply = turn["draft_reply"] or await ai_service.generate_response_with_gemini(
+                    query=request.query,
+                    analysis=turn["analysis"],
+                    relevant_data=turn["processed_data"],
+                    context=request.context,
+                    language=request.language,
+                    budget=budget,
+                    use_response_cache=use_response_cache
                 )
+                result.update({
+                    "reply": reply,
+                    "source": "ai_hybrid",
+                    "intent": turn["intent"],
+                    "entities": turn["entities"],
+                    "analysis_source": turn["analysis"].get("source", "gemini"),
+                    "product_ids": [recommendation["product_id"] for recommendation in turn["personalized_recommendations"]]
+                })
+            finally:
+                ticket.release()
+    except Exception as e:
+        logger.error(f"Batch item {index} for user {item.user_id} failed: {str(e)}", exc_info=True)
+        result["error"] = str(e)
+    result["timings_ms"] = {stage_name: round(ms, 1) for stage_name, ms in timer.totals().items()}
+    result["total_ms"] = round(timer.elapsed_ms(), 1)
+    return result
+
+# --- Pipeline stages shared by the blocking and streaming endpoints ---
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format a single Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+def _ws_event(event: str, message_id: Any, data: Dict[str, Any]) -> str:
+    """Format a single WebSocket event for the message it answers."""
+    return json.dumps({"type": event, "id": message_id, **data}, default=str, ensure_ascii=False)
+
+async def _ws_turn_events(request: ChatRequest, current_user: Dict, ai_service: AIService, conversations_db: Any):
+    """
+    Events of one WebSocket chat turn (see chat_websocket): the same stages as the
+    streaming endpoint, with auth and conversation counting already done per connection.
+    """
+    owner_user_id = current_user["id"]
+
+    hits = await _match_keywords(request, owner_user_id)
+    with stage("order_lookup"):
+        order_response = await _handle_order_status_query(request, owner_user_id, hits)
+    if order_response is not None:
+        async for event in _static_response_events(order_response):
+            yield event
+        return
+
+    ticket = await _admit_turn(current_user)
+    try:
+        budget = LatencyBudget()
+        is_new_conversation = await _prepare_chat_request(request, current_user)
+        turn = await _run_retrieval_pipeline(
+            request, owner_user_id, ai_service, budget, classifier_threshold=get_tenant_threshold(current_user), hits=hits,
+            is_new_conversation=is_new_conversation
+        )
+        async for event in _turn_events(request, owner_user_id, turn, ai_service, conversations_db, budget):
+            yield event
+    finally:
+        ticket.release()
+
+async def _sse_stream(events):
+    """Format (event, data) pairs as an SSE stream."""
+    async for event, data in events:
+        yield _sse_event(event, data)
+
+async def _static_response_events(response: ChatResponse):
+    """Events for an already complete ChatResponse (e.g. an order status lookup)."""
+    payload = serialize_mongo_doc(response.model_dump())
+    yield "metadata", {
+        "conversation_id": payload.get("conversation_id"),
+        "source": payload.get("source"),
+        "metadata": payload.get("metadata", {}),
+        "personalized_recommendations": payload.get("personalized_recommendations", []),
+        "order_details": payload.get("order_details"),
+        "followup_questions": payload.get("followup_questions", [])
+    }
+    yield "delta", {"text": response.reply}
+    yield "done", {
+        "reply": response.reply,
+        "confidence_score": response.confidence_score,
+        "conversation_id": response.conversation_id
+    }
+
+async def _turn_events(request: ChatRequest, owner_user_id: str, turn: Dict[str, Any], ai_service: AIService, conversations_db: Any, budget: LatencyBudget):
+    """
+    Events of a streamed AI turn as (event, data) pairs: `metadata`, reply `delta`s and
+    `done`, or `error` if generation fails. The conversation is persisted after `done`.
+    """
+    yield "metadata", {
+        "conversation_id": turn["conversation_id"],
+        "source": "ai_hybrid",
+        "metadata": _build_response_metadata(request, turn, turn["human_chat_available"]),
+        "personalized_recommendations": turn["personalized_recommendations"]
+    }
+
+    reply_parts = []
+    try:
+        if turn["draft_reply"]:
+            reply_parts.append(turn["draft_reply"])
+            yield "delta", {"text": turn["draft_reply"]}
+        else:
+            async for chunk in ai_service.stream_response_with_gemini(
+                query=request.query,
+                analysis=turn["analysis"],
+                relevant_data=turn["processed_data"],
+                context=request.context,
+                language=request.language,
+                budget=budget
+            ):
+                reply_parts.append(chunk)
+                yield "delta", {"text": chunk}
+    except Exception as e:
+        logger.error(f"Error streaming reply for conversation {turn['conversation_id']}: {str(e)}", exc_info=True)
+        yield "error", {"error": "generation_failed", "message": str(e)}
+        return
+
+    response_text = "".join(reply_parts).strip()
+    yield "done", {
+        "reply": response_text,
+        "confidence_score": turn["analysis"].get("confidence", 0.8),
+        "conversation_id": turn["conversation_id"]
+    }
+
+    # Persist after the client already has the full reply
+    await save_conversation_entry(
+        conversations_db,
+        _build_conversation_entry(request, owner_user_id, turn, response_text)
+    )
+
+async def _match_keywords(request: ChatRequest, owner_user_id: str) -> KeywordHits:
+    """Scan the query once with the tenant's compiled keyword matcher."""
+    knowledge_base = await get_knowledge_base()
+    with stage("keywords"):
+        return knowledge_base.keyword_matcher(owner_user_id).match(request.query)
+
+async def _handle_order_status_query(request: ChatRequest, owner_user_id: str, hits: KeywordHits) -> Optional[ChatResponse]:
+    """
+    Answer order status questions directly from the orders collection (via the
+    cached OrderStatusService), without going through NLU or generation.
+
+    Args:
+        request: Chat request
+        owner_user_id: Tenant the request belongs to
+        hits: Keyword hits of the query (see _match_keywords)
 
-            # Increment count for the new conversation
-            await user_collection.update_one(
-                {"id": owner_user_id},
-                {"$inc": {"conversation_count_current_month": 1}}
+    Returns:
+        A ChatResponse if the query is an order status query, otherwise None.
+    """
+    # (Keeping this as is - critical business functionality)
+    query_lower = request.query.lower()
+    is_order_query = hits.has("order")
+
+    # Simple extraction (can be improved with NLP/regex)
+    order_number_match = re.search(r'#?([a-zA-Z0-9\-]+)', query_lower) # Look for order number like patterns
+    email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', query_lower) # Basic email regex
+
+    extracted_order_number = order_number_match.group(1) if order_number_match else None
+    extracted_email = email_match.group(0) if email_match else None
+
+    logger.debug(f"Order Query Check: is_order_query={is_order_query}, order#={extracted_order_number}, email={extracted_email}")
+
+    if not is_order_query:
+        return None
+
+    conversation_id = _get_context_conversation_id(request) or str(uuid.uuid4())
+
+    if extracted_order_number and extracted_email:
+        logger.info(f"Handling order status query for order '{extracted_order_number}' and email '{extracted_email}' for owner {owner_user_id}")
+        # Look up by owner_user_id, customer_email, and platform_order_id/order_number
+        order_data = await get_order_status_service().find_order(owner_user_id, extracted_email, extracted_order_number)
+
+        if order_data:
+            platform_order_id = order_data.get("platform_order_id", "N/A")
+
+            # Populate order_details with the found order data
+            # The reply can be a simpler confirmation message now
+            return ChatResponse(
+                reply=f"Here's the status for order #{platform_order_id}:", # Simpler text reply
+                source="order_status_lookup",
+                confidence_score=1.0, # High confidence as it's a direct lookup
+                conversation_id=conversation_id,
+                followup_questions=[],
+                metadata={"order_status": order_status_summary(order_data)},
+                personalized_recommendations=[],
+                order_details=Order(**order_data) # Pass the structured order data
             )
-            logger.info(f"Incremented monthly conversation count for user {owner_user_id} (New count: {current_convo_count + 1})")
-        # --- End Limit Check ---
-
-        # Correct language code if needed
-        if request.language == "cze":
-            request.language = "cs"
-
-        # Assign new conversation ID if not present
-        if request.context.conversation_id is None:
-            request.context.conversation_id = str(uuid.uuid4())
-
-        request.context.user_id = owner_user_id
-        request.user_id = owner_user_id # Also add to request object if needed elsewhere
-
-        # --- New Hybrid AI Flow ---
-        # 1. Extract Entities using simplified AI Service method
-        analysis = await ai_service.extract_entities_with_gemini(
-            query=request.query,
-            context=request.context,
-            language=request.language
+
+        logger.warning(f"Order not found for owner {owner_user_id}, email {extracted_email}, order# {extracted_order_number}")
+        return ChatResponse(
+            reply="I couldn't find an order matching that email and order number. Please double-check the details.",
+            source="order_status_not_found",
+            confidence_score=1.0,
+            conversation_id=conversation_id,
+            followup_questions=["Would you like to try a different order number or email?"],
+            metadata={},
+            personalized_recommendations=[]
+        )
+
+    # Ask for missing details
+    missing = []
+    if not extracted_email: missing.append("your email address")
+    if not extracted_order_number: missing.append("your order number")
+    return ChatResponse(
+        reply=f"To check your order status, please provide {' and '.join(missing)}.",
+        source="order_status_clarification",
+        confidence_score=1.0,
+        conversation_id=conversation_id,
+        followup_questions=[],
+        metadata={},
+        personalized_recommendations=[]
+    )
+
+def _get_context_conversation_id(request: ChatRequest) -> Optional[str]:
+    """Read the conversation id from the request context whether it is a dict or a model."""
+    if isinstance(request.context, dict):
+        return request.context.get("conversation_id")
+    return getattr(request.context, "conversation_id", None)
+
+async def _prepare_chat_request(request: ChatRequest, current_user: Dict) -> bool:
+    """
+    Normalize the request context, enforce the monthly conversation limit and
+    bind the request to the owner (tenant) of the API key.
+
+    Returns:
+        True if the request starts a new conversation (its id is assigned here)
+    """
+    owner_user_id = current_user["id"]
+
+    # Ensure we have a valid conversation context before checking limits or accessing attributes
+    # Convert dict to the Pydantic model instance if necessary
+    if isinstance(request.context, dict):
+        request.context = EnhancedConversationContext(**request.context)
+    elif request.context is None:
+         request.context = EnhancedConversationContext()
+    # Now request.context is guaranteed to be an EnhancedConversationContext object
+
+    if not request.context.conversation_id:
+        with stage("usage_limit"):
+            await _enforce_conversation_limit(current_user)
+
+    # Correct language code if needed
+    if request.language == "cze":
+        request.language = "cs"
+
+    # Assign new conversation ID if not present
+    is_new_conversation = request.context.conversation_id is None
+    if is_new_conversation:
+        request.context.conversation_id = str(uuid.uuid4())
+
+    request.context.user_id = owner_user_id
+    request.user_id = owner_user_id # Also add to request object if needed elsewhere
+    return is_new_conversation
+
+async def _enforce_conversation_limit(current_user: Dict) -> None:
+    """
+    Count a new conversation against the owner's monthly limit (atomic, see ConversationQuota).
+
+    Raises:
+        HTTPException: 403 if the owner's plan limit has been reached
+    """
+    try:
+        await get_conversation_quota().consume(current_user)
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+
+async def _admit_turn(current_user: Dict) -> AdmissionTicket:
+    """
+    Wait for the owner's turn to use the LLM layer (weighted by subscription tier, see AdmissionScheduler).
+
+    Returns:
+        The AdmissionTicket to release once the turn's LLM work is done
+
+    Raises:
+        HTTPException: 503 with Retry-After if no slot is available in time
+    """
+    try:
+        with stage("admission"):
+            return await get_admission_scheduler().acquire(current_user["id"], resolve_tier(current_user))
+    except AdmissionRejectedError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
         )
-        intent = analysis.get("intent", "general_question")
-        entities = analysis.get("entities", {})
-        logger.debug(f"Initial Extracted Analysis: Intent={intent}, Entities={entities}")
-
-        # --- Intent Override Fallback ---
-        # If Gemini classified as general but query seems product-related, override intent.
-        # Added more keywords and check query_lower
-        product_keywords_cs = ["produkt", "zboží", "sortiment", "nabídk", "máte", "prodáváte"]
-        product_keywords_en = ["product", "goods", "assortment", "offer", "have", "sell", "inventory", "items"]
-        product_keywords = product_keywords_cs if request.language == "cs" else product_keywords_en
-        if intent == "general_question" and any(keyword in query_lower for keyword in product_keywords):
-            logger.warning(f"Overriding intent from 'general_question' to 'product_recommendation' based on keywords for query: '{request.query}'")
-            intent = "product_recommendation"
-            analysis["intent"] = intent # Update analysis dict as well
-
-        # Update conversation context with potentially overridden intent/entities
-        await request.context.update_context(
-            request.query,
-            intent=intent,
-            entities=entities
+
+async def _run_retrieval_pipeline(request: ChatRequest, owner_user_id: str, ai_service: AIService, budget: Optional[LatencyBudget] = None, classifier_threshold: float = PRECLASSIFIER_THRESHOLD, hits: Optional[KeywordHits] = None, is_new_conversation: bool = False, evaluate_classifier: bool = True) -> Dict[str, Any]:
+    """
+    Run NLU, KnowledgeBase retrieval and product scoring for a prepared request.
+
+    Args:
+        request: Prepared chat request (see _prepare_chat_request)
+        owner_user_id: Tenant the request belongs to
+        ai_service: AIService instance
+        budget: Optional latency budget shared with the generation step
+        classifier_threshold: Minimum local pre-classifier confidence for skipping the Gemini NLU call
+        hits: Keyword hits of the query from the tenant's matcher (matched here when omitted)
+        is_new_conversation: The turn starts a conversation (see _prepare_chat_request)
+        evaluate_classifier: Record the pre-classifier against Gemini and run shadow checks
+            (off for batch replays, which must not cost extra Gemini calls or skew the live report)
+
+    Returns:
+        Dictionary with analysis, intent, entities, relevant_products, processed_data,
+        score_map, draft_reply, personalized_recommendations, human_chat_available
+        and conversation_id
+    """
+    if hits is None:
+        hits = await _match_keywords(request, owner_user_id)
+    conversation_id = request.context.conversation_id or str(uuid.uuid4()) # Ensure ID exists
+
+    # 1. Extract Entities: local pre-classifier first, Gemini only when it isn't confident enough
+    # (in fused mode the Gemini call also drafts a reply, see AI_FUSED_MODE)
+    with stage("preclassifier"):
+        local_analysis = classify_query(request.query, request.language, hits)
+    evaluator = get_classifier_evaluator()
+    speculative = None
+    if local_analysis["confidence"] >= classifier_threshold:
+        logger.info(f"Pre-classifier routed query as '{local_analysis['intent']}' ({local_analysis['confidence']}), skipping Gemini NLU")
+        analysis = local_analysis
+        if evaluate_classifier:
+            evaluator.record_skip(owner_user_id)
+        if evaluate_classifier and should_shadow_check():
+            _spawn_background(_shadow_check_classifier(
+                ai_service, owner_user_id, local_analysis, request.query, request.context.model_copy(deep=True), request.language
+            ))
+    else:
+        # Start the product lookups the local guess already implies while Gemini works out the entities
+        if SPECULATIVE_RETRIEVAL:
+            knowledge_base = await get_knowledge_base()
+            speculative = SpeculativeRetrieval({
+                signature: lookup for signature, lookup in
+                _plan_product_lookups(knowledge_base, owner_user_id, local_analysis["intent"], local_analysis["entities"], request.query).values()
+            })
+        try:
+            if AI_FUSED_MODE:
+                analysis = await ai_service.analyze_and_draft_with_gemini(
+                    query=request.query,
+                    context=request.context,
+                    language=request.language,
+                    budget=budget
+                )
+            else:
+                analysis = await ai_service.extract_entities_with_gemini(
+                    query=request.query,
+                    context=request.context,
+                    language=request.language,
+                    budget=budget
+                )
+        except BaseException:
+            if speculative:
+                speculative.discard()
+            raise
+    intent = analysis.get("intent", "general_question")
+    entities = analysis.get("entities", {})
+    logger.debug(f"Initial Extracted Analysis: Intent={intent}, Entities={entities}")
+    if evaluate_classifier and analysis is not local_analysis and analysis.get("confidence", 0) > 0:
+        evaluator.record(owner_user_id, local_analysis["intent"], local_analysis["confidence"], intent)
+
+    # --- Intent Override Fallback ---
+    # If Gemini classified as general but query seems product-related, override intent.
+    # Only the request language's product keywords count (English for languages without keywords)
+    keyword_language = request.language if request.language in KEYWORD_LANGUAGES else "en"
+    if intent == "general_question" and hits.has("product_query", keyword_language):
+        logger.warning(f"Overriding intent from 'general_question' to 'product_recommendation' based on keywords for query: '{request.query}'")
+        intent = "product_recommendation"
+        analysis["intent"] = intent # Update analysis dict as well
+
+    # Update conversation context with potentially overridden intent/entities
+    await request.context.update_context(
+        request.query,
+        intent=intent,
+        entities=entities
+    )
+
+    # 2. Retrieve Relevant Data from KnowledgeBase (using owner_user_id), all lookups concurrently
+    with stage("retrieval"):
+        relevant_products, qa_items, human_chat_available = await _retrieve_relevant_data(
+            request, owner_user_id, intent, entities, conversation_id, retrieval_timeout(budget), speculative, is_new_conversation
         )
 
-        # 2. Retrieve Relevant Data from KnowledgeBase (using owner_user_id)
-        knowledge_base = await get_knowledge_base()
-        relevant_products = []
-        qa_items = []
-
-        # Prioritize fetching based on specific entities first
-        if entities.get("products"):
-            for name in entities["products"]:
-                found = await knowledge_base.find_products_by_name(name, user_id=owner_user_id, limit=3) # Limit slightly higher for direct name match
-                relevant_products.extend(found)
-        elif entities.get("categories"):
-            # Use the first category for simplicity, could be expanded
-            found = await knowledge_base.find_products_by_category(entities["categories"][0], user_id=owner_user_id, limit=5)
-            relevant_products.extend(found)
-        # Add logic to search by features/price if needed
-        elif entities.get("features") or entities.get("price_range"):
-             search_query = {}
-             if entities.get("features"):
-                 search_query["features"] = {"$all": entities["features"]}
-             if entities.get("price_range"):
-                 price_filter = {}
-                 if entities["price_range"].get("min") is not None: price_filter["$gte"] = entities["price_range"]["min"]
-                 if entities["price_range"].get("max") is not None: price_filter["$lte"] = entities["price_range"]["max"]
-                 if price_filter: search_query["price"] = price_filter
-             if search_query:
-                 found = await knowledge_base.find_products_by_query(search_query, user_id=owner_user_id, limit=5)
-                 relevant_products.extend(found)
-
-        # --- Fetch General Recommendations if Intent is Recommendation AND no specific products were found via entities ---
-        if intent == "product_recommendation" and not relevant_products:
-             logger.info(f"Intent is product_recommendation but no specific entities led to products. Fetching general recommendations for user {owner_user_id}.")
-             recommended_fallback = await knowledge_base.get_recommended_products(user_id=owner_user_id, limit=3) # Fetch top 3 general
-             relevant_products.extend(recommended_fallback)
-
-        # Fetch QA items for service intents (can run in parallel with product fetching if complex)
-        if intent in ["customer_service", "shipping_payment", "store_navigation"]:
-             # Use keywords related to intent or extracted entities to find QA
-             search_term = request.query.split()[0] # Simple keyword extraction
-             qa_items = await knowledge_base.find_qa_items_by_keyword(search_term, user_id=owner_user_id, limit=3) # Assuming QA might be tenant specific? If not, remove user_id
-
-        # Remove duplicates just in case
-        relevant_products = list({p['_id']: p for p in relevant_products}.values())
-        logger.debug(f"Retrieved {len(relevant_products)} relevant products and {len(qa_items)} QA items.")
-
-        # 3. Apply Business Logic / Process Data (Keep relevant parts)
-        processed_data = []
-        score_map = {} # Store both score and components
-        if intent == "product_recommendation" and relevant_products:
-            # Use the existing scoring logic
-            scored_products = await ai_service._score_products_for_recommendation(relevant_products, entities, request.context)
-            scored_products.sort(key=lambda x: x["score"], reverse=True)
-            top_products = scored_products[:3]
-            processed_data = [ai_service._format_product_data(p["product"]) for p in top_products] # Format for Gemini prompt
-            # Store score and components for later use
-            for p_data in top_products:
-                 p_id = str(p_data["product"]["_id"])
-                 score_map[p_id] = {"score": p_data["score"], "components": p_data["score_components"]} # Store both
-        elif relevant_products:
-             # Format top products for context, even if not recommendation
-             processed_data = [ai_service._format_product_data(p) for p in relevant_products[:3]]
-        elif qa_items:
-             # Format QA items for context
-             processed_data = [{"question": q.get("question"), "answer": q.get("answer")} for q in qa_items]
-
-        # 4. Generate Response using simplified AI Service method
-        response_text = await ai_service.generate_response_with_gemini(
-            query=request.query,
-            analysis=analysis,
-            relevant_data=processed_data, # Pass the processed, tenant-specific data
-            context=request.context,
-            language=request.language
+    # Remove duplicates just in case
+    relevant_products = list({p['_id']: p for p in relevant_products}.values())
+    logger.debug(f"Retrieved {len(relevant_products)} relevant products and {len(qa_items)} QA items.")
+
+    # 3. Apply Business Logic / Process Data (Keep relevant parts)
+    processed_data = []
+    score_map = {} # Store both score and components
+    if intent == "product_recommendation" and relevant_products:
+        # Use the existing scoring logic
+        with stage("scoring"):
+            scored_products = await ai_service._score_products_for_recommendation(relevant_products, entities, request.context, query=request.query, user_id=owner_user_id)
+        scored_products.sort(key=lambda x: x["score"], reverse=True)
+        top_products = scored_products[:3]
+        processed_data = [ai_service._format_product_data(p["product"]) for p in top_products] # Format for Gemini prompt
+        # Store score and components for later use
+        for p_data in top_products:
+             p_id = str(p_data["product"]["_id"])
+             score_map[p_id] = {"score": p_data["score"], "components": p_data["score_components"]} # Store both
+    elif relevant_products:
+         # Format top products for context, even if not recommendation
+         processed_data = [ai_service._format_product_data(p) for p in relevant_products[:3]]
+    elif qa_items:
+         # Format QA items for context
+         processed_data = [{"question": q.get("question"), "answer": q.get("answer")} for q in qa_items]
+
+    # Fused mode: serve the draft when retrieval found nothing the answer has to mention
+    draft_reply = None
+    if analysis.get("draft_reply") and intent in DRAFT_REPLY_INTENTS and not processed_data:
+        draft_reply = analysis["draft_reply"]
+        logger.info(f"Using fused draft reply for intent '{intent}', skipping response generation call.")
+
+    return {
+        "analysis": analysis,
+        "intent": intent,
+        "entities": entities,
+        "relevant_products": relevant_products,
+        "processed_data": processed_data,
+        "score_map": score_map,
+        "draft_reply": draft_reply,
+        "personalized_recommendations": _build_personalized_recommendations(
+            intent, relevant_products, processed_data, score_map, request.context
+        ),
+        "human_chat_available": human_chat_available,
+        "conversation_id": conversation_id
+    }
+
+def _plan_product_lookups(knowledge_base: KnowledgeBase, owner_user_id: str, intent: str, entities: Dict[str, Any], query: str) -> Dict[str, Tuple[Tuple, Any]]:
+    """
+    Product lookups a turn needs, as branch name -> (lookup signature, coroutine factory).
+
+    The signature identifies the lookup independently of how the entities were produced,
+    so speculative lookups started from the pre-classifier can be matched after NLU.
+    """
+    lookups = {}
+
+    # Prioritize fetching based on specific entities first
+    if entities.get("products"):
+        names = list(entities["products"])
+        lookups["products"] = (
+            ("products", tuple(name.lower() for name in names)),
+            lambda: knowledge_base.find_products_by_names(names, user_id=owner_user_id, limit=3) # Limit slightly higher for direct name match
         )
-        # Note: Follow-up questions might be included in response_text by Gemini now, or omitted.
-
-        # 5. Structure Final Response
-        conv_id = request.context.conversation_id or str(uuid.uuid4()) # Ensure ID exists
-        conversation_entry = ConversationEntry(
-            conversation_id=conv_id,
-            timestamp=datetime.now(timezone.utc),
-            query=request.query,
-            response=response_text, # Use the text generated by Gemini
-            source="ai_hybrid", # Indicate the new source
-            language=request.language,
-            user_id=owner_user_id,
-            confidence_score=analysis.get("confidence", 0.8), # Use confidence from entity extraction
-            metadata={ # Store analysis results and client context
-                "intent": intent,
-                "entities": entities,
-                "client_metadata": request.context.model_dump()
-                # Removed old complex metadata structure
-            }
+    elif entities.get("categories"):
+        # Use the first category for simplicity, could be expanded
+        category = entities["categories"][0]
+        lookups["category"] = (
+            ("category", category.lower()),
+            lambda: knowledge_base.find_products_by_category(category, user_id=owner_user_id, limit=5)
+        )
+    # Add logic to search by features/price if needed
+    elif entities.get("features") or entities.get("price_range"):
+         search_query = {}
+         if entities.get("features"):
+             search_query["features"] = {"$all": entities["features"]}
+         if entities.get("price_range"):
+             price_filter = {}
+             if entities["price_range"].get("min") is not None: price_filter["$gte"] = entities["price_range"]["min"]
+             if entities["price_range"].get("max") is not None: price_filter["$lte"] = entities["price_range"]["max"]
+             if price_filter: search_query["price"] = price_filter
+         if search_query:
+             lookups["query"] = (
+                 ("query", json.dumps(search_query, sort_keys=True, default=str)),
+                 lambda: knowledge_base.find_products_by_query(search_query, user_id=owner_user_id, limit=5)
+             )
+
+    # Products described rather than named ("something warm for a winter hike") are found by meaning
+    if intent == "product_recommendation" and not entities.get("products"):
+        lookups["semantic"] = (
+            ("semantic", query.lower()),
+            lambda: knowledge_base.find_products_semantic(query, user_id=owner_user_id, limit=3)
         )
 
-        # Save conversation in background
-        background_tasks.add_task(save_conversation_entry, conversations_db, conversation_entry)
-
-        # Check human chat availability
-        human_chat_available = await is_human_chat_available(conv_id, owner_user_id)
-
-        # Generate personalized recommendations whenever relevant products were found and processed,
-        # especially if the intent was recommendation or if specific products were mentioned/found.
-        personalized_recommendations = []
-        # Check if processed_data contains product info (check for 'product_id' or similar key)
-        # and if the intent suggests products OR if specific products were found initially.
-        if relevant_products and processed_data and isinstance(processed_data[0], dict) and "id" in processed_data[0]:
-             logger.info(f"Generating personalized recommendations for intent '{intent}' as relevant products were found.")
-             # Use score_map if intent was recommendation, otherwise use default scores/explanations
-             for product in relevant_products: # Iterate through originally found products
-                 p_id = str(product["_id"])
-                 # Find corresponding formatted data in processed_data (used for Gemini prompt)
-                 formatted_product_data = next((item for item in processed_data if item.get("id") == p_id), None)
-                 if not formatted_product_data: continue # Skip if not in top processed
-
-                 score_components = {}
-                 match_score = 0.7 # Default score
-                 explanation = _generate_simple_explanation(product, request.context) # Default explanation
-
-                 if p_id in score_map: # If scoring was done (recommendation intent)
-                     score_data = score_map[p_id]
-                     score_components = score_data["components"]
-                     match_score = score_data["score"]
-                     explanation = _generate_recommendation_explanation(product, score_components, request.context)
-
-                 personalized_recommendations.append({
-                     "product_id": p_id,
-                         "name": product.get("product_name", ""),
-                         "explanation": explanation,
-                         "match_score": match_score, # Use the correct score
-                         "image_url": product.get("image_url", "/static/images/default.jpg"),
-                         "url": product.get("url", "#"),
-                         "price": _format_price(product.get("pricing", {})), # Use existing helper
-                         "category": product.get("category", ""),
-                         "features": product.get("features", [])[:5],
-                         "score_components": score_components
-                     })
-             # Sort recommendations by score before returning
-             personalized_recommendations.sort(key=lambda x: x["match_score"], reverse=True)
-             # No need to limit here again, as top_products was already limited
-             # personalized_recommendations = personalized_recommendations[:3]
-
-        # Prepare and return final response
-        return ChatResponse(
-            reply=response_text,
-            source="ai_hybrid",
-            confidence_score=analysis.get("confidence", 0.8),
-            conversation_id=conv_id,
-            followup_questions=[], # Follow-ups are now part of the main reply or omitted
-            metadata={ # Simplified metadata
-                "intent": intent,
-                "entities": entities,
-                "human_chat_available": human_chat_available,
-                "client_context": serialize_mongo_doc(request.context.model_dump())
-            },
-            personalized_recommendations=personalized_recommendations # Use the generated list
+    # General recommendations, used if intent is recommendation AND no specific products were found via entities
+    if intent == "product_recommendation":
+        lookups["recommended"] = (
+            ("recommended",),
+            lambda: knowledge_base.get_recommended_products(user_id=owner_user_id, limit=3) # Fetch top 3 general
         )
 
-    except HTTPException as http_exception:
-        raise http_exception
+    return lookups
+
+async def _retrieve_relevant_data(request: ChatRequest, owner_user_id: str, intent: str, entities: Dict[str, Any], conversation_id: str, timeout: float, speculative: Optional[SpeculativeRetrieval] = None, is_new_conversation: bool = False) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], bool]:
+    """
+    Run the KnowledgeBase lookups for a turn concurrently under one deadline.
+
+    All named products are resolved together in one fuzzy name match, and recommendation
+    requests that name no product are also matched by embedding similarity; the general
+    recommendation fallback is started alongside and only used when the other branches
+    found nothing.
+    Lookups already started speculatively are reused, the other speculative ones are
+    cancelled. Branches that miss the deadline are dropped, the rest of the results are kept.
+
+    Returns:
+        Tuple of (relevant_products, qa_items, human_chat_available)
+    """
+    knowledge_base = await get_knowledge_base()
+    branches = {}
+    for name, (signature, lookup) in _plan_product_lookups(knowledge_base, owner_user_id, intent, entities, request.query).items():
+        branches[name] = (speculative.take(signature) if speculative else None) or lookup()
+    if speculative:
+        speculative.discard()
+
+    # Fetch QA items for service intents
+    if intent in ["customer_service", "shipping_payment", "store_navigation"]:
+         # Use keywords related to intent or extracted entities to find QA
+         search_term = request.query.split()[0] # Simple keyword extraction
+         branches["qa"] = knowledge_base.find_qa_items_by_keyword(search_term, user_id=owner_user_id, limit=3) # Assuming QA might be tenant specific? If not, remove user_id
+
+    # A brand new conversation can't have human chat sessions yet
+    if not is_new_conversation:
+        branches["human_chat"] = is_human_chat_available(conversation_id, owner_user_id)
+
+    results = await gather_within(branches, timeout, label=f"Retrieval for user {owner_user_id}")
+
+    relevant_products = []
+    relevant_products.extend(results.get("products", []))
+    relevant_products.extend(results.get("category", []))
+    relevant_products.extend(results.get("query", []))
+    relevant_products.extend(results.get("semantic", []))
+    if not relevant_products and results.get("recommended"):
+        logger.info(f"Intent is product_recommendation but no specific entities led to products. Using general recommendations for user {owner_user_id}.")
+        relevant_products.extend(results["recommended"])
+
+    # Without an answer in time (or for a new conversation) offer human chat, its usual availability
+    return relevant_products, results.get("qa", []), results.get("human_chat", True)
+
+# References to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_jobs = set()
+
+def _spawn_background(coro) -> None:
+    """Run a coroutine in the background without blocking the chat turn."""
+    task = asyncio.create_task(coro)
+    _background_jobs.add(task)
+    task.add_done_callback(_background_jobs.discard)
+
+async def _shadow_check_classifier(ai_service: AIService, owner_user_id: str, local_analysis: Dict[str, Any], query: str, context: EnhancedConversationContext, language: str) -> None:
+    """Compare a confident local prediction with Gemini so precision stays measurable above the threshold."""
+    try:
+        analysis = await ai_service.extract_entities_with_gemini(query=query, context=context, language=language)
+        if analysis.get("confidence", 0) > 0:
+            get_classifier_evaluator().record(owner_user_id, local_analysis["intent"], local_analysis["confidence"], analysis.get("intent", "general_question"))
     except Exception as e:
-        logger.error(f"Error handling message: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "error": "internal_server_error",
-                "message": str(e)
-            }
-        )
+        logger.warning(f"Pre-classifier shadow check failed: {str(e)}")
+
+def _build_personalized_recommendations(intent: str, relevant_products: List[Dict[str, Any]], processed_data: List[Dict[str, Any]], score_map: Dict[str, Dict[str, Any]], context: EnhancedConversationContext) -> List[Dict[str, Any]]:
+    """Build the product cards shown by the widget next to the reply."""
+    # Generate personalized recommendations whenever relevant products were found and processed,
+    # especially if the intent was recommendation or if specific products were mentioned/found.
+    personalized_recommendations = []
+    # Check if processed_data contains product info (check for 'product_id' or similar key)
+    # and if the intent suggests products OR if specific products were found initially.
+    if relevant_products and processed_data and isinstance(processed_data[0], dict) and "id" in processed_data[0]:
+         logger.info(f"Generating personalized recommendations for intent '{intent}' as relevant products were found.")
+         # Use score_map if intent was recommendation, otherwise use default scores/explanations
+         for product in relevant_products: # Iterate through originally found products
+             p_id = str(product["_id"])
+             # Find corresponding formatted data in processed_data (used for Gemini prompt)
+             formatted_product_data = next((item for item in processed_data if item.get("id") == p_id), None)
+             if not formatted_product_data:
+                 continue # Skip if not in top processed
+
+             score_components = {}
+             match_score = 0.7 # Default score
+             explanation = _generate_simple_explanation(product, context) # Default explanation
+
+             if p_id in score_map: # If scoring was done (recommendation intent)
+                 score_data = score_map[p_id]
+                 score_components = score_data["components"]
+                 match_score = score_data["score"]
+                 explanation = _generate_recommendation_explanation(product, score_components, context)
+
+             personalized_recommendations.append({
+                 "product_id": p_id,
+                 "name": product.get("product_name", ""),
+                 "explanation": explanation,
+                 "match_score": match_score, # Use the correct score
+                 "image_url": product.get("image_url", "/static/images/default.jpg"),
+                 "url": product.get("url", "#"),
+                 "price": _format_price(product.get("pricing", {})), # Use existing helper
+                 "category": product.get("category", ""),
+                 "features": product.get("features", [])[:5],
+                 "score_components": score_components
+             })
+         # Sort recommendations by score before returning
+         personalized_recommendations.sort(key=lambda x: x["match_score"], reverse=True)
+
+    return personalized_recommendations
+
+def _build_response_metadata(request: ChatRequest, turn: Dict[str, Any], human_chat_available: bool) -> Dict[str, Any]:
+    """Build the simplified metadata returned to the widget."""
+    return {
+        "intent": turn["intent"],
+        "entities": turn["entities"],
+        "human_chat_available": human_chat_available,
+        "client_context": serialize_mongo_doc(request.context.model_dump())
+    }
+
+def _build_conversation_entry(request: ChatRequest, owner_user_id: str, turn: Dict[str, Any], response_text: str) -> ConversationEntry:
+    """Build the ConversationEntry persisted for a completed chat turn."""
+    return ConversationEntry(
+        conversation_id=turn["conversation_id"],
+        timestamp=datetime.now(timezone.utc),
+        query=request.query,
+        response=response_text, # Use the text generated by Gemini
+        source="ai_hybrid", # Indicate the new source
+        language=request.language,
+        user_id=owner_user_id,
+        confidence_score=turn["analysis"].get("confidence", 0.8), # Use confidence from entity extraction
+        metadata={ # Store analysis results and client context
+            "intent": turn["intent"],
+            "entities": turn["entities"],
+            "client_metadata": request.context.model_dump()
+        }
+    )
+
 
 async def is_human_chat_available(conversation_id: str, user_id: str) -> bool:
     """
@@ -1009,7 +1282,8 @@ async def save_conversation_entry(db: Any, entry: ConversationEntry) -> bool:
             return False
             
         entry_dict = entry.model_dump()
-        await db.insert_one(entry_dict)
+        with stage("persistence"):
+            await db.insert_one(entry_dict)
         logger.debug(f"Saved conversation entry for conversation {entry.conversation_id}, user {entry.user_id}")
         return True
     except Exception as e:
@@ -1,11 +1,14 @@
 from fastapi import APIRouter, Request, HTTPException, status, Depends
 from fastapi.responses import JSONResponse
 from datetime import datetime, timezone # Added timezone
+import json
 from typing import List, Optional, Dict, Any # Added Dict, Any
 # Removed UUID import as user_id is likely a string
 from ..utils.mongo import get_orders_collection, serialize_mongo_doc # Use specific collection getter and serializer
 from ..models.models import Order, OrderCreate, OrderUpdate, OrderItem # Import Order models
-from ..utils.dependencies import get_current_active_user # Import authentication dependency
+from ..utils.dependencies import get_current_active_user, verify_widget_origin # Import authentication dependencies
+from ..services.order_status import get_order_status_service, order_status_summary
+from pydantic import BaseModel, Field
 from pymongo.collection import Collection
 from app.utils.logging_config import get_module_logger
 
@@ -84,6 +87,12 @@ async def shoptet_webhook(
             upsert=True,
         )
         logger.info(f"Upserted order {platform_order_id} for user {user_id} from Shoptet webhook.")
+        get_order_status_service().invalidate(
+            order_to_save["user_id"],
+            platform_order_id=order_to_save["platform_order_id"],
+            email=order_to_save.get("customer_email"),
+            order_number=order_to_save.get("order_number")
+        )
         return {"message": "Order webhook processed successfully"}
 
     except json.JSONDecodeError:
@@ -95,6 +104,22 @@ async def shoptet_webhook(
         return {"message": "Accepted but internal server error occurred"}
 
 
+class OrderStatusRequest(BaseModel):
+    order_number: str = Field(..., min_length=1, max_length=100)
+    email: str = Field(..., min_length=3, max_length=254)
+
+@router.post("/status", summary="Order Status Lookup (Widget)")
+async def get_order_status(
+    status_request: OrderStatusRequest,
+    current_user: Dict[str, Any] = Depends(verify_widget_origin) # Website owner of the API key
+):
+    """Returns the status of a shopper's order by order number and email, without going through the chat pipeline."""
+    order = await get_order_status_service().find_order(current_user["id"], status_request.email.strip(), status_request.order_number.strip().lstrip("#"))
+    if not order:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
+    return order_status_summary(order)
+
+
 @router.get("/", response_model=List[Order], summary="List User Orders")
 async def list_orders(
     current_user: Dict[str, Any] = Depends(get_current_active_user), # Use auth dependency
@@ -372,6 +372,8 @@ async def create_product(
              logger.error(f"Failed to fetch product immediately after insertion for user {user_id}")
              raise HTTPException(status_code=500, detail="Failed to create product")
 
+        mongo.notify_product_changed(user_id, str(created_product["_id"]))
+
         return Product(**mongo.serialize_mongo_doc(created_product))
     except ValidationError as ve:
         logger.error(f"Validation error creating product: {ve}")
@@ -646,6 +648,8 @@ async def update_product(
              logger.error(f"Update seemed successful but could not refetch product {product_id} for user {user_id}.")
              raise HTTPException(status_code=404, detail="Failed to retrieve updated product")
 
+        mongo.notify_product_changed(user_id, str(updated_product["_id"]))
+
         # Return updated product
         return Product(**mongo.serialize_mongo_doc(updated_product))
     except ValidationError as ve:
@@ -745,6 +749,8 @@ async def update_product_json(
              logger.error(f"Update JSON seemed successful but could not refetch product {product_id} for user {user_id}.")
              raise HTTPException(status_code=404, detail="Failed to retrieve updated product")
 
+        mongo.notify_product_changed(user_id, str(updated_product["_id"]))
+
         # Return updated product
         return Product(**mongo.serialize_mongo_doc(updated_product))
 
@@ -773,12 +779,15 @@ async def delete_product(
         else:
             delete_filter["id"] = product_id # Assuming 'id' is the custom string field
 
-        result = await collection.delete_one(delete_filter)
+        # find_one_and_delete returns the document so listeners get its _id even when deleting by custom id
+        deleted_product = await collection.find_one_and_delete(delete_filter, projection={"_id": 1})
 
-        if result.deleted_count == 0:
+        if deleted_product is None:
             logger.warning(f"Delete failed: Product {product_id} not found for user {user_id}")
             raise HTTPException(status_code=404, detail="Product not found or access denied")
 
+        mongo.notify_product_changed(user_id, str(deleted_product["_id"]))
+
         logger.info(f"Deleted product {product_id} for user {user_id}")
         # No content to return on successful delete (status 204)
 
@@ -855,6 +864,8 @@ async def upload_product_image(
              logger.error(f"Image URL update seemed successful but could not refetch product {product_id} for user {user_id}.")
              raise HTTPException(status_code=404, detail="Failed to retrieve updated product after image upload")
 
+        mongo.notify_product_changed(user_id, str(updated_product["_id"]))
+
         # Return updated product
         return Product(**mongo.serialize_mongo_doc(updated_product))
     except Exception as e:
@@ -2,7 +2,7 @@
 from fastapi import APIRouter, HTTPException, Depends, status
 from typing import List, Optional
 from motor.motor_asyncio import AsyncIOMotorClient
-from app.utils.mongo import get_db, get_shop_info_collection, get_shop_info, update_shop_info
+from app.utils.mongo import get_db, get_shop_info_collection, get_shop_info, update_shop_info, notify_shop_info_changed
 from app.models.shop_info import ShopInfo, ShopInfoUpdate
 # from app.utils.error import handle_error # Removed import
 from app.utils.jwt import verify_token
@@ -133,6 +133,7 @@ async def reset_shop_information(
         # Delete existing shop info for the specified language and user
         collection = await get_shop_info_collection()
         await collection.delete_one({"language": language, "user_id": user_id})
+        notify_shop_info_changed(user_id, language)
         
         # Get default shop info (will be created since we just deleted it)
         new_default_info = await get_shop_info(language, user_id)
@@ -1,6 +1,8 @@
+import json
 from fastapi import APIRouter, Depends, HTTPException, status, Query, Body
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from motor.motor_asyncio import AsyncIOMotorClient
 # from beanie import PydanticObjectId # Beanie might not be used directly for updates here
 
@@ -8,6 +10,14 @@ from app.utils.mongo import get_db, get_user_collection
 from app.models.user import User, UserProfile, SubscriptionStatus, SubscriptionTier # Keep User import for type hints if needed elsewhere, but dependency returns dict
 from app.utils.jwt import verify_token
 from app.utils.logging_config import get_module_logger
+from app.services.circuit_breaker import get_circuit_breaker_states, reset_circuit_breaker
+from app.services.llm_client import get_llm_client
+from app.api.chat import get_ai_service, get_knowledge_base, run_chat_batch, ChatBatchItem, CHAT_BATCH_CONCURRENCY, CHAT_BATCH_MAX_CONCURRENCY
+from app.utils.stage_timing import get_stage_metrics
+from app.services.retrieval import SpeculativeRetrieval
+from app.services.idempotency import get_idempotency_store
+from app.services.admission import get_admission_scheduler
+from app.services.kb_sync import get_knowledge_base_sync
 from fastapi.security import OAuth2PasswordBearer
 
 router = APIRouter(
@@ -270,3 +280,109 @@ async def update_user_role(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to update user role")
 
 # TODO: Consider adding endpoint to change subscription_tier if needed by super admin
+
+@router.get("/llm/circuit-breakers")
+async def get_llm_circuit_breakers(
+    current_user_data: dict = Depends(get_current_super_admin_user)
+):
+    """
+    (Super Admin) Returns the circuit breaker state of every Gemini model plus client in-flight stats.
+    """
+    return {
+        "circuit_breakers": get_circuit_breaker_states(),
+        "client": get_llm_client().get_stats()
+    }
+
+@router.post("/llm/circuit-breakers/{model_name}/reset", status_code=status.HTTP_204_NO_CONTENT)
+async def reset_llm_circuit_breaker(
+    model_name: str,
+    current_user_data: dict = Depends(get_current_super_admin_user)
+):
+    """
+    (Super Admin) Forces a model's circuit breaker back to closed.
+    """
+    if not reset_circuit_breaker(model_name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Circuit breaker not found")
+    logger.info(f"Super admin {current_user_data.get('id')} reset circuit breaker for {model_name}")
+    return
+
+@router.get("/llm/caches")
+async def get_llm_cache_stats(
+    current_user_data: dict = Depends(get_current_super_admin_user),
+    ai_service = Depends(get_ai_service)
+):
+    """
+    (Super Admin) Returns hit/miss statistics of the AI service caches and the idempotency key store.
+    """
+    return {**ai_service.get_cache_stats(), "idempotency": get_idempotency_store().stats()}
+
+@router.get("/metrics/latency")
+async def get_latency_metrics(
+    tenant_id: Optional[str] = Query(None, description="Only this tenant's stage histograms"),
+    current_user_data: dict = Depends(get_current_super_admin_user)
+):
+    """
+    (Super Admin) Returns per-stage and per-tenant request latency histograms, the most recent
+    slow requests and how often speculative retrieval was used.
+    """
+    metrics = get_stage_metrics().snapshot(tenant_id)
+    metrics["speculative_retrieval"] = dict(SpeculativeRetrieval.stats)
+    return metrics
+
+@router.get("/metrics/admission")
+async def get_admission_metrics(
+    tenant_id: Optional[str] = Query(None, description="Only this tenant's queue"),
+    current_user_data: dict = Depends(get_current_super_admin_user)
+):
+    """
+    (Super Admin) Returns LLM admission slots in use plus queue depth, wait time histogram,
+    admitted and rejected turns per tenant.
+    """
+    return get_admission_scheduler().stats(tenant_id)
+
+@router.get("/knowledge-base/sync")
+async def get_knowledge_base_sync_status(
+    current_user_data: dict = Depends(get_current_super_admin_user)
+):
+    """
+    (Super Admin) Returns how the product cache follows the products collection (change stream
+    or polling), applied changes and each tenant's cache version.
+    """
+    sync = get_knowledge_base_sync()
+    if sync is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Knowledge base sync is not running")
+    return sync.stats()
+
+@router.get("/knowledge-base/semantic")
+async def get_semantic_index_status(
+    current_user_data: dict = Depends(get_current_super_admin_user)
+):
+    """
+    (Super Admin) Returns the product embedding index: embedded products per tenant, queued
+    writes, encoder failures and the embedding cache hit rate.
+    """
+    knowledge_base = await get_knowledge_base()
+    return knowledge_base.semantic_index.stats()
+
+class ChatBatchRequest(BaseModel):
+    items: List[ChatBatchItem] = Field(..., min_length=1, max_length=5000)
+    concurrency: int = Field(CHAT_BATCH_CONCURRENCY, ge=1, le=CHAT_BATCH_MAX_CONCURRENCY)
+    use_response_cache: bool = False
+
+@router.post("/chat/batch")
+async def run_chat_batch_replay(
+    batch: ChatBatchRequest,
+    current_user_data: dict = Depends(get_current_super_admin_user)
+):
+    """
+    (Super Admin) Answers many (tenant, query, context) items for offline evaluation and streams
+    one NDJSON line per item as it finishes, with the reply, intent, products and stage timings.
+    Items are not counted against conversation limits and are not persisted.
+    """
+    logger.info(f"Super admin {current_user_data.get('id')} started a chat batch of {len(batch.items)} items")
+
+    async def ndjson_lines():
+        async for result in run_chat_batch(batch.items, batch.concurrency, batch.use_response_cache):
+            yield json.dumps(result, default=str, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
@@ -21,6 +21,9 @@ from app.api import shop_info
 from app.api.orders import router as orders_router
 
 from app.api.chat import router as chat_router, get_knowledge_base, get_ai_service
+from app.services.kb_sync import start_knowledge_base_sync, stop_knowledge_base_sync
+from app.services.product_embeddings import shutdown_encoder_pool
+from app.services.embeddings import load_embedding_model
 from app.api.admin import router as admin_router
 from app.api.auth import router as auth_router
 from app.api.subscriptions import router as subscription_router
@@ -55,7 +58,7 @@ from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
 # Use mongo.py version of get_user_collection, not dependencies.py version
 from app.utils.mongo import get_user_collection
-from app.middleware import LoggingMiddleware, ErrorLoggingMiddleware
+from app.middleware import LoggingMiddleware, ErrorLoggingMiddleware, ServerTimingMiddleware
 import traceback
 from bson import json_util
 import json
@@ -82,8 +85,8 @@ app.add_middleware(
     allow_origins=["*"], # Allow all origins for CORS preflight, security handled by verify_widget_origin
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
-    allow_headers=["Content-Type", "Authorization", "Accept", "Origin", "X-Requested-With", "X-API-Key"],
-    expose_headers=["Content-Length"],
+    allow_headers=["Content-Type", "Authorization", "Accept", "Origin", "X-Requested-With", "X-API-Key", "Idempotency-Key"],
+    expose_headers=["Content-Length", "Server-Timing", "Retry-After"],
     max_age=600,
 )
 
@@ -95,6 +98,7 @@ app.middleware("http")(rate_limit_middleware)
 # Add middleware
 app.add_middleware(LoggingMiddleware)
 app.add_middleware(ErrorLoggingMiddleware)
+app.add_middleware(ServerTimingMiddleware)
 
 @app.get("/health")
 async def health_check():
@@ -173,10 +177,14 @@ async def startup_event():
         # Initialize KnowledgeBase
         knowledge_base = await get_knowledge_base()
         logger.info("KnowledgeBase initialized")
+        # Keep its product cache and indexes in step with product writes
+        start_knowledge_base_sync(knowledge_base)
         
         # Initialize AIService
         ai_service = await get_ai_service()
         logger.info("AIService initialized")
+        # Load the embedding model now (off the event loop) rather than on the first cache or semantic lookup
+        app.embedding_model_warmup = asyncio.create_task(load_embedding_model())
 
         # Initialize admin user on startup
         logger.info("Initializing admin user...")
@@ -220,6 +228,8 @@ async def startup_event():
 async def shutdown_event():
     """Close MongoDB connections on application shutdown."""
     logger.info("Shutting down application...")
+    await stop_knowledge_base_sync()
+    shutdown_encoder_pool()
     if hasattr(app, "mongodb_client"):
         app.mongodb_client.close()
         logger.info("MongoDB connection closed")
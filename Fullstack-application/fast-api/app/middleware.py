@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 from typing import Dict, List
 from app.utils.jwt import verify_token
 from app.utils.logging_config import get_module_logger
+from app.utils.stage_timing import start_request_timer
 import time
 import traceback
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -78,6 +79,25 @@ class ErrorLoggingMiddleware(BaseHTTPMiddleware):
                 content={"detail": "An internal server error occurred"}
             )
 
+class ServerTimingMiddleware(BaseHTTPMiddleware):
+    """
+    Middleware that times request stages (see app/utils/stage_timing.py) and returns
+    them in a Server-Timing header.
+    """
+    async def dispatch(self, request: Request, call_next):
+        timer = start_request_timer(f"{request.method} {request.url.path}")
+        try:
+            response = await call_next(request)
+        except Exception:
+            timer.finish()
+            raise
+        if timer.spans:
+            response.headers["Server-Timing"] = timer.server_timing_header()
+        # Streaming responses finish their timer when the stream ends
+        if not timer.deferred:
+            timer.finish()
+        return response
+
 async def rate_limit_middleware(request: Request, call_next):
     """
     Rate limiting middleware to limit requests per client IP.
@@ -0,0 +1,271 @@
+"""
+Per-tenant fair admission in front of the LLM layer.
+
+Every chat turn that will call Gemini takes an admission slot first. At most
+ADMISSION_MAX_CONCURRENT turns hold a slot at a time; the rest wait in per-tenant queues
+that are served by start-time fair queueing: each waiting turn gets a virtual finish tag
+of max(virtual time, the tenant's last tag) + 1 / weight, and a freed slot goes to the
+lowest tag. A tenant with weight 4 therefore gets four turns through for every turn of a
+weight 1 tenant while both are backlogged, and a single tenant flooding the service only
+lengthens its own queue. Weights come from the tenant's SubscriptionTier.
+
+Turns are rejected up front (AdmissionRejectedError, a 503 with Retry-After in chat.py)
+instead of timing out later when:
+- the tenant already has ADMISSION_MAX_QUEUE_PER_TENANT turns waiting,
+- the estimated wait (turns ahead in tag order / slots * average turn time) is above
+  ADMISSION_MAX_WAIT,
+- or a queued turn is still waiting when its ADMISSION_MAX_WAIT deadline passes.
+
+The GeminiClient in-flight limits (llm_client.py) still apply underneath.
+"""
+
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+from app.models.user import SubscriptionTier
+from app.utils.logging_config import get_module_logger
+from app.utils.stage_timing import LatencyHistogram
+
+logger = get_module_logger(__name__)
+
+# Chat turns doing LLM work at the same time (a turn makes one or two sequential Gemini calls)
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "32"))
+# Turns one tenant may have waiting for a slot
+ADMISSION_MAX_QUEUE_PER_TENANT = int(os.getenv("ADMISSION_MAX_QUEUE_PER_TENANT", "50"))
+# Longest time (seconds) a turn may wait for a slot
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "8"))
+# Assumed turn duration (seconds) until turns have been measured
+ADMISSION_DEFAULT_SERVICE_TIME = 3.0
+ADMISSION_SERVICE_TIME_ALPHA = 0.1  # EWMA smoothing of the measured turn duration
+
+# Share of the admission slots per tier while tenants are backlogged
+TIER_WEIGHTS = {
+    SubscriptionTier.FREE: 1,
+    SubscriptionTier.BASIC: 2,
+    SubscriptionTier.PREMIUM: 4,
+    SubscriptionTier.ENTERPRISE: 8
+}
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a turn can't be admitted in time; retry_after is in whole seconds."""
+
+    def __init__(self, tenant: str, reason: str, retry_after: int):
+        self.tenant = tenant
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Too many requests in progress ({reason}), retry in {retry_after}s.")
+
+
+class AdmissionTicket:
+    """An admission slot held by one turn; release() gives it back (once)."""
+
+    def __init__(self, scheduler: "AdmissionScheduler", tenant: str):
+        self.scheduler = scheduler
+        self.tenant = tenant
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self.tenant, time.monotonic() - self.admitted_at)
+
+
+class _Waiter:
+    __slots__ = ("tenant", "start_tag", "finish_tag", "future", "enqueued_at", "active")
+
+    def __init__(self, tenant: str, start_tag: float, finish_tag: float, future: asyncio.Future):
+        self.tenant = tenant
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.active = True
+
+
+class _TenantState:
+    def __init__(self):
+        self.weight = TIER_WEIGHTS[SubscriptionTier.FREE]
+        self.last_finish_tag = 0.0
+        self.queued = 0
+        self.inflight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_ms = LatencyHistogram()
+
+
+class AdmissionScheduler:
+    """
+    Weighted fair queueing of chat turns across tenants with bounded queues and deadlines.
+    """
+
+    def __init__(self, max_concurrent: int = ADMISSION_MAX_CONCURRENT, max_queue_per_tenant: int = ADMISSION_MAX_QUEUE_PER_TENANT, max_wait: float = ADMISSION_MAX_WAIT):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.max_wait = max_wait
+        self.inflight = 0
+        self.virtual_time = 0.0
+        self.service_time = ADMISSION_DEFAULT_SERVICE_TIME
+        self._queue: List[Any] = []  # heap of (finish_tag, seq, waiter)
+        self._queued = 0
+        self._seq = itertools.count()
+        self._tenants: Dict[str, _TenantState] = {}
+
+    def _tenant(self, tenant: str) -> _TenantState:
+        state = self._tenants.get(tenant)
+        if state is None:
+            state = self._tenants[tenant] = _TenantState()
+        return state
+
+    @asynccontextmanager
+    async def admit(self, tenant: str, tier: SubscriptionTier = SubscriptionTier.FREE):
+        """
+        Hold an admission slot for the duration of the block.
+
+        Raises:
+            AdmissionRejectedError: if the tenant's queue is full or no slot frees up in time
+        """
+        ticket = await self.acquire(tenant, tier)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    async def acquire(self, tenant: str, tier: SubscriptionTier = SubscriptionTier.FREE) -> AdmissionTicket:
+        """
+        Take an admission slot, waiting in the tenant's queue if all slots are busy.
+
+        Args:
+            tenant: Owner user id the turn is for
+            tier: The tenant's subscription tier (sets its weight)
+
+        Returns:
+            The AdmissionTicket to release when the turn's LLM work is done
+
+        Raises:
+            AdmissionRejectedError: if the tenant's queue is full or no slot frees up in time
+        """
+        state = self._tenant(tenant)
+        state.weight = TIER_WEIGHTS.get(tier, TIER_WEIGHTS[SubscriptionTier.FREE])
+        start_tag = max(self.virtual_time, state.last_finish_tag)
+        finish_tag = start_tag + 1.0 / state.weight
+
+        if self.inflight < self.max_concurrent and not self._queued:
+            state.last_finish_tag = finish_tag
+            self.virtual_time = start_tag
+            self._admitted(state, 0.0)
+            return AdmissionTicket(self, tenant)
+
+        if state.queued >= self.max_queue_per_tenant:
+            self._reject(state, tenant, "tenant queue full", self._estimated_wait(finish_tag))
+        estimated_wait = self._estimated_wait(finish_tag)
+        if estimated_wait > self.max_wait:
+            self._reject(state, tenant, "estimated wait too long", estimated_wait)
+
+        state.last_finish_tag = finish_tag
+        waiter = _Waiter(tenant, start_tag, finish_tag, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (finish_tag, next(self._seq), waiter))
+        state.queued += 1
+        self._queued += 1
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self._dequeue(waiter)
+            state.timed_out += 1
+            self._reject(state, tenant, "queue deadline passed", self.service_time)
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as the caller went away: hand the slot on
+                self.release(tenant)
+            else:
+                self._dequeue(waiter)
+            raise
+        return AdmissionTicket(self, tenant)
+
+    def release(self, tenant: str, service_time: Optional[float] = None) -> None:
+        """Give back a slot (see AdmissionTicket.release) and admit the next waiting turn."""
+        self.inflight -= 1
+        state = self._tenants.get(tenant)
+        if state is not None:
+            state.inflight -= 1
+        if service_time is not None:
+            self.service_time += ADMISSION_SERVICE_TIME_ALPHA * (service_time - self.service_time)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.inflight < self.max_concurrent and self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.active:
+                continue
+            self._dequeue(waiter)
+            if waiter.future.done():
+                # Timed out or cancelled, its task just hasn't run yet
+                continue
+            self.virtual_time = max(self.virtual_time, waiter.start_tag)
+            self._admitted(self._tenants[waiter.tenant], time.monotonic() - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def _dequeue(self, waiter: _Waiter) -> None:
+        # Cancelled waiters stay in the heap and are skipped by _dispatch
+        if waiter.active:
+            waiter.active = False
+            self._tenants[waiter.tenant].queued -= 1
+            self._queued -= 1
+
+    def _admitted(self, state: _TenantState, wait: float) -> None:
+        self.inflight += 1
+        state.inflight += 1
+        state.admitted += 1
+        state.wait_ms.observe(wait * 1000)
+
+    def _estimated_wait(self, finish_tag: float) -> float:
+        """Seconds until a turn with this finish tag would get a slot."""
+        ahead = sum(1 for tag, _, waiter in self._queue if waiter.active and tag <= finish_tag)
+        return (ahead // self.max_concurrent + 1) * self.service_time
+
+    def _reject(self, state: _TenantState, tenant: str, reason: str, retry_after: float) -> None:
+        state.rejected += 1
+        logger.warning(f"Admission rejected for user {tenant}: {reason} ({state.queued} queued, {self.inflight} in flight)")
+        raise AdmissionRejectedError(tenant, reason, max(1, math.ceil(retry_after)))
+
+    def stats(self, tenant: Optional[str] = None) -> Dict[str, Any]:
+        """Slots in use, queue depth and wait time histograms, overall and per tenant."""
+        tenants = {
+            tenant_id: {
+                "weight": state.weight,
+                "queue_depth": state.queued,
+                "inflight": state.inflight,
+                "admitted": state.admitted,
+                "rejected": state.rejected,
+                "timed_out": state.timed_out,
+                "wait": state.wait_ms.snapshot()
+            }
+            for tenant_id, state in self._tenants.items()
+            if tenant is None or tenant_id == tenant
+        }
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue_per_tenant": self.max_queue_per_tenant,
+            "max_wait": self.max_wait,
+            "inflight": self.inflight,
+            "queue_depth": self._queued,
+            "avg_service_time": round(self.service_time, 3),
+            "tenants": tenants
+        }
+
+
+_admission_scheduler: Optional[AdmissionScheduler] = None
+
+def get_admission_scheduler() -> AdmissionScheduler:
+    """Get or create the AdmissionScheduler singleton"""
+    global _admission_scheduler
+    if _admission_scheduler is None:
+        _admission_scheduler = AdmissionScheduler()
+    return _admission_scheduler
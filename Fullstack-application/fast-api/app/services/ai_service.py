@@ -15,15 +15,25 @@ import os
 import json
 import re
 import math
-from typing import Dict, List, Optional, Any, Tuple
+import copy
+import hashlib
+import time
+from typing import Dict, List, Optional, Any, Tuple, AsyncIterator
 from bson import ObjectId
 import google.generativeai as genai
 import asyncio
 from datetime import datetime
 from app.utils.logging_config import get_module_logger
 from app.services.knowledge_base import KnowledgeBase
+from app.services.llm_client import get_llm_client, LatencyBudget
+from app.services.response_cache import ResponseCache
+from app.services.prompt_registry import SystemPromptRegistry, PromptPrefix
+from app.services.prompt_builder import PromptBuilder, compact_value, get_prompt_budget, NLU_PROMPT_TOKEN_BUDGET
 from app.utils.context import EnhancedConversationContext
-from app.utils.mongo import get_shop_info
+from app.utils.keyword_matcher import match_keywords
+from app.utils.mongo import register_shop_info_listener, register_product_listener
+from app.utils.ttl_cache import TTLCache
+from app.utils.stage_timing import stage, record_stage
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -43,6 +53,18 @@ MODEL_CASCADE = [
     {'name': 'gemini-1.0-pro', 'desc': 'Gemini 1.0 Pro model (paid tier)'}
 ]
 
+# Fused mode: one Gemini call returns intent, entities and a draft reply. A second
+# (generation) call is only made when retrieval found data the answer must use.
+AI_FUSED_MODE = os.getenv("AI_FUSED_MODE", "false").lower() == "true"
+# Intents whose answer normally doesn't depend on catalog data, so the fused draft can be served as-is
+DRAFT_REPLY_INTENTS = {"general_question", "customer_service", "store_navigation", "shipping_payment"}
+# Share of the remaining request latency budget the NLU call may use (the rest is kept for generation)
+NLU_BUDGET_SHARE = float(os.getenv("NLU_BUDGET_SHARE", "0.4"))
+FUSED_BUDGET_SHARE = float(os.getenv("FUSED_BUDGET_SHARE", "0.6"))
+# In-process cache for extract_entities_with_gemini results
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "5000"))
+ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", "900"))  # seconds
+
 logger = get_module_logger(__name__)
 
 # Custom JSON encoder to handle datetime objects
@@ -65,6 +87,10 @@ def json_safe_dumps(obj):
     """Convert object to JSON string with datetime and infinity handling."""
     return json.dumps(obj, cls=EnhancedJSONEncoder, ensure_ascii=False)
 
+def normalize_query(query: str) -> str:
+    """Normalize a user query for cache lookups: lowercase, collapse whitespace, strip edge punctuation."""
+    return re.sub(r"\s+", " ", query.lower()).strip(" \t\n?!.,;:")
+
 class AIService:
     """
     Enhanced AI service with a hybrid architecture that balances:
@@ -76,121 +102,37 @@ class AIService:
     def __init__(self, knowledge_base: KnowledgeBase):
         self.knowledge_base = knowledge_base
         self.logger = logger
-        self.system_prompts = {}  # Dynamically loaded shop-specific prompts
+        self.llm_client = get_llm_client()  # Shared async Gemini client (connection reuse + in-flight limits)
+        # Cache of successful entity extractions, keyed per tenant (see _entity_cache_key)
+        self.entity_cache = TTLCache("entity_extraction", maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+        # Cache of generated replies, invalidated per product (see ResponseCache)
+        self.response_cache = ResponseCache()
+        register_shop_info_listener(self._on_shop_info_changed)
+        register_product_listener(self._on_product_changed)
+        # Compiled per-tenant system prompts, invalidated on shop info changes
+        self.prompt_registry = SystemPromptRegistry(provider_cache_models=[model_info["name"] for model_info in MODEL_CASCADE])
     
-    async def _get_system_prompt(self, language: str = "cs") -> str:
+    @staticmethod
+    def _tenant_id(context: Optional[EnhancedConversationContext]) -> Optional[str]:
+        """Owner user id of the conversation, used for per-tenant LLM limits."""
+        return getattr(context, "user_id", None) if context else None
+
+    async def _get_system_prompt(self, language: str = "cs", user_id: Optional[str] = None) -> str:
         """
-        Get the system prompt for the specified language, dynamically constructed using 
-        shop information from the database to personalize the AI behavior.
+        Get the tenant's system prompt for the specified language, constructed from
+        their shop information (see SystemPromptRegistry; no DB lookup once compiled).
         
         Args:
             language: Language code (default: "cs" for Czech)
+            user_id: Owner user id of the shop (tenant)
             
         Returns:
             System prompt for AI
         """
-        # Check if we already have this prompt loaded
-        if language in self.system_prompts:
-            return self.system_prompts[language]
-            
-        # Otherwise, fetch shop info and construct the prompt
-        try:
-            shop_info = await get_shop_info(language)
-            
-            if language == "cs":
-                prompt = f"""{shop_info['ai_prompt_summary']}
-
-Základní informace:
-- Jmenujeme se {shop_info['shop_name']}
-- Byli jsme založeni v roce {shop_info['founded_year']}
-- Naše webové stránky jsou na {shop_info['website']}
-- Kontaktovat nás můžete na {shop_info['primary_email']} nebo telefonicky na {shop_info['primary_phone']}
-"""
-
-                # Add services if available
-                if shop_info.get('services'):
-                    prompt += "\nNaše služby:\n"
-                    for service in shop_info['services']:
-                        prompt += f"- {service}\n"
-
-                # Add AI facts if available
-                if shop_info.get('ai_faq_facts'):
-                    prompt += "\nDůležitá fakta:\n"
-                    for fact in shop_info['ai_faq_facts']:
-                        prompt += f"- {fact}\n"
-
-                # Add voice style if available
-                if shop_info.get('ai_voice_style'):
-                    prompt += f"\nTón komunikace: {shop_info['ai_voice_style']}\n"
-                
-                prompt += """
-Tvé schopnosti:
-- Doporučuješ produkty na základě potřeb zákazníka  
-- Porovnáváš výhody a nevýhody různých možností
-- Vysvětluješ technické parametry srozumitelným způsobem
-- Doporučuješ kompatibilní příslušenství a související služby
-- Pomáháš s orientací v e-shopu
-- Odpovídáš na otázky o dopravě, platbách, reklamacích a doplňkových službách
-
-Buď vždy přátelský, profesionální a užitečný. Snaž se porozumět skutečným potřebám zákazníka.
-Odpovídej stručně a přímo, vždy česky. Pro údaje, které neznáš, upřímně přiznej neznalost.
-"""
-            else:  # English or other languages
-                prompt = f"""{shop_info.get('ai_prompt_summary', f"We are {shop_info['shop_name']}, founded in {shop_info['founded_year']}.")}
-
-Basic information:
-- Our name is {shop_info['shop_name']}
-- We were founded in {shop_info['founded_year']}
-- Our website is at {shop_info['website']}
-- You can contact us at {shop_info['primary_email']} or by phone at {shop_info['primary_phone']}
-"""
-
-                # Add services if available
-                if shop_info.get('services'):
-                    prompt += "\nOur services:\n"
-                    for service in shop_info['services']:
-                        prompt += f"- {service}\n"
-
-                # Add AI facts if available
-                if shop_info.get('ai_faq_facts'):
-                    prompt += "\nImportant facts:\n"
-                    for fact in shop_info['ai_faq_facts']:
-                        prompt += f"- {fact}\n"
-
-                # Add voice style if available
-                if shop_info.get('ai_voice_style'):
-                    prompt += f"\nCommunication style: {shop_info['ai_voice_style']}\n"
-                
-                prompt += """
-Your capabilities:
-- Recommend products based on customer needs
-- Compare pros and cons of different options
-- Explain technical specifications in an accessible way
-- Recommend compatible accessories and related services
-- Help customers navigate the online store
-- Answer questions about shipping, payment methods, refunds, and complementary services
-
-Always be friendly, professional, and helpful. Try to understand the customer's real needs.
-Respond concisely and directly. For information you don't know, honestly admit your lack of knowledge.
-"""
-            
-            # Cache the prompt for future use
-            self.system_prompts[language] = prompt
-            return prompt
-            
-        except Exception as e:
-            self.logger.error(f"Error loading shop info for prompt: {str(e)}")
-            
-            # Fall back to hardcoded prompts if shop info can't be loaded
-            if language == "cs":
-                fallback = """Jsme DvojkavIT, nová generace digitálních tvůrců, která vznikla v roce 2024. Spojuje nás vášeň pro online svět a touha dělat věci jinak, lépe. Jako stratégové a vizionáři vytváříme inovativní digitální řešení, která vám pomohou dosáhnout vašich online cílů. Odpovídáme stručně a výstižně, maximálně ve 100 slovech."""
-            else:
-                fallback = """You are a concise and direct shopping assistant. Answer in a maximum of 60 words."""
-                
-            self.system_prompts[language] = fallback
-            return fallback
+        prefix = await self.prompt_registry.get(user_id, language)
+        return prefix.text
 
-    async def extract_entities_with_gemini(self, query: str, context: Optional[EnhancedConversationContext], language: str = "cs") -> Dict[str, Any]:
+    async def extract_entities_with_gemini(self, query: str, context: Optional[EnhancedConversationContext], language: str = "cs", budget: Optional[LatencyBudget] = None) -> Dict[str, Any]:
         """
         Analyze query using Gemini to extract intent and entities.
         This is a streamlined approach where Gemini handles the NLP tasks directly.
@@ -199,156 +141,198 @@ Respond concisely and directly. For information you don't know, honestly admit y
             query: The user's query text
             context: Optional conversation context
             language: Language code (default: "cs" for Czech)
+            budget: Optional request latency budget; extraction gets NLU_BUDGET_SHARE of what is left
             
         Returns:
             Dictionary with extracted intent and entities, or a fallback structure on error.
             Example: {"intent": "product_recommendation", "entities": {"products": ["kolo"], "price_range": {"min": 5000}}}
         """
         self.logger.info(f"Extracting entities from query: '{query}' in language: {language}")
-        
-        # Prepare context data for the analysis
-        context_data = {}
-        if context:
-            context_data = {
-                "previous_queries": context.previous_queries[-3:] if context.previous_queries else [],
-                "previous_intents": context.previous_intents[-3:] if context.previous_intents else [],
-                "category": context.category,
-                "budget_range": context.budget_range,
-                "required_features": context.required_features,
-                "attributes": context.attributes
-            }
 
-        system_prompt = await self._get_system_prompt(language)
-        
-        # Define possible intents and entities for the prompt
-        possible_intents = ["product_recommendation", "product_comparison", "technical_explanation", "accessory_recommendation", "store_navigation", "shipping_payment", "customer_service", "order_status", "general_question"]
-        entity_structure = """
-        {
-            "products": ["<product name>", ...],
-            "categories": ["<category name>", ...],
-            "features": ["<feature name>", ...],
-            "brands": ["<brand name>", ...],
-            "price_range": {"min": <number or null>, "max": <number or null>},
-            "comparison": <boolean>,
-            "accessories": ["<accessory name>", ...],
-            "service_requests": ["<service type>", ...],
-            "order_number": "<order number or null>",
-            "email": "<email address or null>"
-        }
-        """
+        cache_key = self._entity_cache_key(query, context, language)
+        cached_analysis = self.entity_cache.get(cache_key)
+        if cached_analysis is not None:
+            self.logger.debug(f"Entity extraction cache hit for query: '{query}'")
+            return copy.deepcopy(cached_analysis) # Callers mutate the analysis/entities
 
-        analysis_instructions = f"""
-Analyze the user query considering the conversation context. Identify the primary user intent and extract relevant entities. 
-**CRITICAL:** Queries asking generally about products, inventory, or what the shop sells (e.g., "jaké máte produkty?", "what products do you have?", "show me bikes", "do you sell accessories?", "ukaž mi zboží") MUST be classified with the intent 'product_recommendation', even if no specific product name or category is mentioned. Do NOT classify these as 'general_question'.
+        full_prompt = await self._build_analysis_prompt(query, context, language)
+        generation_config = {
+            "temperature": 0.1, # Low temperature for factual extraction
+            "max_output_tokens": 512,
+            "top_p": 0.95,
+            "top_k": 40,
+            "response_mime_type": "application/json", # Request JSON output directly if supported
+        }
 
-Possible Intents: {', '.join(possible_intents)}
-Entity Structure to Extract: {entity_structure}
+        with stage("nlu"):
+            parsed_json = await self._generate_json_with_cascade(
+                full_prompt, generation_config, required_keys=("intent", "entities"), label="Entity Extraction",
+                tenant_id=self._tenant_id(context),
+                timeout=budget.slice(NLU_BUDGET_SHARE) if budget else None,
+                prefix=await self.prompt_registry.get(self._tenant_id(context), language)
+            )
+        if parsed_json is not None:
+            # Add confidence score based on successful parsing
+            parsed_json["confidence"] = 0.85 # High confidence for successful AI extraction
+            self.logger.debug(f"Successfully extracted entities: {parsed_json}")
+            self.entity_cache.set(cache_key, copy.deepcopy(parsed_json)) # Fallbacks are never cached
+            return parsed_json
 
-User query: "{query}"
-Conversation context: {json_safe_dumps(context_data)}
+        self.logger.error("All Gemini API attempts failed for entity extraction. Using fallback.")
+        return self._fallback_entity_analysis()
 
-Return ONLY the JSON object containing the 'intent' and 'entities'.
-""" if language == "cs" else f"""
-Analyze the user query considering the conversation context. Identify the primary user intent and extract relevant entities.
+    async def analyze_and_draft_with_gemini(self, query: str, context: Optional[EnhancedConversationContext], language: str = "cs", budget: Optional[LatencyBudget] = None) -> Dict[str, Any]:
+        """
+        Fused mode: extract intent/entities and draft a reply in a single Gemini call.
 
-Possible Intents: {', '.join(possible_intents)}
-Entity Structure to Extract: {entity_structure}
+        The draft is written without any catalog data, so callers should only use it when
+        retrieval adds nothing to the answer (see DRAFT_REPLY_INTENTS) and otherwise make
+        the regular generate_response_with_gemini call.
 
-User query: "{query}"
-Conversation context: {json_safe_dumps(context_data)}
+        Args:
+            query: The user's query text
+            context: Optional conversation context
+            language: Language code (default: "cs" for Czech)
+            budget: Optional request latency budget
 
-Return ONLY the JSON object containing the 'intent' and 'entities'.
-"""
+        Returns:
+            Same structure as extract_entities_with_gemini plus a "draft_reply" key
+            (None when the model did not produce one or on fallback).
+        """
+        self.logger.info(f"Fused analysis + draft for query: '{query}' in language: {language}")
 
-        full_prompt = f"{system_prompt}\n\n{analysis_instructions}"
+        full_prompt = await self._build_analysis_prompt(query, context, language, include_draft=True)
         generation_config = {
-            "temperature": 0.1, # Low temperature for factual extraction
-            "max_output_tokens": 512,
+            "temperature": 0.3, # Between extraction (0.1) and free-form generation (0.6)
+            "max_output_tokens": 1024,
             "top_p": 0.95,
             "top_k": 40,
-            "response_mime_type": "application/json", # Request JSON output directly if supported
+            "response_mime_type": "application/json",
         }
 
-    async def extract_entities_with_gemini(self, query: str, context: Optional[EnhancedConversationContext], language: str = "cs") -> Dict[str, Any]:
+        with stage("nlu"):
+            parsed_json = await self._generate_json_with_cascade(
+                full_prompt, generation_config, required_keys=("intent", "entities"), label="Fused Analysis",
+                tenant_id=self._tenant_id(context),
+                timeout=budget.slice(FUSED_BUDGET_SHARE) if budget else None,
+                prefix=await self.prompt_registry.get(self._tenant_id(context), language)
+            )
+        if parsed_json is not None:
+            parsed_json["confidence"] = 0.85
+            draft_reply = parsed_json.get("draft_reply")
+            parsed_json["draft_reply"] = draft_reply.strip() if isinstance(draft_reply, str) and draft_reply.strip() else None
+            self.logger.debug(f"Fused analysis result: intent={parsed_json.get('intent')}, has_draft={parsed_json['draft_reply'] is not None}")
+            return parsed_json
+
+        self.logger.error("All Gemini API attempts failed for fused analysis. Using fallback.")
+        fallback_analysis = self._fallback_entity_analysis()
+        fallback_analysis["draft_reply"] = None
+        return fallback_analysis
+
+    async def _build_analysis_prompt(self, query: str, context: Optional[EnhancedConversationContext], language: str = "cs", include_draft: bool = False) -> str:
         """
-        Analyze query using Gemini to extract intent and entities.
-        
+        Build the intent/entity extraction prompt.
+
         Args:
             query: The user's query text
             context: Optional conversation context
-            language: Language code (default: "cs" for Czech)
-            
+            language: Language code
+            include_draft: Also ask for a "draft_reply" (fused mode)
+
         Returns:
-            Dictionary with extracted intent and entities, or a fallback structure on error.
-            Example: {"intent": "product_recommendation", "entities": {"products": ["kolo"], "price_range": {"min": 5000}}}
+            The full prompt including the system prompt
         """
-        self.logger.info(f"Extracting entities from query: '{query}' in language: {language}")
-        
-        # Prepare context data for the analysis
-        context_data = {}
-        if context:
-            context_data = {
-                "previous_queries": context.previous_queries[-3:] if context.previous_queries else [],
-                "previous_intents": context.previous_intents[-3:] if context.previous_intents else [],
-                "category": context.category,
-                "budget_range": context.budget_range,
-                "required_features": context.required_features,
-                "attributes": context.attributes
-            }
-
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, self._tenant_id(context))
         
         # Define possible intents and entities for the prompt
         possible_intents = ["product_recommendation", "product_comparison", "technical_explanation", "accessory_recommendation", "store_navigation", "shipping_payment", "customer_service", "order_status", "general_question"]
-        entity_structure = """
-        {
-            "products": ["<product name>", ...],
-            "categories": ["<category name>", ...],
-            "features": ["<feature name>", ...],
-            "brands": ["<brand name>", ...],
-            "price_range": {"min": <number or null>, "max": <number or null>},
-            "comparison": <boolean>,
-            "accessories": ["<accessory name>", ...],
-            "service_requests": ["<service type>", ...],
-            "order_number": "<order number or null>",
-            "email": "<email address or null>"
-        }
-        """
-
-        analysis_instructions = f"""
-Analyze the user query considering the conversation context. Identify the primary user intent and extract relevant entities. 
-**CRITICAL:** Queries asking generally about products, inventory, or what the shop sells (e.g., "jaké máte produkty?", "what products do you have?", "show me bikes", "do you sell accessories?", "ukaž mi zboží") MUST be classified with the intent 'product_recommendation', even if no specific product name or category is mentioned. Do NOT classify these as 'general_question'.
+        entity_structure = """{
+    "products": ["<product name>", ...],
+    "categories": ["<category name>", ...],
+    "features": ["<feature name>", ...],
+    "brands": ["<brand name>", ...],
+    "price_range": {"min": <number or null>, "max": <number or null>},
+    "comparison": <boolean>,
+    "accessories": ["<accessory name>", ...],
+    "service_requests": ["<service type>", ...],
+    "order_number": "<order number or null>",
+    "email": "<email address or null>"
+}"""
+
+        critical_note = """
+**CRITICAL:** Queries asking generally about products, inventory, or what the shop sells (e.g., "jaké máte produkty?", "what products do you have?", "show me bikes", "do you sell accessories?", "ukaž mi zboží") MUST be classified with the intent 'product_recommendation', even if no specific product name or category is mentioned. Do NOT classify these as 'general_question'.""" if language == "cs" else ""
+
+        builder = PromptBuilder("nlu_fused" if include_draft else "nlu", NLU_PROMPT_TOKEN_BUDGET)
+        builder.add("system", system_prompt, priority=100, required=True)
+        builder.add("task", f"""Analyze the user query considering the conversation context. Identify the primary user intent and extract relevant entities.{critical_note}
 
 Possible Intents: {', '.join(possible_intents)}
 Entity Structure to Extract: {entity_structure}
 
-User query: "{query}"
-Conversation context: {json_safe_dumps(context_data)}
+User query: "{query}\"""", priority=100, required=True)
+        context_data = compact_value(self._prompt_context_data(context))
+        if context_data:
+            builder.add("context", f"Conversation context: {json_safe_dumps(context_data)}", priority=30)
+        builder.add("output", "Return ONLY the JSON object containing the 'intent' and 'entities'.", priority=90, required=True)
 
-Return ONLY the JSON object containing the 'intent' and 'entities'.
-""" if language == "cs" else f"""
-Analyze the user query considering the conversation context. Identify the primary user intent and extract relevant entities.
+        if include_draft:
+            builder.add("draft", f"""Additionally include a 'draft_reply' key: a concise, friendly answer to the user in {language}, written from the shop information above only.
+Do not invent products, prices or stock; for product questions the draft may be a short lead-in, product data will be added later.""", priority=90, required=True)
 
-Possible Intents: {', '.join(possible_intents)}
-Entity Structure to Extract: {entity_structure}
+        return builder.build()
 
-User query: "{query}"
-Conversation context: {json_safe_dumps(context_data)}
+    @staticmethod
+    def _prompt_context_data(context: Optional[EnhancedConversationContext]) -> Dict[str, Any]:
+        """The conversation context fields that are sent to Gemini."""
+        if not context:
+            return {}
+        return {
+            "previous_queries": context.previous_queries[-3:] if context.previous_queries else [],
+            "previous_intents": context.previous_intents[-3:] if context.previous_intents else [],
+            "category": context.category,
+            "budget_range": context.budget_range,
+            "required_features": context.required_features,
+            "attributes": context.attributes
+        }
 
-Return ONLY the JSON object containing the 'intent' and 'entities'.
-"""
+    def _entity_cache_key(self, query: str, context: Optional[EnhancedConversationContext], language: str) -> Tuple[str, str, str, str]:
+        """Cache key for entity extraction: tenant, language, normalized query and a hash of the prompt context."""
+        context_json = json.dumps(self._prompt_context_data(context), cls=EnhancedJSONEncoder, ensure_ascii=False, sort_keys=True)
+        context_hash = hashlib.sha1(context_json.encode("utf-8")).hexdigest()
+        return (self._tenant_id(context) or "", language, normalize_query(query), context_hash)
+
+    def _on_shop_info_changed(self, user_id: Optional[str], language: str) -> None:
+        """Drop the tenant's compiled system prompt and the cached AI results built with it."""
+        self.prompt_registry.invalidate(user_id, language)
+        removed = self.entity_cache.invalidate_tenant(user_id or "", lambda key: key[1] == language)
+        removed += self.response_cache.invalidate_tenant(user_id or "", language)
+        self.logger.info(f"Shop info changed for user {user_id} ({language}), dropped {removed} cached AI results")
+
+    def _on_product_changed(self, user_id: Optional[str], product_id: str) -> None:
+        """Drop cached replies that were generated from a product that changed or was deleted."""
+        removed = self.response_cache.invalidate_product(user_id or "", product_id)
+        if removed:
+            self.logger.info(f"Product {product_id} of user {user_id} changed, dropped {removed} cached replies")
+
+    @staticmethod
+    def _is_response_cacheable(context: Optional[EnhancedConversationContext]) -> bool:
+        """
+        Only first turns are served from the response cache: later turns depend on the
+        conversation history that is part of the prompt.
+        """
+        return not context or len(context.previous_queries or []) <= 1
 
-        full_prompt = f"{system_prompt}\n\n{analysis_instructions}"
-        generation_config = {
-            "temperature": 0.1, # Low temperature for factual extraction
-            "max_output_tokens": 512,
-            "top_p": 0.95,
-            "top_k": 40,
-            "response_mime_type": "application/json", # Request JSON output directly if supported
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss statistics of the AI service caches."""
+        return {
+            "entity_extraction": self.entity_cache.stats(),
+            "response_generation": self.response_cache.stats(),
+            "system_prompts": self.prompt_registry.stats()
         }
 
-        # Default fallback structure
-        fallback_analysis = {
+    def _fallback_entity_analysis(self) -> Dict[str, Any]:
+        """Default analysis returned when Gemini entity extraction fails."""
+        return {
             "intent": "general_question",
             "entities": {
                 "products": [], "categories": [], "features": [], "brands": [],
@@ -358,59 +342,59 @@ Return ONLY the JSON object containing the 'intent' and 'entities'.
             "confidence": 0.0 # Indicate low confidence for fallback
         }
 
-        response = None
-        retry_count = 0
-        last_error = None
-
-        while response is None and retry_count <= MAX_RETRIES:
-            try:
-                model_info = MODEL_CASCADE[min(retry_count, len(MODEL_CASCADE) - 1)]
-                self.logger.info(f"Entity Extraction Try #{retry_count+1} with {model_info['desc']}")
-                model = genai.GenerativeModel(model_info['name'])
-                
-                response = await asyncio.to_thread(
-                    model.generate_content,
-                    full_prompt,
-                    generation_config=generation_config
-                )
-                
-                # Check if response has text part
-                if response and hasattr(response, 'text') and response.text:
-                    result_text = response.text.strip()
-                    try:
-                        # Try to parse the JSON response
-                        parsed_json = json.loads(result_text)
-                        # Basic validation
-                        if "intent" in parsed_json and "entities" in parsed_json:
-                             # Add confidence score based on successful parsing
-                            parsed_json["confidence"] = 0.85 # High confidence for successful AI extraction
-                            self.logger.debug(f"Successfully extracted entities: {parsed_json}")
-                            return parsed_json
-                        else:
-                             self.logger.warning(f"Extracted JSON missing required keys: {result_text}")
-                             # Fall through to retry or fallback
-                    except json.JSONDecodeError:
-                        self.logger.warning(f"Failed to parse JSON response for entity extraction: {result_text}")
-                        # Fall through to retry or fallback
-                else:
-                    self.logger.warning(f"Received empty or invalid response from Gemini API (Attempt {retry_count+1})")
+    async def _generate_json_with_cascade(self, full_prompt: str, generation_config: Dict[str, Any], required_keys: Tuple[str, ...], label: str, tenant_id: Optional[str] = None, timeout: Optional[float] = None, prefix: Optional[PromptPrefix] = None) -> Optional[Dict[str, Any]]:
+        """
+        Call Gemini down MODEL_CASCADE (hedged, see GeminiClient.generate_hedged) until it
+        returns a JSON object with the required keys.
 
-            except Exception as e:
-                last_error = e
-                self.logger.warning(f"Gemini API call failed (attempt {retry_count+1}): {str(e)}")
-            
-            # Increment retry count and delay
-            retry_count += 1
-            if retry_count <= MAX_RETRIES:
-                delay = min(RETRY_DELAY_BASE * (2 ** (retry_count - 1)), MAX_RETRY_DELAY)
-                await asyncio.sleep(delay)
+        Args:
+            full_prompt: Prompt to send
+            generation_config: Gemini generation config (should request JSON output)
+            required_keys: Keys the parsed JSON object must contain
+            label: Name used in log messages
+            tenant_id: Owner user id, for the per-tenant in-flight limit
+            timeout: Seconds available for this call (None = no limit)
+            prefix: The tenant's compiled system prompt, if full_prompt starts with it
 
-        # If all retries fail
-        self.logger.error(f"All Gemini API attempts failed for entity extraction. Last error: {last_error}. Using fallback.")
-        return fallback_analysis
+        Returns:
+            The parsed JSON object, or None if all attempts failed or the time ran out
+        """
+        def parse(response):
+            # Check if response has text part
+            if not (response and hasattr(response, 'text') and response.text):
+                self.logger.warning(f"Received empty or invalid response from Gemini API for {label}")
+                return None
+            result_text = response.text.strip()
+            try:
+                # Try to parse the JSON response
+                parsed_json = json.loads(result_text)
+            except json.JSONDecodeError:
+                self.logger.warning(f"Failed to parse JSON response for {label}: {result_text}")
+                return None
+            # Basic validation
+            if isinstance(parsed_json, dict) and all(key in parsed_json for key in required_keys):
+                return parsed_json
+            self.logger.warning(f"{label} JSON missing required keys: {result_text}")
+            return None
+
+        parsed_json, model_name = await self.llm_client.generate_hedged(
+            [model_info['name'] for model_info in MODEL_CASCADE],
+            full_prompt,
+            generation_config=generation_config,
+            tenant_id=tenant_id,
+            timeout=timeout,
+            parse=parse,
+            label=label,
+            prefix=prefix
+        )
+        if parsed_json is None:
+            self.logger.error(f"All Gemini API attempts failed for {label} within {timeout if timeout is not None else 'unbounded'}s")
+            return None
+        self.logger.info(f"{label} answered by {model_name}")
+        return parsed_json
 
 
-    async def generate_response_with_gemini(self, query: str, analysis: Dict[str, Any], relevant_data: List[Dict], context: Optional[EnhancedConversationContext], language: str = "cs") -> str:
+    async def generate_response_with_gemini(self, query: str, analysis: Dict[str, Any], relevant_data: List[Dict], context: Optional[EnhancedConversationContext], language: str = "cs", budget: Optional[LatencyBudget] = None, use_response_cache: bool = True) -> str:
         """
         Generate a natural language response using Gemini based on the query, analysis, and retrieved data.
         
@@ -420,52 +404,92 @@ Return ONLY the JSON object containing the 'intent' and 'entities'.
             relevant_data: List of processed data items (e.g., formatted products) retrieved from KnowledgeBase.
             context: Optional conversation context.
             language: Language code.
+            budget: Optional request latency budget; when it runs out the fallback reply is returned.
+            use_response_cache: Serve and store the reply in the response cache (off for evaluation replays).
             
         Returns:
             The generated natural language response string.
         """
         self.logger.info(f"Generating response for query: '{query}' with intent: {analysis.get('intent')}")
 
-        system_prompt = await self._get_system_prompt(language)
-        
-        # Prepare context data
-        context_data = {}
-        if context:
-            context_data = {
-                "previous_queries": context.previous_queries[-3:] if context.previous_queries else [],
-                "previous_intents": context.previous_intents[-3:] if context.previous_intents else [],
-                "category": context.category,
-                "budget_range": context.budget_range,
-                "required_features": context.required_features,
-                "attributes": context.attributes
-            }
+        cacheable = use_response_cache and self._is_response_cacheable(context)
+        cache_args = (self._tenant_id(context) or "", language, analysis.get("intent", "general_question"), normalize_query(query), relevant_data)
+        if cacheable:
+            cached_reply = await self.response_cache.get(*cache_args)
+            if cached_reply is not None:
+                self.logger.debug(f"Response cache hit for query: '{query}'")
+                return cached_reply
 
-        # Prepare relevant data string
-        relevant_data_str = "No specific data found."
-        if relevant_data:
-            relevant_data_str = f"Found the following relevant information:\n{json_safe_dumps(relevant_data)}"
+        full_prompt, generation_config, fallback_reply = await self._build_response_prompt(
+            query, analysis, relevant_data, context, language
+        )
 
-        response_instructions = f"""
-Based on the user's query, the conversation context, and the relevant data found, generate a helpful and natural response in {language}.
+        def parse(response):
+            if response and hasattr(response, 'text') and response.text:
+                return response.text.strip()
+            self.logger.warning("Received empty or invalid response from Gemini API for response generation")
+            return None
 
-User Query: "{query}"
-Identified Intent: {analysis.get('intent', 'N/A')}
-Extracted Entities: {json_safe_dumps(analysis.get('entities', {}))}
-Conversation Context: {json_safe_dumps(context_data)}
-Relevant Data Found:
-{relevant_data_str}
+        with stage("generation"):
+            response_text, model_name = await self.llm_client.generate_hedged(
+                [model_info['name'] for model_info in MODEL_CASCADE],
+                full_prompt,
+                generation_config=generation_config,
+                tenant_id=self._tenant_id(context),
+                timeout=budget.remaining() if budget else None,
+                parse=parse,
+                label="Response Generation",
+                prefix=await self.prompt_registry.get(self._tenant_id(context), language)
+            )
+        if response_text:
+            self.logger.debug(f"Successfully generated response with {model_name}: {response_text}")
+            if cacheable:
+                await self.response_cache.set(*cache_args, response_text)
+            return response_text
+
+        # If all models failed or the budget ran out
+        self.logger.error("All Gemini API attempts failed or latency budget exhausted for response generation. Using fallback response.")
+        return fallback_reply
+        
+    async def _build_response_prompt(self, query: str, analysis: Dict[str, Any], relevant_data: List[Dict], context: Optional[EnhancedConversationContext], language: str = "cs") -> Tuple[str, Dict[str, Any], str]:
+        """
+        Build the prompt, generation config and fallback reply shared by the
+        blocking and streaming response generators.
+
+        Returns:
+            Tuple of (full_prompt, generation_config, fallback_reply)
+        """
+        system_prompt = await self._get_system_prompt(language, self._tenant_id(context))
+        intent = analysis.get('intent', 'N/A')
 
-Instructions:
+        builder = PromptBuilder("generation", get_prompt_budget(intent))
+        builder.add("system", system_prompt, priority=100, required=True)
+        builder.add("query", f"""Based on the user's query, the conversation context, and the relevant data found, generate a helpful and natural response in {language}.
+
+User Query: "{query}"
+Identified Intent: {intent}""", priority=100, required=True)
+        entities = compact_value(analysis.get('entities', {}))
+        if entities and entities != {"comparison": False}:
+            builder.add("entities", f"Extracted Entities: {json_safe_dumps(entities)}", priority=50)
+        context_data = compact_value(self._prompt_context_data(context))
+        if context_data:
+            builder.add("context", f"Conversation Context: {json_safe_dumps(context_data)}", priority=30)
+        builder.add_items(
+            "relevant_data", relevant_data,
+            render=lambda items: f"Relevant Data Found:\nFound the following relevant information:\n{json_safe_dumps(items)}",
+            priority=70,
+            empty_text="Relevant Data Found:\nNo specific data found."
+        )
+        builder.add("instructions", f"""Instructions:
 - Address the user's query directly.
 - Incorporate the relevant data naturally into the response.
-- Maintain a {language} language and a friendly, professional tone ({system_prompt}).
+- Maintain a {language} language and the friendly, professional tone described above.
 - Keep the response concise and to the point.
 - If relevant data was found, base your response primarily on that data.
 - If no relevant data was found, provide a helpful general response or ask clarifying questions.
-- Optionally, suggest one relevant follow-up question the user might have.
-"""
+- Optionally, suggest one relevant follow-up question the user might have.""", priority=90, required=True)
 
-        full_prompt = f"{system_prompt}\n\n{response_instructions}"
+        full_prompt = builder.build()
         generation_config = {
             "temperature": 0.6, # Slightly higher temperature for more natural language
             "max_output_tokens": 1024,
@@ -480,42 +504,73 @@ Instructions:
         }
         fallback_reply = fallback_responses.get(language, fallback_responses["cs"])
 
-        response = None
-        retry_count = 0
-        last_error = None
+        return full_prompt, generation_config, fallback_reply
 
-        while response is None and retry_count <= MAX_RETRIES:
-            try:
-                model_info = MODEL_CASCADE[min(retry_count, len(MODEL_CASCADE) - 1)]
-                self.logger.info(f"Response Generation Try #{retry_count+1} with {model_info['desc']}")
-                model = genai.GenerativeModel(model_info['name'])
-                
-                response = await asyncio.to_thread(
-                    model.generate_content,
-                    full_prompt,
-                    generation_config=generation_config
-                )
+    async def stream_response_with_gemini(self, query: str, analysis: Dict[str, Any], relevant_data: List[Dict], context: Optional[EnhancedConversationContext], language: str = "cs", budget: Optional[LatencyBudget] = None) -> AsyncIterator[str]:
+        """
+        Stream a natural language response from Gemini chunk by chunk.
 
-                if response and hasattr(response, 'text') and response.text:
-                    self.logger.debug(f"Successfully generated response: {response.text.strip()}")
-                    return response.text.strip()
-                else:
-                    self.logger.warning(f"Received empty or invalid response from Gemini API for response generation (Attempt {retry_count+1})")
+        Walks MODEL_CASCADE like generate_response_with_gemini, but only falls back to the
+        next model while nothing has been emitted yet; once text has been sent to the client
+        a mid-stream failure ends the stream instead of restarting the answer. A model that
+        produces no first chunk within its p95 latency is skipped for the next one.
 
-            except Exception as e:
-                last_error = e
-                self.logger.warning(f"Gemini API call failed during response generation (attempt {retry_count+1}): {str(e)}")
+        Args:
+            query: The original user query.
+            analysis: The result from extract_entities_with_gemini.
+            relevant_data: List of processed data items retrieved from KnowledgeBase.
+            context: Optional conversation context.
+            language: Language code.
+            budget: Optional request latency budget.
 
-            # Increment retry count and delay
-            retry_count += 1
-            if retry_count <= MAX_RETRIES:
-                delay = min(RETRY_DELAY_BASE * (2 ** (retry_count - 1)), MAX_RETRY_DELAY)
-                await asyncio.sleep(delay)
+        Yields:
+            Text chunks of the generated response (the fallback reply if every model fails).
+        """
+        self.logger.info(f"Streaming response for query: '{query}' with intent: {analysis.get('intent')}")
+
+        cacheable = self._is_response_cacheable(context)
+        cache_args = (self._tenant_id(context) or "", language, analysis.get("intent", "general_question"), normalize_query(query), relevant_data)
+        if cacheable:
+            cached_reply = await self.response_cache.get(*cache_args)
+            if cached_reply is not None:
+                self.logger.debug(f"Response cache hit for streamed query: '{query}'")
+                yield cached_reply
+                return
+
+        full_prompt, generation_config, fallback_reply = await self._build_response_prompt(
+            query, analysis, relevant_data, context, language
+        )
+
+        emitted = False
+        streamed_parts = []
+        generation_started = time.monotonic()
+        try:
+            async for text in self.llm_client.stream_with_fallback(
+                [model_info['name'] for model_info in MODEL_CASCADE],
+                full_prompt,
+                generation_config=generation_config,
+                tenant_id=self._tenant_id(context),
+                timeout=budget.remaining() if budget else None,
+                label="Streaming Response",
+                prefix=await self.prompt_registry.get(self._tenant_id(context), language)
+            ):
+                emitted = True
+                streamed_parts.append(text)
+                yield text
+        except Exception as e:
+            if emitted:
+                self.logger.error(f"Gemini stream interrupted after partial output: {str(e)}")
+                return
+            self.logger.warning(f"Gemini API streaming call failed: {str(e)}")
+        finally:
+            record_stage("generation", (time.monotonic() - generation_started) * 1000)
+
+        if not emitted:
+            self.logger.error("All Gemini API attempts failed or latency budget exhausted for streamed response. Using fallback response.")
+            yield fallback_reply
+        elif cacheable:
+            await self.response_cache.set(*cache_args, "".join(streamed_parts).strip())
 
-        # If all retries fail
-        self.logger.error(f"All Gemini API attempts failed for response generation. Last error: {last_error}. Using fallback response.")
-        return fallback_reply
-        
     def _create_fallback_analysis(self, query: str, context: Optional[EnhancedConversationContext] = None) -> Dict[str, Any]:
         """
         DEPRECATED - Use extract_entities_with_gemini fallback instead.
@@ -686,7 +741,7 @@ Instructions:
                 }
             
             # Get the system prompt
-            system_prompt = await self._get_system_prompt(language)
+            system_prompt = await self._get_system_prompt(language, self._tenant_id(context))
             
             # Expanded analysis instructions for better intent detection
             analysis_instructions = f"""
@@ -788,25 +843,26 @@ Possible query_type values: direct_product, category_browse, comparison, feature
                     if retry_count == 0 or retry_for_free_model:
                         model_info = MODEL_CASCADE[0]  # Always use the free model for these attempts
                         self.logger.info(f"Try #{retry_count+1} with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                     # For later retries, use the cascade
                     elif retry_count < len(MODEL_CASCADE):
                         model_info = MODEL_CASCADE[retry_count]
                         self.logger.info(f"Trying with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                     else:
                         # If we've gone through all models, use the last one with reduced parameters
                         model_info = MODEL_CASCADE[-1]
                         self.logger.info(f"Final retry with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                         # Reduce token count for lighter load
                         generation_config["max_output_tokens"] = 512
                     
                     # For Gemini API
-                    response = await asyncio.to_thread(
-                        model.generate_content,
+                    response = await self.llm_client.generate(
+                        model_name,
                         full_prompt,
-                        generation_config=generation_config
+                        generation_config=generation_config,
+                        tenant_id=self._tenant_id(context)
                     )
                     
                 except Exception as e:
@@ -1492,7 +1548,7 @@ Possible query_type values: direct_product, category_browse, comparison, feature
             "query": query
         }
         
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, user_id or self._tenant_id(context))
         comparison_instructions = """
     Vytvoř podrobné porovnání produktů. Zaměř se na:
     1. Klíčové rozdíly mezi produkty
@@ -1540,19 +1596,20 @@ Possible query_type values: direct_product, category_browse, comparison, feature
                     if retry_count < len(MODEL_CASCADE):
                         model_info = MODEL_CASCADE[retry_count]
                         self.logger.info(f"Trying with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                     else:
                         # If we've gone through all models, use the last one with reduced parameters
                         model_info = MODEL_CASCADE[-1]
                         self.logger.info(f"Final retry with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                         # Reduce token count for lighter load
                         generation_config["max_output_tokens"] = 512
                     
-                    response = await asyncio.to_thread(
-                        model.generate_content,
+                    response = await self.llm_client.generate(
+                        model_name,
                         full_prompt,
-                        generation_config=generation_config
+                        generation_config=generation_config,
+                        tenant_id=user_id or self._tenant_id(context)
                     )
                     
                 except Exception as e:
@@ -1675,7 +1732,7 @@ Possible query_type values: direct_product, category_browse, comparison, feature
             "user_context": context.model_dump() if context else {}
         }
         
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, user_id or self._tenant_id(context))
         recommendation_instructions = """
     Vytvoř personalizované doporučení produktů. Zaměř se na:
     1. Jak doporučené produkty odpovídají požadavkům zákazníka
@@ -1719,19 +1776,20 @@ Possible query_type values: direct_product, category_browse, comparison, feature
                     if retry_count < len(MODEL_CASCADE):
                         model_info = MODEL_CASCADE[retry_count]
                         self.logger.info(f"Trying with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                     else:
                         # If we've gone through all models, use the last one with reduced parameters
                         model_info = MODEL_CASCADE[-1]
                         self.logger.info(f"Final retry with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                         # Reduce token count for lighter load
                         generation_config["max_output_tokens"] = 512
                     
-                    response = await asyncio.to_thread(
-                        model.generate_content,
+                    response = await self.llm_client.generate(
+                        model_name,
                         full_prompt,
-                        generation_config=generation_config
+                        generation_config=generation_config,
+                        tenant_id=user_id or self._tenant_id(context)
                     )
                     
                 except Exception as e:
@@ -1828,7 +1886,7 @@ Possible query_type values: direct_product, category_browse, comparison, feature
             "user_context": context.model_dump() if context else {}
         }
         
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, self._tenant_id(context))
         tech_instructions = """
 Vytvoř podrobné a přístupné vysvětlení technických vlastností. Zaměř se na:
 1. Srozumitelné vysvětlení technických konceptů bez zbytečného žargonu
@@ -1872,19 +1930,20 @@ Use analogies and practical examples to make the explanation understandable to e
                     if retry_count < len(MODEL_CASCADE):
                         model_info = MODEL_CASCADE[retry_count]
                         self.logger.info(f"Trying with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                     else:
                         # If we've gone through all models, use the last one with reduced parameters
                         model_info = MODEL_CASCADE[-1]
                         self.logger.info(f"Final retry with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                         # Reduce token count for lighter load
                         generation_config["max_output_tokens"] = 512
                     
-                    response = await asyncio.to_thread(
-                        model.generate_content,
+                    response = await self.llm_client.generate(
+                        model_name,
                         full_prompt,
-                        generation_config=generation_config
+                        generation_config=generation_config,
+                        tenant_id=self._tenant_id(context)
                     )
                     
                 except Exception as e:
@@ -2032,7 +2091,7 @@ Use analogies and practical examples to make the explanation understandable to e
             "user_context": context.model_dump() if context else {}
         }
         
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, self._tenant_id(context))
         accessory_instructions = """
 Doporuč vhodné příslušenství a doplňkové služby pro dané produkty. Zaměř se na:
 1. Kompatibilitu příslušenství s hlavními produkty
@@ -2082,19 +2141,20 @@ If the customer uses vague references like "this" or "it", use the conversation
                     if retry_count < len(MODEL_CASCADE):
                         model_info = MODEL_CASCADE[retry_count]
                         self.logger.info(f"Trying with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                     else:
                         # If we've gone through all models, use the last one with reduced parameters
                         model_info = MODEL_CASCADE[-1]
                         self.logger.info(f"Final retry with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                         # Reduce token count for lighter load
                         generation_config["max_output_tokens"] = 512
                     
-                    response = await asyncio.to_thread(
-                        model.generate_content,
+                    response = await self.llm_client.generate(
+                        model_name,
                         full_prompt,
-                        generation_config=generation_config
+                        generation_config=generation_config,
+                        tenant_id=self._tenant_id(context)
                     )
                     
                 except Exception as e:
@@ -2225,7 +2285,7 @@ If the customer uses vague references like "this" or "it", use the conversation
             "user_context": context.model_dump() if context else {}
         }
         
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, self._tenant_id(context))
         service_instructions = """
 Odpověz na dotaz zákazníka týkající se zákaznického servisu, dopravy, plateb, reklamací nebo vrácení zboží. Zaměř se na:
 1. Poskytnutí přesných a užitečných informací
@@ -2269,19 +2329,20 @@ If you don't have accurate information, recommend how the customer can obtain it
                     if retry_count < len(MODEL_CASCADE):
                         model_info = MODEL_CASCADE[retry_count]
                         self.logger.info(f"Trying with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                     else:
                         # If we've gone through all models, use the last one with reduced parameters
                         model_info = MODEL_CASCADE[-1]
                         self.logger.info(f"Final retry with {model_info['desc']}")
-                        model = genai.GenerativeModel(model_info['name'])
+                        model_name = model_info['name']
                         # Reduce token count for lighter load
                         generation_config["max_output_tokens"] = 512
                     
-                    response = await asyncio.to_thread(
-                        model.generate_content,
+                    response = await self.llm_client.generate(
+                        model_name,
                         full_prompt,
-                        generation_config=generation_config
+                        generation_config=generation_config,
+                        tenant_id=self._tenant_id(context)
                     )
                     
                 except Exception as e:
@@ -2359,7 +2420,7 @@ If you don't have accurate information, recommend how the customer can obtain it
             "user_context": context.model_dump() if context else {}
         }
         
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, self._tenant_id(context))
         nav_instructions = """
 Pomoz zákazníkovi s navigací na e-shopu. Zaměř se na:
 1. Přesné pokyny, kde požadovaný obsah najít
@@ -2393,11 +2454,12 @@ Be specific but also flexible so the customer can easily follow the navigation t
             }
             
             # Call Gemini API
-            model = genai.GenerativeModel('gemini-1.5-pro')
-            response = await asyncio.to_thread(
-                model.generate_content,
+            model_name = 'gemini-1.5-pro'
+            response = await self.llm_client.generate(
+                model_name,
                 full_prompt,
-                generation_config=generation_config
+                generation_config=generation_config,
+                tenant_id=self._tenant_id(context)
             )
             
             nav_text = response.text.strip()
@@ -2493,7 +2555,7 @@ Be specific but also flexible so the customer can easily follow the navigation t
             "user_context": user_context_data
         }
         
-        system_prompt = await self._get_system_prompt(language)
+        system_prompt = await self._get_system_prompt(language, user_id or self._tenant_id(context))
         general_instructions = """
     Odpověz na obecný dotaz zákazníka. Zaměř se na:
     1. Poskytnutí užitečných informací, které přímo odpovídají na dotaz
@@ -2527,11 +2589,12 @@ Be specific but also flexible so the customer can easily follow the navigation t
             }
             
             # Call Gemini API
-            model = genai.GenerativeModel('gemini-1.5-pro')
-            response = await asyncio.to_thread(
-                model.generate_content,
+            model_name = 'gemini-1.5-pro'
+            response = await self.llm_client.generate(
+                model_name,
                 full_prompt,
-                generation_config=generation_config
+                generation_config=generation_config,
+                tenant_id=user_id or self._tenant_id(context)
             )
             
             general_text = response.text.strip()
@@ -2562,7 +2625,9 @@ Be specific but also flexible so the customer can easily follow the navigation t
     async def _score_products_for_recommendation(self,
                                             products: List[Dict],
                                             entities: Dict[str, Any],
-                                            context: Optional[EnhancedConversationContext] = None
+                                            context: Optional[EnhancedConversationContext] = None,
+                                            query: Optional[str] = None,
+                                            user_id: Optional[str] = None
                                            ) -> List[Dict]:
         """
         Score products for recommendation based on user preferences and requirements.
@@ -2571,12 +2636,19 @@ Be specific but also flexible so the customer can easily follow the navigation t
             products: List of product dictionaries
             entities: Entities extracted from query
             context: Optional conversation context
+            query: Optional user query, compared with the product embeddings for semantic_score
+            user_id: Owner of the products (needed for semantic_score)
             
         Returns:
             List of scored products with score components
         """
         scored_products = []
         
+        # Embedding similarity of the query with every product, in one batch
+        semantic_scores = {}
+        if query and user_id:
+            semantic_scores = await self.knowledge_base.semantic_scores(user_id, query, [str(product.get("_id")) for product in products])
+        
         for product in products:
             # Initialize score components
             score_components = {
@@ -2659,13 +2731,16 @@ Be specific but also flexible so the customer can easily follow the navigation t
             if admin_priority > 0:
                 score_components["admin_priority_score"] = min(admin_priority / 10, 1.0)
             
+            # Semantic similarity (cosine, negative similarity counts as none)
+            score_components["semantic_score"] = max(semantic_scores.get(str(product.get("_id")), 0.0), 0.0)
+            
             # Calculate aggregate score
             weights = {
-                "feature_score": 0.3,
+                "feature_score": 0.25,
                 "price_score": 0.25,
-                "category_score": 0.2,
+                "category_score": 0.15,
                 "brand_score": 0.1,
-                "semantic_score": 0.05,
+                "semantic_score": 0.15,
                 "admin_priority_score": 0.1
             }
             
@@ -2874,8 +2949,7 @@ Be specific but also flexible so the customer can easily follow the navigation t
             
             # Call Gemini API to generate questions
             try:
-                model = genai.GenerativeModel('gemini-1.5-pro')
-                response = await model.generate_content_async(prompt)
+                response = await self.llm_client.generate('gemini-1.5-pro', prompt)
                 if response and response.text:
                     # Process response to get individual questions
                     questions = [q.strip() for q in response.text.strip().split('\n') if q.strip()]
@@ -3704,22 +3778,9 @@ Be specific but also flexible so the customer can easily follow the navigation t
         
         # Use category to infer product domain
         if context.category:
-            # Check if the query contains terms that are likely product references
-            category_terms = {
-                "smartphone": ["telefon", "mobil", "smartphone", "iphone", "samsung", "xiaomi"],
-                "notebook": ["notebook", "laptop", "počítač", "macbook", "lenovo", "hp", "dell"],
-                "televize": ["televize", "tv", "televizor", "smart tv", "led", "oled"],
-                "kolo": ["kolo", "bicykl", "bike", "elektrokolo"],
-                # Add more as needed
-            }
-            
-            # Match terms to the current category
-            if context.category in category_terms:
-                relevant_terms = category_terms[context.category]
-                # Check if any terms exist in the query
-                for term in relevant_terms:
-                    if term.lower() in query.lower():
-                        inferred_products.append(term)
+            # Terms in the query that are likely product references for the current category
+            # (KEYWORD_VOCABULARY["product_term"])
+            inferred_products.extend(match_keywords(query).keywords("product_term", context.category))
         
         # If we already have previous references to products in the context
         if context.attributes and "product_references" in context.attributes:
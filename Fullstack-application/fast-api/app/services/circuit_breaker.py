@@ -0,0 +1,183 @@
+"""
+Per-model circuit breakers for the Gemini client layer.
+
+A breaker tracks the outcome and latency of recent calls in a rolling time window.
+When the error rate (slow calls count as errors) goes over the threshold the breaker
+opens and callers skip the model immediately. After a cool-down it goes half-open and
+lets a few probe calls through; a successful probe closes it again, a failed one
+re-opens it.
+"""
+
+import os
+import time
+from collections import deque
+from typing import Dict, Any, Optional
+from app.utils.logging_config import get_module_logger
+
+logger = get_module_logger(__name__)
+
+# Rolling window (seconds) over which the error rate is computed
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60"))
+# Minimum calls in the window before the breaker may open
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+# Error rate (0-1) at which the breaker opens
+CIRCUIT_ERROR_THRESHOLD = float(os.getenv("CIRCUIT_ERROR_THRESHOLD", "0.5"))
+# Calls slower than this (seconds) count as errors
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "10"))
+# How long the breaker stays open before allowing probes
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+# Concurrent probe calls allowed while half-open
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is attempted on a model whose breaker is open."""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker for a single model.
+    """
+
+    def __init__(self,
+                 name: str,
+                 window_seconds: float = CIRCUIT_WINDOW_SECONDS,
+                 min_calls: int = CIRCUIT_MIN_CALLS,
+                 error_threshold: float = CIRCUIT_ERROR_THRESHOLD,
+                 slow_call_seconds: float = CIRCUIT_SLOW_CALL_SECONDS,
+                 open_seconds: float = CIRCUIT_OPEN_SECONDS,
+                 half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self.state = STATE_CLOSED
+        self.opened_at: Optional[float] = None
+        self.probes_in_flight = 0
+        self.times_opened = 0
+        self.rejected_calls = 0
+        self._calls = deque()  # (timestamp, is_error, latency)
+
+    def _trim(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _open(self, now: float) -> None:
+        self.state = STATE_OPEN
+        self.opened_at = now
+        self.probes_in_flight = 0
+        self.times_opened += 1
+        logger.warning(f"Circuit breaker for {self.name} opened (error rate {self.error_rate():.2f})")
+
+    def _close(self) -> None:
+        self.state = STATE_CLOSED
+        self.opened_at = None
+        self.probes_in_flight = 0
+        self._calls.clear()
+        logger.info(f"Circuit breaker for {self.name} closed")
+
+    def allow_request(self) -> bool:
+        """
+        Check whether a call may go to this model, reserving a probe slot when half-open.
+
+        Returns:
+            True if the call may proceed
+        """
+        now = time.monotonic()
+        if self.state == STATE_OPEN:
+            if now - self.opened_at < self.open_seconds:
+                self.rejected_calls += 1
+                return False
+            self.state = STATE_HALF_OPEN
+            self.probes_in_flight = 0
+            logger.info(f"Circuit breaker for {self.name} half-open, probing")
+
+        if self.state == STATE_HALF_OPEN:
+            if self.probes_in_flight >= self.half_open_probes:
+                self.rejected_calls += 1
+                return False
+            self.probes_in_flight += 1
+        return True
+
+    def record_success(self, latency: float) -> None:
+        """Record a completed call. Calls slower than slow_call_seconds count as errors."""
+        if latency > self.slow_call_seconds:
+            self.record_failure(latency)
+            return
+        if self.state == STATE_HALF_OPEN:
+            self._close()
+            return
+        now = time.monotonic()
+        self._calls.append((now, False, latency))
+        self._trim(now)
+
+    def record_failure(self, latency: Optional[float] = None) -> None:
+        """Record a failed (or too slow) call."""
+        now = time.monotonic()
+        if self.state == STATE_HALF_OPEN:
+            self._open(now)
+            return
+        self._calls.append((now, True, latency))
+        self._trim(now)
+        if self.state == STATE_CLOSED and len(self._calls) >= self.min_calls and self.error_rate() >= self.error_threshold:
+            self._open(now)
+
+    def release(self) -> None:
+        """Give back a half-open probe slot for a call that was cancelled without an outcome."""
+        if self.state == STATE_HALF_OPEN and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
+
+    def error_rate(self) -> float:
+        """Error rate over the rolling window."""
+        if not self._calls:
+            return 0.0
+        return sum(1 for _, is_error, _ in self._calls if is_error) / len(self._calls)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current state for the admin endpoint."""
+        now = time.monotonic()
+        self._trim(now)
+        latencies = sorted(latency for _, _, latency in self._calls if latency is not None)
+        return {
+            "name": self.name,
+            "state": self.state,
+            "calls_in_window": len(self._calls),
+            "error_rate": round(self.error_rate(), 3),
+            "p95_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+            "open_for_seconds": round(now - self.opened_at, 1) if self.opened_at is not None else None,
+            "times_opened": self.times_opened,
+            "rejected_calls": self.rejected_calls
+        }
+
+
+# Registry of breakers by model name
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Get or create the breaker for a model"""
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        breaker = CircuitBreaker(name)
+        _circuit_breakers[name] = breaker
+    return breaker
+
+def get_circuit_breaker_states() -> Dict[str, Dict[str, Any]]:
+    """Snapshot of every known breaker"""
+    return {name: breaker.snapshot() for name, breaker in _circuit_breakers.items()}
+
+def reset_circuit_breaker(name: str) -> bool:
+    """Force a breaker back to closed. Returns False if the breaker doesn't exist."""
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        return False
+    breaker._close()
+    return True
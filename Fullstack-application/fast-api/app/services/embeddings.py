@@ -0,0 +1,74 @@
+"""
+Sentence embeddings for semantic matching (CPU only).
+
+sentence-transformers is optional: if it isn't installed, or EMBEDDINGS_ENABLED is
+false, every function here returns None and callers fall back to exact matching.
+"""
+
+import os
+import asyncio
+from typing import List, Optional, Sequence
+from app.utils.logging_config import get_module_logger
+
+logger = get_module_logger(__name__)
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+    logger.warning("sentence-transformers not installed, semantic matching disabled")
+
+EMBEDDINGS_ENABLED = os.getenv("EMBEDDINGS_ENABLED", "true").lower() == "true"
+# Multilingual model so Czech and English queries share one vector space
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "paraphrase-multilingual-MiniLM-L12-v2")
+
+_embedding_model = None
+_embedding_model_failed = False
+# Serializes the first load so concurrent callers don't each load (or download) the model
+_embedding_model_lock = asyncio.Lock()
+
+def get_embedding_model():
+    """Get or load the SentenceTransformer model, or None if embeddings are unavailable (blocking)"""
+    global _embedding_model, _embedding_model_failed
+    if _embedding_model is not None:
+        return _embedding_model
+    if SentenceTransformer is None or not EMBEDDINGS_ENABLED or _embedding_model_failed:
+        return None
+    try:
+        _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
+        logger.info(f"Loaded embedding model {EMBEDDING_MODEL_NAME}")
+    except Exception as e:
+        _embedding_model_failed = True
+        logger.error(f"Failed to load embedding model {EMBEDDING_MODEL_NAME}: {e}")
+    return _embedding_model
+
+async def load_embedding_model():
+    """Get the model, loading it in a worker thread so the event loop keeps serving requests."""
+    if _embedding_model is not None or SentenceTransformer is None or not EMBEDDINGS_ENABLED or _embedding_model_failed:
+        return _embedding_model
+    async with _embedding_model_lock:
+        return await asyncio.to_thread(get_embedding_model)
+
+async def embed_texts(texts: Sequence[str]) -> Optional[List[List[float]]]:
+    """
+    Embed texts into L2-normalized vectors.
+
+    Args:
+        texts: Texts to embed
+
+    Returns:
+        One vector per text, or None if embeddings are unavailable or encoding failed
+    """
+    model = await load_embedding_model()
+    if model is None or not texts:
+        return None
+    try:
+        vectors = await asyncio.to_thread(model.encode, list(texts), normalize_embeddings=True)
+        return [vector.tolist() for vector in vectors]
+    except Exception as e:
+        logger.error(f"Embedding failed: {e}")
+        return None
+
+def cosine_similarity(a: Sequence[float], b: Sequence[float]) -> float:
+    """Cosine similarity of two L2-normalized vectors."""
+    return sum(x * y for x, y in zip(a, b))
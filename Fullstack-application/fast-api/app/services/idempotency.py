@@ -0,0 +1,124 @@
+"""
+Idempotency keys for chat requests.
+
+The widget retries POSTs on flaky connections. When a request carries an
+`Idempotency-Key` header, its result is shared by every request with the same tenant and
+key: a duplicate that arrives while the first request is still running waits for it
+(single-flight), and one that arrives later gets the stored response for
+IDEMPOTENCY_TTL seconds. Duplicates never reach the pipeline, so they cost no Gemini
+calls, conversation count increments or conversation inserts.
+
+Failed requests are not stored, so a retry after an error runs again. A key reused with
+a different request body is rejected. Keys live in process memory, like the other hot
+path caches (see ttl_cache.py).
+"""
+
+import os
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from app.utils.logging_config import get_module_logger
+from app.utils.ttl_cache import TTLCache
+
+logger = get_module_logger(__name__)
+
+# How long (seconds) a completed response is replayed for its key
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_CACHE_SIZE = 20000
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKeyMismatchError(Exception):
+    """Raised when an idempotency key is reused with a different request body."""
+
+    def __init__(self, key: str):
+        self.key = key
+        super().__init__(f"Idempotency-Key '{key}' was already used for a different request.")
+
+
+def request_fingerprint(payload: Any) -> str:
+    """Stable hash of a request body, to detect keys reused for other requests."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Single-flight execution and short-term replay of responses per (tenant, key).
+    """
+
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL, maxsize: int = IDEMPOTENCY_CACHE_SIZE):
+        # (tenant, key) -> (fingerprint, response)
+        self.responses = TTLCache("idempotency", maxsize=maxsize, ttl=ttl)
+        self._inflight: Dict[Tuple[str, str], Tuple[str, asyncio.Task]] = {}
+        self.replayed = 0
+        self.joined = 0
+
+    async def run(self, tenant: str, key: str, fingerprint: str, handler: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run handler once per (tenant, key) and share its result.
+
+        Args:
+            tenant: Owner user id the request belongs to
+            key: Client supplied Idempotency-Key
+            fingerprint: request_fingerprint of the request body
+            handler: Produces the response (only called for the first request)
+
+        Returns:
+            The response of the first request with this key
+
+        Raises:
+            IdempotencyKeyMismatchError: if the key was used for a different request body
+        """
+        cache_key = (tenant, key[:IDEMPOTENCY_MAX_KEY_LENGTH])
+
+        stored = self.responses.get(cache_key)
+        if stored is not None:
+            stored_fingerprint, response = stored
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyKeyMismatchError(key)
+            self.replayed += 1
+            logger.info(f"Replaying stored response for Idempotency-Key '{key}' of user {tenant}")
+            return response
+
+        inflight = self._inflight.get(cache_key)
+        if inflight is not None:
+            inflight_fingerprint, task = inflight
+            if inflight_fingerprint != fingerprint:
+                raise IdempotencyKeyMismatchError(key)
+            self.joined += 1
+            logger.info(f"Idempotency-Key '{key}' of user {tenant} is in flight, waiting for it")
+            return await asyncio.shield(task)
+
+        # The handler runs in its own task so that the first client disconnecting
+        # (usually the reason for the retry) doesn't cancel the work duplicates wait for
+        task = asyncio.ensure_future(self._complete(cache_key, fingerprint, handler))
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._inflight[cache_key] = (fingerprint, task)
+        return await asyncio.shield(task)
+
+    async def _complete(self, cache_key: Tuple[str, str], fingerprint: str, handler: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            response = await handler()
+            self.responses.set(cache_key, (fingerprint, response))
+            return response
+        finally:
+            self._inflight.pop(cache_key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.responses.stats(),
+            "in_flight": len(self._inflight),
+            "replayed": self.replayed,
+            "joined": self.joined
+        }
+
+
+_idempotency_store: Optional[IdempotencyStore] = None
+
+def get_idempotency_store() -> IdempotencyStore:
+    """Get or create the IdempotencyStore singleton"""
+    global _idempotency_store
+    if _idempotency_store is None:
+        _idempotency_store = IdempotencyStore()
+    return _idempotency_store
@@ -0,0 +1,229 @@
+"""
+Local (CPU only) intent and entity pre-classifier.
+
+Runs before Gemini on every chat message. Keyword rules give an intent with a confidence;
+when the confidence is above the tenant's threshold, chat.py uses this analysis and skips
+extract_entities_with_gemini. Whenever Gemini does run, its intent is recorded against
+the local prediction so per-intent precision/recall can be reported per tenant.
+
+The keyword rules ("intent" and "intent_hint" keywords) and category keywords live in
+app.utils.keyword_matcher.KEYWORD_VOCABULARY and come in as the message's keyword hits.
+"""
+
+import os
+import re
+import random
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+from app.utils.logging_config import get_module_logger
+from app.utils.keyword_matcher import KEYWORD_VOCABULARY, KeywordHits, fold_text, match_keywords
+
+logger = get_module_logger(__name__)
+
+# Default minimum confidence for skipping the Gemini NLU call (tenants may override)
+PRECLASSIFIER_THRESHOLD = float(os.getenv("PRECLASSIFIER_THRESHOLD", "0.85"))
+# Share of confident local predictions that are still checked against Gemini in the background
+PRECLASSIFIER_SHADOW_RATE = float(os.getenv("PRECLASSIFIER_SHADOW_RATE", "0.05"))
+# Evaluation samples kept per tenant
+PRECLASSIFIER_EVAL_WINDOW = 2000
+# Thresholds shown in the precision/recall report
+REPORT_THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95]
+
+# Amount: integer part with optional " "/"." thousands groups, optional decimals, optional unit.
+# ", " ends the number ("do 5000, 2 kusy"); a unit must not run into a word ("2 ks", "5 kg").
+_PRICE_AMOUNT = r"(\d+(?:[ .]\d{3})*)(?:[.,](\d{1,2}))?\s*(k|tis(?:ic(?:e)?)?|kc|czk|korun\w*|eur|€|\$)?(?![a-z0-9])"
+PRICE_MAX_PATTERN = re.compile(r"\b(?:do|pod|max(?:imalne)?|nejvys\w*|under|below|up to|less than)\b\s*" + _PRICE_AMOUNT)
+PRICE_MIN_PATTERN = re.compile(r"\b(?:od|nad|min(?:imalne)?|alespon|from|over|above|at least)\b\s*" + _PRICE_AMOUNT)
+# Units that multiply the amount by a thousand ("20k", "15 tisíc")
+THOUSAND_UNITS = {"k", "tis", "tisic", "tisice"}
+# A bare amount below this without a unit may be thousands, days or pieces ("do 15", "do 5 dnu")
+UNCLEAR_PRICE_BELOW = 1000
+# Order numbers, model numbers or e-mails mean entities we can't extract locally
+UNRESOLVABLE_PATTERN = re.compile(r"[\w.-]+@[\w.-]+|#\s?\d+|\b[a-z]*\d+[a-z]+\w*\b|\b[a-z]+\d+\w*\b")
+# A standalone number after a word, checked on the original text ("iPhone 15 Pro", "Trek Marlin 7")
+MODEL_NUMBER_PATTERN = re.compile(r"\b([^\W\d_]+)\s+\d+\b(?![.,]?\d)")
+
+
+def _parse_price(match: "re.Match") -> Tuple[float, Optional[str]]:
+    """(amount, unit) of a price match, with thousand units applied."""
+    integer, decimals, unit = match.groups()
+    value = float(re.sub(r"[ .]", "", integer) + (f".{decimals}" if decimals else ""))
+    if unit in THOUSAND_UNITS:
+        value *= 1000
+    return value, unit
+
+
+def _names_model(query: str, hits: KeywordHits) -> bool:
+    """Whether a number follows a brand or a capitalized (non sentence-initial) word."""
+    brands = {fold_text(brand) for brand in hits.values("brand")} | set(hits.keywords("phone_brand"))
+    for match in MODEL_NUMBER_PATTERN.finditer(query):
+        word = match.group(1)
+        preceding = query[:match.start()].rstrip()
+        capitalized = word[0].isupper() and preceding and preceding[-1] not in ".!?"
+        if fold_text(word) in brands or capitalized or any(char.isupper() for char in word[1:]):
+            return True
+    return False
+
+
+def _empty_entities() -> Dict[str, Any]:
+    return {
+        "products": [], "categories": [], "features": [], "brands": [],
+        "price_range": {"min": None, "max": None}, "comparison": False,
+        "accessories": [], "service_requests": [], "order_number": None, "email": None
+    }
+
+
+def classify_query(query: str, language: str = "cs", hits: Optional[KeywordHits] = None) -> Dict[str, Any]:
+    """
+    Classify a query with keyword rules.
+
+    Args:
+        query: The user's query text
+        language: Language code (rules cover all vocabulary languages together)
+        hits: Keyword hits of the query (e.g. from the tenant's matcher); the shared
+            vocabulary is matched when omitted
+
+    Returns:
+        Analysis in the extract_entities_with_gemini format with "confidence" and "source": "local"
+    """
+    folded = f" {fold_text(query)} "
+    if hits is None:
+        hits = match_keywords(query)
+    scores: Dict[str, float] = {}
+    for intent in KEYWORD_VOCABULARY["intent"]:
+        strong = hits.count("intent", intent)
+        weak = hits.count("intent_hint", intent)
+        if strong or weak:
+            scores[intent] = strong * 1.0 + weak * 0.35
+
+    entities = _empty_entities()
+    category = hits.first("category")
+    if category:
+        entities["categories"].append(category)
+    # Category and brand names from the tenant's catalog
+    for catalog_category in hits.values("catalog_category"):
+        if catalog_category not in entities["categories"]:
+            entities["categories"].append(catalog_category)
+    entities["brands"].extend(hits.values("brand"))
+    if entities["categories"]:
+        # A bare category mention ("máte kola?") is a product question
+        scores["product_recommendation"] = scores.get("product_recommendation", 0.0) + 0.6
+
+    max_match = PRICE_MAX_PATTERN.search(folded)
+    min_match = PRICE_MIN_PATTERN.search(folded)
+    prices = {}
+    if max_match:
+        prices["max"] = _parse_price(max_match)
+    if min_match:
+        prices["min"] = _parse_price(min_match)
+    # "od 5 do 10 tisíc": the unit of the upper bound also applies to the lower one
+    if "min" in prices and "max" in prices and prices["min"][1] is None and prices["max"][1] in THOUSAND_UNITS:
+        if prices["min"][0] * 1000 <= prices["max"][0]:
+            prices["min"] = (prices["min"][0] * 1000, prices["max"][1])
+    unclear_price = any(unit is None and value < UNCLEAR_PRICE_BELOW for value, unit in prices.values())
+    for bound, (value, _) in prices.items():
+        entities["price_range"][bound] = value
+    if prices:
+        scores["product_recommendation"] = scores.get("product_recommendation", 0.0) + 0.5
+
+    if not scores:
+        return {"intent": "general_question", "entities": entities, "confidence": 0.0, "source": "local"}
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    intent, best = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+
+    # Confidence grows with evidence and with the margin over the next intent
+    confidence = min(0.98, 0.55 + 0.25 * min(best, 2.0) / 2.0 + 0.2 * (best - runner_up) / best)
+    if intent == "product_comparison":
+        entities["comparison"] = True
+    # Named products, model numbers, order numbers or e-mails need Gemini's extraction
+    # (prices like "20k" are already parsed, so they don't count as model numbers)
+    if UNRESOLVABLE_PATTERN.search(PRICE_MIN_PATTERN.sub(" ", PRICE_MAX_PATTERN.sub(" ", folded))) or _names_model(query, hits):
+        confidence *= 0.6
+    # So does a bare small amount that may not be a price at all
+    if unclear_price:
+        confidence *= 0.6
+    # Long queries tend to carry more than we can parse with keywords
+    if len(folded.split()) > 12:
+        confidence *= 0.8
+
+    return {"intent": intent, "entities": entities, "confidence": round(confidence, 3), "source": "local"}
+
+
+class ClassifierEvaluator:
+    """
+    Per-tenant record of local predictions vs Gemini intents, for precision/recall reports.
+    """
+
+    def __init__(self, window: int = PRECLASSIFIER_EVAL_WINDOW):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self.skipped_nlu_calls: Dict[str, int] = {}
+
+    def record(self, tenant: str, predicted_intent: str, confidence: float, actual_intent: str) -> None:
+        samples = self._samples.get(tenant)
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            self._samples[tenant] = samples
+        samples.append((predicted_intent, confidence, actual_intent))
+
+    def record_skip(self, tenant: str) -> None:
+        self.skipped_nlu_calls[tenant] = self.skipped_nlu_calls.get(tenant, 0) + 1
+
+    def report(self, tenant: str, thresholds: List[float] = REPORT_THRESHOLDS) -> Dict[str, Any]:
+        """
+        Precision/recall per intent at each threshold.
+
+        At threshold t a local prediction counts only if its confidence is >= t; recall is
+        measured against all samples where Gemini chose that intent.
+        """
+        samples = list(self._samples.get(tenant, []))
+        actual_counts: Dict[str, int] = {}
+        for _, _, actual in samples:
+            actual_counts[actual] = actual_counts.get(actual, 0) + 1
+
+        by_threshold = []
+        for threshold in thresholds:
+            accepted = [(predicted, actual) for predicted, confidence, actual in samples if confidence >= threshold]
+            per_intent: Dict[str, Dict[str, Any]] = {}
+            for intent in sorted(set(actual_counts) | {predicted for predicted, _ in accepted}):
+                true_positive = sum(1 for predicted, actual in accepted if predicted == intent and actual == intent)
+                predicted_total = sum(1 for predicted, _ in accepted if predicted == intent)
+                per_intent[intent] = {
+                    "precision": round(true_positive / predicted_total, 3) if predicted_total else None,
+                    "recall": round(true_positive / actual_counts[intent], 3) if actual_counts.get(intent) else None,
+                    "predicted": predicted_total,
+                    "actual": actual_counts.get(intent, 0)
+                }
+            by_threshold.append({
+                "threshold": threshold,
+                "coverage": round(len(accepted) / len(samples), 3) if samples else 0.0,
+                "accuracy": round(sum(1 for predicted, actual in accepted if predicted == actual) / len(accepted), 3) if accepted else None,
+                "intents": per_intent
+            })
+
+        return {
+            "samples": len(samples),
+            "skipped_nlu_calls": self.skipped_nlu_calls.get(tenant, 0),
+            "thresholds": by_threshold
+        }
+
+
+_evaluator: Optional[ClassifierEvaluator] = None
+
+def get_classifier_evaluator() -> ClassifierEvaluator:
+    """Get or create the ClassifierEvaluator singleton"""
+    global _evaluator
+    if _evaluator is None:
+        _evaluator = ClassifierEvaluator()
+    return _evaluator
+
+def get_tenant_threshold(user: Dict[str, Any]) -> float:
+    """The tenant's pre-classifier threshold, falling back to PRECLASSIFIER_THRESHOLD."""
+    threshold = user.get("preclassifier_threshold") if user else None
+    return float(threshold) if threshold is not None else PRECLASSIFIER_THRESHOLD
+
+def should_shadow_check() -> bool:
+    """Whether a confident local prediction should also be checked against Gemini."""
+    return random.random() < PRECLASSIFIER_SHADOW_RATE
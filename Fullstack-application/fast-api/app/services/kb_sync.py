@@ -0,0 +1,279 @@
+"""
+Incremental sync of the KnowledgeBase product cache and indexes with MongoDB.
+
+KnowledgeBase loads products_cache and builds its indexes once at startup. This keeps
+them current without full reloads, one product at a time (KnowledgeBase.upsert_product
+and remove_product, which also bump the tenant's cache version):
+
+- Writes made through this process (app/api/products.py calls notify_product_changed)
+  are re-read by _id and applied right away.
+- Writes made by other workers or processes arrive through a MongoDB change stream on
+  the products collection, resumed from the last resume token after errors.
+- When change streams aren't available (standalone mongod without a replica set) the
+  collection is polled for products with a newer `updated_at` every
+  KB_SYNC_POLL_INTERVAL seconds. Polling can't see deletes, so the cached product ids
+  are also reconciled against the collection every KB_SYNC_RECONCILE_INTERVAL seconds.
+
+Applied changes are passed on to the other product listeners (AIService caches) through
+notify_product_changed.
+"""
+
+import os
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+from app.services.knowledge_base import KnowledgeBase, PRODUCT_CACHE_FIELDS
+from app.utils.mongo import register_product_listener, notify_product_changed
+from app.utils.logging_config import get_module_logger
+
+logger = get_module_logger(__name__)
+
+# Set to 0 to disable change streams and always poll
+KB_SYNC_CHANGE_STREAMS = os.getenv("KB_SYNC_CHANGE_STREAMS", "1") != "0"
+KB_SYNC_POLL_INTERVAL = float(os.getenv("KB_SYNC_POLL_INTERVAL", "10"))  # seconds
+KB_SYNC_RECONCILE_INTERVAL = float(os.getenv("KB_SYNC_RECONCILE_INTERVAL", "300"))  # seconds
+KB_SYNC_RETRY_DELAY = 5  # seconds before reopening a failed change stream
+# Server error codes meaning change streams aren't supported by the deployment
+CHANGE_STREAM_UNSUPPORTED_CODES = {40573, 40324, 136}
+
+
+class KnowledgeBaseSync:
+    """
+    Keeps a KnowledgeBase's products_cache and indexes in step with the products collection.
+    """
+
+    def __init__(self, knowledge_base: KnowledgeBase):
+        self.knowledge_base = knowledge_base
+        self.mode: Optional[str] = None  # "change_stream" or "polling" once started
+        self.resume_token = None
+        self.watermark: Optional[datetime] = None  # newest updated_at applied
+        self.applied = 0
+        self.removed = 0
+        self.errors = 0
+        self.last_reconcile: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+        self._forwarding = False
+        register_product_listener(self._on_product_changed)
+
+    @property
+    def collection(self):
+        return self.knowledge_base.product_collection
+
+    def start(self) -> None:
+        """Start following the products collection in the background."""
+        if self._task is None or self._task.done():
+            self.watermark = self._cached_watermark()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        for task in [self._task, *self._pending]:
+            if task is not None:
+                task.cancel()
+        self._task = None
+
+    def _cached_watermark(self) -> Optional[datetime]:
+        timestamps = [
+            product["updated_at"]
+            for user_products in self.knowledge_base.products_cache.values()
+            for product in user_products.values()
+            if isinstance(product.get("updated_at"), datetime)
+        ]
+        return max(timestamps, default=None)
+
+    async def _run(self) -> None:
+        if KB_SYNC_CHANGE_STREAMS:
+            try:
+                await self._follow_change_stream()
+                return
+            except OperationFailure as e:
+                # Only raised for CHANGE_STREAM_UNSUPPORTED_CODES on the first open
+                logger.warning(f"Product change streams unavailable ({e.code}: {e}), polling updated_at instead")
+        await self._poll_forever()
+
+    async def _follow_change_stream(self) -> None:
+        while True:
+            try:
+                async with self.collection.watch(full_document="updateLookup", resume_after=self.resume_token) as stream:
+                    if self.mode != "change_stream":
+                        self.mode = "change_stream"
+                        logger.info("Following product changes through a change stream")
+                        # Catch up on writes between the startup load and opening the stream
+                        await self.poll_once()
+                    async for change in stream:
+                        await self._apply_change(change)
+                        self.resume_token = stream.resume_token
+            except OperationFailure as e:
+                if self.mode is None and e.code in CHANGE_STREAM_UNSUPPORTED_CODES:
+                    raise
+                self.errors += 1
+                logger.error(f"Product change stream failed, reopening in {KB_SYNC_RETRY_DELAY}s: {e}")
+                if e.code == 286:  # ChangeStreamHistoryLost: the resume token is too old
+                    self.resume_token = None
+                    await self.poll_once()
+                    await self.reconcile()
+            except PyMongoError as e:
+                self.errors += 1
+                logger.error(f"Product change stream failed, reopening in {KB_SYNC_RETRY_DELAY}s: {e}")
+            await asyncio.sleep(KB_SYNC_RETRY_DELAY)
+
+    async def _apply_change(self, change: Dict[str, Any]) -> None:
+        operation = change.get("operationType")
+        if operation in ("insert", "update", "replace"):
+            product = change.get("fullDocument")
+            if product is None:
+                # Deleted again before the lookup: the delete event follows
+                return
+            self._upsert(product)
+        elif operation == "delete":
+            self._remove(str(change["documentKey"]["_id"]))
+        elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            logger.warning(f"Products collection {operation}, reloading the product cache")
+            await self.knowledge_base.load_products_cache()
+            await self.knowledge_base.build_indexes()
+            self.resume_token = None
+
+    async def _poll_forever(self) -> None:
+        self.mode = "polling"
+        logger.info(f"Polling products for changes every {KB_SYNC_POLL_INTERVAL}s")
+        loop = asyncio.get_running_loop()
+        next_reconcile = loop.time() + KB_SYNC_RECONCILE_INTERVAL
+        while True:
+            try:
+                await self.poll_once()
+                if loop.time() >= next_reconcile:
+                    await self.reconcile()
+                    next_reconcile = loop.time() + KB_SYNC_RECONCILE_INTERVAL
+            except PyMongoError as e:
+                self.errors += 1
+                logger.error(f"Polling products for changes failed: {e}")
+            await asyncio.sleep(KB_SYNC_POLL_INTERVAL)
+
+    async def poll_once(self) -> int:
+        """
+        Apply products written since the watermark.
+
+        `$gte` re-reads the products at the watermark itself, so writes sharing its
+        timestamp aren't missed; re-applying an unchanged product is a no-op.
+
+        Returns:
+            Number of products that changed the cache
+        """
+        query = {"updated_at": {"$gte": self.watermark}} if self.watermark else {"updated_at": {"$exists": True}}
+        changed = 0
+        async for product in self.collection.find(query, PRODUCT_CACHE_FIELDS).sort("updated_at", 1):
+            changed += self._upsert(product)
+        return changed
+
+    async def reconcile(self) -> int:
+        """
+        Compare cached product ids with the collection: drop deleted products and load
+        products the cache never saw (e.g. written without `updated_at`).
+
+        Returns:
+            Number of products removed or added
+        """
+        stored = {}
+        async for product in self.collection.find({}, {"_id": 1, "user_id": 1}):
+            stored[str(product["_id"])] = str(product.get("user_id", "global"))
+        cached = {
+            product_id: user_id
+            for user_id, user_products in self.knowledge_base.products_cache.items()
+            for product_id in user_products
+        }
+
+        changes = 0
+        for product_id, user_id in cached.items():
+            if product_id not in stored:
+                changes += self._remove(product_id, user_id)
+        missing = [ObjectId(product_id) for product_id in stored if product_id not in cached and ObjectId.is_valid(product_id)]
+        if missing:
+            async for product in self.collection.find({"_id": {"$in": missing}}, PRODUCT_CACHE_FIELDS):
+                changes += self._upsert(product)
+        self.last_reconcile = datetime.utcnow()
+        if changes:
+            logger.info(f"Reconciled product cache with the collection: {changes} products added or removed")
+        return changes
+
+    async def refresh_product(self, product_id: str, user_id: Optional[str] = None) -> bool:
+        """Re-read one product by _id and apply it (or its deletion) to the cache."""
+        if not ObjectId.is_valid(product_id):
+            return False
+        product = await self.collection.find_one({"_id": ObjectId(product_id)}, PRODUCT_CACHE_FIELDS)
+        if product is None:
+            return self._remove(product_id, user_id, forward=False)
+        return self._upsert(product, forward=False)
+
+    def _upsert(self, product: Dict[str, Any], forward: bool = True) -> bool:
+        updated_at = product.get("updated_at")
+        if isinstance(updated_at, datetime) and (self.watermark is None or updated_at > self.watermark):
+            self.watermark = updated_at
+        if not self.knowledge_base.upsert_product(product):
+            return False
+        self.applied += 1
+        if forward:
+            self._forward(product.get("user_id"), str(product["_id"]))
+        return True
+
+    def _remove(self, product_id: str, user_id: Optional[str] = None, forward: bool = True) -> bool:
+        user_id = user_id or self.knowledge_base._cached_owner(product_id)
+        if not self.knowledge_base.remove_product(product_id, user_id):
+            return False
+        self.removed += 1
+        if forward:
+            self._forward(user_id, product_id)
+        return True
+
+    def _forward(self, user_id: Optional[str], product_id: str) -> None:
+        """Let the other product listeners (AIService caches) know about a change made elsewhere."""
+        self._forwarding = True
+        try:
+            notify_product_changed(user_id, product_id)
+        finally:
+            self._forwarding = False
+
+    def _on_product_changed(self, user_id: Optional[str], product_id: str) -> None:
+        """Product written through this process: re-read it without waiting for the stream or poll."""
+        if self._forwarding or self.collection is None:
+            return
+        task = asyncio.get_running_loop().create_task(self.refresh_product(product_id, user_id))
+        self._pending.add(task)
+        task.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, task: asyncio.Task) -> None:
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            logger.error(f"Refreshing a written product failed: {task.exception()}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "watermark": self.watermark,
+            "applied": self.applied,
+            "removed": self.removed,
+            "errors": self.errors,
+            "last_reconcile": self.last_reconcile,
+            "cache_versions": dict(self.knowledge_base.cache_versions)
+        }
+
+
+_knowledge_base_sync: Optional[KnowledgeBaseSync] = None
+
+def start_knowledge_base_sync(knowledge_base: KnowledgeBase) -> KnowledgeBaseSync:
+    """Create the KnowledgeBaseSync singleton for knowledge_base (once) and start it."""
+    global _knowledge_base_sync
+    if _knowledge_base_sync is None:
+        _knowledge_base_sync = KnowledgeBaseSync(knowledge_base)
+    _knowledge_base_sync.start()
+    return _knowledge_base_sync
+
+def get_knowledge_base_sync() -> Optional[KnowledgeBaseSync]:
+    """The running KnowledgeBaseSync, if started"""
+    return _knowledge_base_sync
+
+async def stop_knowledge_base_sync() -> None:
+    if _knowledge_base_sync is not None:
+        await _knowledge_base_sync.stop()
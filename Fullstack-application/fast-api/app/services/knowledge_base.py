@@ -2,14 +2,47 @@
 import yaml
 import os
 import re
+import asyncio
 from typing import Dict, List, Optional, Any, Tuple, Set
 from motor.motor_asyncio import AsyncIOMotorClient
 from app.utils.logging_config import get_module_logger
-from app.utils.mongo import get_product_collection, get_qa_collection, get_widget_faq_collection, serialize_mongo_doc
+from app.utils.mongo import get_product_collection, get_qa_collection, get_widget_faq_collection, serialize_mongo_doc, register_product_listener
+from app.utils.keyword_matcher import KeywordMatcher, vocabulary_entries, catalog_entries
+from app.services.product_query import ProductQuery, from_mongo_filter
+from app.services.product_search import ProductSearchIndex
+from app.services.product_names import ProductNameTable, PRODUCT_NAME_SCORE_CUTOFF
+from app.services.product_embeddings import SemanticProductIndex
 from bson import ObjectId
 
 logger = get_module_logger(__name__)
 
+# Fields kept per product in products_cache (and by the incremental sync, see kb_sync.py).
+# Everything a chat turn reads from a product, so index queries can be served from the cache.
+PRODUCT_CACHE_FIELDS = {
+    "id": 1,
+    "product_name": 1,
+    "description": 1,
+    "category": 1,
+    "business_type": 1,
+    "features": 1,
+    "pricing": 1,
+    "brand": 1,
+    "target_audience": 1,
+    "keywords": 1,
+    "url": 1,
+    "image_url": 1,
+    "stock_information": 1,
+    "metrics": 1,
+    # Prompt and follow-up data (AIService._format_product_data, accessories)
+    "technical_specifications": 1,
+    "pros": 1,
+    "cons": 1,
+    "compatible_accessories": 1,
+    "admin_priority": 1,
+    "updated_at": 1,
+    "user_id": 1  # Make sure to include user_id for tenant filtering
+}
+
 class KnowledgeBase:
     """
     Enhanced knowledge base for retrieving and managing structured information about products, 
@@ -23,6 +56,7 @@ class KnowledgeBase:
         self.widget_faq_collection = None # Added for widget FAQs
         # Tenant-specific caches
         self.products_cache = {}  # user_id -> {product_id -> product}
+        self.products_loaded = False  # products_cache holds every product (index queries are complete)
         self.widget_faqs_cache = {} # Added for widget FAQs: user_id -> {faq_id -> faq}
         self.categories_cache = {}
         self.templates_cache = {}
@@ -34,6 +68,17 @@ class KnowledgeBase:
         self.brand_index = {}    # user_id -> {brand -> [product_ids]}
         self.price_index = {}    # user_id -> {price_range -> [product_ids]}
         self.category_index = {} # user_id -> {category -> [product_ids]}
+        self.search_indexes = {} # user_id -> ProductSearchIndex (BM25 over name, keywords, features, description)
+        self.name_tables = {}    # user_id -> ProductNameTable (normalized names and aliases for fuzzy matching)
+        # Product embeddings; kept across index rebuilds so unchanged products aren't re-encoded
+        self.semantic_index = SemanticProductIndex()
+        # Bumped on every change to a tenant's products_cache entries and indexes
+        self.cache_versions = {}  # user_id -> int
+        
+        # Tenant-specific keyword matchers (shared vocabulary + the tenant's category and brand names)
+        self.keyword_matchers = {}  # user_id -> KeywordMatcher
+        self._vocabulary_entries = vocabulary_entries()
+        register_product_listener(self._on_product_changed)
         
         # Enhanced synonym system for better matching
         self.synonyms = {
@@ -81,17 +126,7 @@ class KnowledgeBase:
             
         try:
             # Use projection to load only essential fields for the cache
-            essential_fields = {
-                "product_name": 1, 
-                "category": 1, 
-                "features": 1, 
-                "pricing": 1,
-                "brand": 1,
-                "admin_priority": 1,
-                "user_id": 1  # Make sure to include user_id for tenant filtering
-            }
-            
-            cursor = self.product_collection.find({}, essential_fields)
+            cursor = self.product_collection.find({}, PRODUCT_CACHE_FIELDS)
             products = await cursor.to_list(length=None)
             
             # Initialize tenant-specific caches
@@ -109,11 +144,14 @@ class KnowledgeBase:
                 # Store product in tenant-specific cache
                 self.products_cache[user_id][product_id] = product
             
+            self.products_loaded = True
+            
             # Log cache stats
             total_products = sum(len(user_products) for user_products in self.products_cache.values())
             self.logger.info(f"Loaded {total_products} products into tenant-specific cache for {len(self.products_cache)} tenants")
             
         except Exception as e:
+            self.products_loaded = False
             self.logger.error(f"Error loading products cache: {str(e)}")
     
     async def load_qa_cache(self):
@@ -193,55 +231,18 @@ class KnowledgeBase:
             self.brand_index = {}
             self.price_index = {}
             self.category_index = {}
+            self.search_indexes = {}
+            self.name_tables = {}
             
             # Process each product and build tenant-specific indexes
             for user_id, user_products in self.products_cache.items():
-                # Initialize indexes for this tenant
-                if user_id not in self.feature_index:
-                    self.feature_index[user_id] = {}
-                    self.brand_index[user_id] = {}
-                    self.price_index[user_id] = {}
-                    self.category_index[user_id] = {}
-                
-                # Process each product for this tenant
                 for product_id, product in user_products.items():
-                    # Index by features
-                    for feature in product.get("features", []):
-                        feature_key = feature.lower()
-                        if feature_key not in self.feature_index[user_id]:
-                            self.feature_index[user_id][feature_key] = []
-                        self.feature_index[user_id][feature_key].append(product_id)
-                    
-                    # Index by brand
-                    if "brand" in product:
-                        brand_key = product["brand"].lower()
-                        if brand_key not in self.brand_index[user_id]:
-                            self.brand_index[user_id][brand_key] = []
-                        self.brand_index[user_id][brand_key].append(product_id)
-                    
-                    # Index by price ranges (in 1000 CZK increments)
-                    price = self._get_price_value(product)
-                    if price is not None:
-                        price_range = int(price / 1000) * 1000  # Group by 1000s
-                        if price_range not in self.price_index[user_id]:
-                            self.price_index[user_id][price_range] = []
-                        self.price_index[user_id][price_range].append(product_id)
-                    
-                    # Index by category
-                    if "category" in product:
-                        category_key = product["category"].lower()
-                        if category_key not in self.category_index[user_id]:
-                            self.category_index[user_id][category_key] = []
-                        self.category_index[user_id][category_key].append(product_id)
-                        
-                        # Also index by category synonyms
-                        for category, synonyms in self.synonyms.items():
-                            if category_key == category.lower():
-                                for synonym in synonyms:
-                                    synonym_key = synonym.lower()
-                                    if synonym_key not in self.category_index[user_id]:
-                                        self.category_index[user_id][synonym_key] = []
-                                    self.category_index[user_id][synonym_key].append(product_id)
+                    self._index_product(user_id, product_id, product)
+                self._bump_version(user_id)
+            self.semantic_index.prune(self.products_cache)
+            
+            # Catalog vocabulary may have changed
+            self.keyword_matchers = {}
             
             # Log index stats
             tenant_count = len(self.feature_index)
@@ -256,6 +257,329 @@ class KnowledgeBase:
         except Exception as e:
             self.logger.error(f"Error building indexes: {str(e)}")
     
+    def _index_keys(self, product: Dict) -> List[Tuple[Dict, Any]]:
+        """(index, key) pairs a cached product is listed under."""
+        keys = []
+        # Index by features
+        for feature in product.get("features", []):
+            keys.append((self.feature_index, feature.lower()))
+        # Index by brand
+        if "brand" in product:
+            keys.append((self.brand_index, product["brand"].lower()))
+        # Index by price ranges (in 1000 CZK increments)
+        price = self._get_price_value(product)
+        if price is not None:
+            keys.append((self.price_index, int(price / 1000) * 1000))  # Group by 1000s
+        # Index by category, also under the category's synonyms
+        if "category" in product:
+            category_key = product["category"].lower()
+            keys.append((self.category_index, category_key))
+            for category, synonyms in self.synonyms.items():
+                if category_key == category.lower():
+                    keys.extend((self.category_index, synonym.lower()) for synonym in synonyms)
+        return keys
+    
+    def _index_product(self, user_id: str, product_id: str, product: Dict) -> None:
+        for index in (self.feature_index, self.brand_index, self.price_index, self.category_index):
+            index.setdefault(user_id, {})
+        for index, key in self._index_keys(product):
+            index[user_id].setdefault(key, []).append(product_id)
+        self.search_indexes.setdefault(user_id, ProductSearchIndex()).add(product_id, product)
+        self.name_tables.setdefault(user_id, ProductNameTable()).add(product_id, product)
+        self.semantic_index.update(user_id, product_id, product)
+    
+    def _unindex_product(self, user_id: str, product_id: str, product: Dict) -> None:
+        for index, key in self._index_keys(product):
+            product_ids = index.get(user_id, {}).get(key)
+            if product_ids and product_id in product_ids:
+                product_ids.remove(product_id)
+                if not product_ids:
+                    del index[user_id][key]
+        if user_id in self.search_indexes:
+            self.search_indexes[user_id].remove(product_id)
+        if user_id in self.name_tables:
+            self.name_tables[user_id].remove(product_id)
+    
+    def _bump_version(self, user_id: str) -> int:
+        self.cache_versions[user_id] = self.cache_versions.get(user_id, 0) + 1
+        return self.cache_versions[user_id]
+    
+    def cache_version(self, user_id: str) -> int:
+        """Version of the tenant's cached products and indexes (0 if nothing is cached)."""
+        return self.cache_versions.get(user_id, 0)
+    
+    def upsert_product(self, product: Dict) -> bool:
+        """
+        Apply an inserted or updated product document to products_cache and the indexes.
+        
+        Args:
+            product: Product document (at least PRODUCT_CACHE_FIELDS and _id)
+            
+        Returns:
+            True if the tenant's cache changed (and its version was bumped)
+        """
+        user_id = str(product.get("user_id", "global"))
+        product_id = str(product["_id"])
+        product = {field: product[field] for field in ("_id", *PRODUCT_CACHE_FIELDS) if field in product}
+        
+        # A product can't move between tenants through the API, but don't leave a stale copy behind
+        previous_owner = self._cached_owner(product_id)
+        if previous_owner is not None and previous_owner != user_id:
+            self.remove_product(product_id, previous_owner)
+        
+        user_products = self.products_cache.setdefault(user_id, {})
+        cached = user_products.get(product_id)
+        if cached is not None:
+            if all(cached.get(field) == product.get(field) for field in PRODUCT_CACHE_FIELDS):
+                return False
+            self._unindex_product(user_id, product_id, cached)
+        user_products[product_id] = product
+        self._index_product(user_id, product_id, product)
+        self._catalog_changed(user_id)
+        return True
+    
+    def remove_product(self, product_id: str, user_id: Optional[str] = None) -> bool:
+        """
+        Drop a deleted product from products_cache and the indexes.
+        
+        Args:
+            product_id: str of the product's _id
+            user_id: Owner, looked up in the cache when not known (e.g. change stream deletes)
+            
+        Returns:
+            True if the product was cached
+        """
+        user_id = user_id or self._cached_owner(product_id)
+        cached = self.products_cache.get(user_id, {}).pop(product_id, None) if user_id else None
+        if cached is None:
+            return False
+        self._unindex_product(user_id, product_id, cached)
+        self.semantic_index.remove(user_id, product_id)
+        self._catalog_changed(user_id)
+        return True
+    
+    def _cached_owner(self, product_id: str) -> Optional[str]:
+        for user_id, user_products in self.products_cache.items():
+            if product_id in user_products:
+                return user_id
+        return None
+    
+    def _catalog_changed(self, user_id: str) -> None:
+        self._bump_version(user_id)
+        # Category and brand vocabulary may have changed
+        self.keyword_matchers.pop(user_id, None)
+    
+    def _category_terms(self, category: str) -> List[str]:
+        """The category and, if it belongs to a synonym group, the whole group (lowercased)."""
+        category_lower = category.lower()
+        terms = [category_lower]
+        for cat, syns in self.synonyms.items():
+            if category_lower == cat.lower() or category_lower in [s.lower() for s in syns]:
+                terms.extend(term.lower() for term in [cat] + syns)
+        return list(dict.fromkeys(terms))
+    
+    def query_products(self, user_id: Optional[str], query: ProductQuery, limit: int = 10) -> Optional[List[Dict]]:
+        """
+        Answer a ProductQuery from the tenant's in-memory indexes.
+        
+        Each constraint narrows a candidate id set (union within a constraint, intersection
+        across constraints); only the candidates are read for the exact price and
+        admin_priority checks. Results are sorted by admin_priority (descending), ties in
+        insertion order like the Mongo queries they replace.
+        
+        Returns:
+            Matching products, or None if the cache can't answer (products not loaded or no
+            tenant given), in which case the caller should query Mongo
+        """
+        if not self.products_loaded or not user_id:
+            return None
+        user_products = self.products_cache.get(user_id)
+        if not user_products:
+            return []
+        
+        candidates: Optional[Set[str]] = None
+        def narrow(product_ids) -> None:
+            nonlocal candidates
+            candidates = set(product_ids) if candidates is None else candidates.intersection(product_ids)
+        
+        if query.categories is not None:
+            category_index = self.category_index.get(user_id, {})
+            terms = {term for category in query.categories for term in self._category_terms(category)}
+            narrow(product_id for term in terms for product_id in category_index.get(term, ()))
+        if query.brands is not None:
+            brand_index = self.brand_index.get(user_id, {})
+            narrow(product_id for brand in query.brands for product_id in brand_index.get(brand, ()))
+        for feature in query.features:
+            narrow(self.feature_index.get(user_id, {}).get(feature, ()))
+            if not candidates:
+                return []
+        if query.has_price_range:
+            low = int(query.price_min / 1000) * 1000 if query.price_min is not None else float("-inf")
+            high = query.price_max if query.price_max is not None else float("inf")
+            narrow(
+                product_id
+                for bucket, product_ids in self.price_index.get(user_id, {}).items()
+                if low <= bucket <= high
+                for product_id in product_ids
+            )
+        
+        product_ids = user_products.keys() if candidates is None else candidates
+        matches = []
+        for product_id in product_ids:
+            product = user_products.get(product_id)
+            if product is None or product_id in query.exclude_ids:
+                continue
+            if query.min_admin_priority is not None and not (product.get("admin_priority") or 0) > query.min_admin_priority:
+                continue
+            if query.has_price_range:
+                price = self._get_price_value(product)
+                if price is None or (query.price_min is not None and price < query.price_min) or (query.price_max is not None and price > query.price_max):
+                    continue
+            matches.append(product)
+        # ObjectIds grow with insertion time, so ties keep Mongo's natural order
+        matches.sort(key=lambda product: (-(product.get("admin_priority") or 0), str(product["_id"])))
+        return matches[:limit]
+    
+    def search_cached_products(self, user_id: Optional[str], text: str, limit: int = 5, query: Optional[ProductQuery] = None) -> Optional[List[Dict]]:
+        """
+        Rank the tenant's products against free text with its BM25 index.
+        
+        Args:
+            user_id: Tenant whose products are searched
+            text: Search text
+            limit: Maximum number of results
+            query: Optional filters the results must also match
+            
+        Returns:
+            Matching products (best first, admin_priority breaking ties), or None if the
+            cache can't answer and the caller should query Mongo
+        """
+        if not self.products_loaded or not user_id:
+            return None
+        search_index = self.search_indexes.get(user_id)
+        if search_index is None:
+            return []
+        allowed = None
+        if query is not None:
+            allowed = {str(product["_id"]) for product in self.query_products(user_id, query, limit=len(search_index))}
+        user_products = self.products_cache.get(user_id, {})
+        ranked = [
+            (score, user_products[product_id])
+            for product_id, score in search_index.search(text, limit, allowed)
+            if product_id in user_products
+        ]
+        ranked.sort(key=lambda item: (-round(item[0], 6), -(item[1].get("admin_priority") or 0)))
+        return [product for _, product in ranked]
+    
+    def resolve_product_names(self, user_id: Optional[str], names: List[str], limit: int = 3, score_cutoff: float = PRODUCT_NAME_SCORE_CUTOFF) -> Optional[List[List[Tuple[Dict, float]]]]:
+        """
+        Fuzzy-match product names against the tenant's name table in one batch.
+        
+        Args:
+            user_id: Tenant whose products are matched
+            names: Product names as mentioned by the user
+            limit: Maximum matches per name
+            score_cutoff: Minimum match score (0-100)
+            
+        Returns:
+            Per name, (product, score) pairs best first, or None if the cache can't answer
+        """
+        if not self.products_loaded or not user_id:
+            return None
+        name_table = self.name_tables.get(user_id)
+        if name_table is None:
+            return [[] for _ in names]
+        user_products = self.products_cache.get(user_id, {})
+        return [
+            [(user_products[match.product_id], match.score) for match in matches if match.product_id in user_products]
+            for matches in name_table.resolve(names, limit, score_cutoff)
+        ]
+    
+    async def find_products_by_names(self, product_names: List[str], user_id: Optional[str] = None, limit: int = 3) -> List[Dict]:
+        """
+        Find the products named in one message.
+        
+        All names are resolved with one fuzzy match over the tenant's name table; names
+        without a confident match fall back to find_products_by_name (BM25 or Mongo).
+        
+        Returns:
+            Matching products in the order the names were given, without duplicates
+        """
+        resolved = self.resolve_product_names(user_id, product_names, limit)
+        if resolved is None:
+            resolved = [[] for _ in product_names]
+        unresolved = [index for index, matches in enumerate(resolved) if not matches]
+        fallbacks = await asyncio.gather(*(
+            self.find_products_by_name(product_names[index], user_id=user_id, limit=limit) for index in unresolved
+        ))
+        per_name = [[product for product, _ in matches] for matches in resolved]
+        for index, products in zip(unresolved, fallbacks):
+            per_name[index] = products
+        
+        products, seen = [], set()
+        for matches in per_name:
+            for product in matches:
+                product_id = str(product.get("_id"))
+                if product_id not in seen:
+                    seen.add(product_id)
+                    products.append(product)
+        return products
+    
+    async def find_products_semantic(self, text: str, user_id: Optional[str] = None, limit: int = 5, query: Optional[ProductQuery] = None) -> List[Dict]:
+        """
+        Find the tenant's products closest in meaning to free text (embedding similarity).
+        
+        Args:
+            text: Query text
+            user_id: Tenant whose products are searched
+            limit: Maximum number of results
+            query: Optional filters the results must also match
+            
+        Returns:
+            Matching products, most similar first; empty if semantic retrieval is unavailable
+        """
+        if not self.products_loaded or not user_id:
+            return []
+        allowed = None
+        if query is not None:
+            allowed = {str(product["_id"]) for product in self.query_products(user_id, query, limit=len(self.products_cache.get(user_id, {})))}
+        ranked = await self.semantic_index.search(user_id, [text], limit, allowed)
+        if not ranked:
+            return []
+        user_products = self.products_cache.get(user_id, {})
+        return [user_products[product_id] for product_id, _ in ranked[0] if product_id in user_products]
+    
+    async def semantic_scores(self, user_id: Optional[str], text: str, product_ids: List[str]) -> Dict[str, float]:
+        """Embedding similarity (cosine) of a query with each product; products without a vector are left out."""
+        if not user_id:
+            return {}
+        return await self.semantic_index.similarities(user_id, text, product_ids)
+    
+    def keyword_matcher(self, user_id: str) -> KeywordMatcher:
+        """
+        Get the tenant's compiled keyword matcher, building it on first use.
+        
+        Besides the shared vocabulary it matches the tenant's category names (including
+        synonyms) as "catalog_category" and brand names as "brand".
+        """
+        matcher = self.keyword_matchers.get(user_id)
+        if matcher is None:
+            matcher = KeywordMatcher(
+                self._vocabulary_entries
+                + catalog_entries("catalog_category", self.category_index.get(user_id, {}).keys())
+                + catalog_entries("brand", self.brand_index.get(user_id, {}).keys())
+            )
+            self.keyword_matchers[user_id] = matcher
+            self.logger.debug(f"Compiled keyword matcher for user {user_id} with {len(matcher)} keywords")
+        return matcher
+    
+    def _on_product_changed(self, user_id: Optional[str], product_id: str) -> None:
+        """Drop compiled keyword matchers whose catalog vocabulary may have changed."""
+        if user_id is None:
+            self.keyword_matchers = {}
+        else:
+            self.keyword_matchers.pop(user_id, None)
+    
     async def find_product_by_id(self, product_id: str, user_id: Optional[str] = None) -> Optional[Dict]:
         """Find a product by its ID with enhanced error handling and tenant filtering."""
         try:
@@ -294,6 +618,10 @@ class KnowledgeBase:
         """Find products by name using enhanced text search, filtered by user_id."""
         self.logger.debug(f"Finding products with user_id={user_id}, query={product_name}")
         try:
+            products = self.search_cached_products(user_id, product_name, limit)
+            if products is not None:
+                return products
+            
             # Base filter
             filter_query = {}
             if user_id:
@@ -353,6 +681,10 @@ class KnowledgeBase:
         """Find products by category with synonym support, filtered by user_id."""
         self.logger.debug(f"Finding products with user_id={user_id}, query={category}")
         try:
+            products = self.query_products(user_id, ProductQuery(categories=[category]), limit)
+            if products is not None:
+                return products
+            
             # Base filter
             filter_query = {}
             if user_id:
@@ -406,6 +738,14 @@ class KnowledgeBase:
                                   sort_direction: int = 1) -> List[Dict]:
         """Find products by custom query with improved sorting, filtered by user_id."""
         try:
+            # Served from the indexes when the filter and sort allow it
+            if sort_by in (None, "admin_priority") and (sort_by is None or sort_direction == -1):
+                product_query = from_mongo_filter(query)
+                if product_query is not None:
+                    products = self.query_products(user_id, product_query, limit)
+                    if products is not None:
+                        return products
+            
             # Base filter
             filter_query = {}
             if user_id:
@@ -496,6 +836,13 @@ class KnowledgeBase:
             List of matching products
         """
         try:
+            # BM25 over the in-memory index when the filters can be evaluated there too
+            product_query = from_mongo_filter(filters) if filters else None
+            if not filters or product_query is not None:
+                products = self.search_cached_products(user_id, query, limit, product_query)
+                if products is not None:
+                    return products
+
             # Base filter
             base_filter = {}
             if user_id:
@@ -796,6 +1143,19 @@ class KnowledgeBase:
     async def get_recommended_products(self, user_id: Optional[str] = None, limit: int = 5) -> List[Dict]:
         """Get recommended products based on admin priority and popularity, filtered by user_id."""
         try:
+            recommended = self.query_products(user_id, ProductQuery(min_admin_priority=0), limit)
+            if recommended is not None:
+                if len(recommended) < limit:
+                    recommended_ids = {str(product["_id"]) for product in recommended}
+                    popular = [product for product_id, product in self.products_cache.get(user_id, {}).items() if product_id not in recommended_ids]
+                    # Same order as sorting on metrics.user_satisfaction descending (missing values last)
+                    def popularity(product):
+                        satisfaction = (product.get("metrics") or {}).get("user_satisfaction")
+                        return (satisfaction is None, -(satisfaction or 0), str(product["_id"]))
+                    popular.sort(key=popularity)
+                    recommended.extend(popular[:limit - len(recommended)])
+                return recommended
+            
             # Base filter with tenant isolation
             filter_query = {}
             if user_id:
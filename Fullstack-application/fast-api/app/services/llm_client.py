@@ -0,0 +1,415 @@
+"""
+Shared Gemini client layer used by every AIService call site.
+
+- Uses the native async transport (`generate_content_async`, grpc.aio) instead of
+  running the blocking `generate_content` in the default thread pool, so LLM calls no
+  longer compete with other `asyncio.to_thread` users.
+- Keeps one `GenerativeModel` per model name, so the underlying channel and its
+  keep-alive connections are reused across requests.
+- Enforces a global and a per-tenant in-flight limit so a burst from one tenant can't
+  take every Gemini slot.
+- Runs model cascades under a per-request latency budget: if the current model hasn't
+  answered by its observed p95 latency a hedged request goes to the next model and the
+  first valid answer wins. Failures move on immediately instead of sleeping.
+- Consults a per-model circuit breaker (see circuit_breaker.py) so models that are
+  failing or rate-limited are skipped without paying for the attempt.
+- Sends only the part after the system prompt when Gemini cached content exists for it
+  (see PromptPrefix in prompt_registry.py).
+"""
+
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, AsyncIterator, Callable, List, Tuple
+import google.generativeai as genai
+from app.utils.logging_config import get_module_logger
+from app.services.circuit_breaker import get_circuit_breaker, CircuitOpenError
+
+logger = get_module_logger(__name__)
+
+# Maximum concurrent Gemini calls for the whole process
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "64"))
+# Maximum concurrent Gemini calls for a single tenant (website owner)
+LLM_MAX_INFLIGHT_PER_TENANT = int(os.getenv("LLM_MAX_INFLIGHT_PER_TENANT", "16"))
+# Total time (seconds) a chat turn may spend waiting on Gemini before degrading to fallbacks
+CHAT_LATENCY_BUDGET = float(os.getenv("CHAT_LATENCY_BUDGET", "12"))
+# Hedge delay used until a model has enough latency samples for a p95
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "3.0"))
+# Longest gap (seconds) allowed between two chunks of a stream that has started answering
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", "10"))
+LLM_HEDGE_MIN_DELAY = 0.25  # seconds, never hedge faster than this
+LLM_LATENCY_WINDOW = 200  # successful calls kept per model for the p95
+LLM_LATENCY_MIN_SAMPLES = 20
+
+
+class LatencyBudget:
+    """
+    Wall-clock budget for all LLM work of one chat request.
+    """
+
+    def __init__(self, seconds: float = CHAT_LATENCY_BUDGET):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """Seconds left in the budget (never negative)."""
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def slice(self, share: float) -> float:
+        """Seconds for one stage, given as a share of what is left."""
+        return self.remaining() * share
+
+
+class GeminiClient:
+    """
+    Async Gemini client with model reuse and in-flight limits.
+    """
+
+    def __init__(self, max_inflight: int = LLM_MAX_INFLIGHT, max_inflight_per_tenant: int = LLM_MAX_INFLIGHT_PER_TENANT):
+        self.max_inflight = max_inflight
+        self.max_inflight_per_tenant = max_inflight_per_tenant
+        self._models: Dict[str, genai.GenerativeModel] = {}
+        self._global_slots = asyncio.Semaphore(max_inflight)
+        self._tenant_slots: Dict[str, asyncio.Semaphore] = {}
+        self._tenant_inflight: Dict[str, int] = {}
+        self._inflight = 0
+        self._latencies: Dict[str, deque] = {}
+        self.hedged_requests = 0
+
+    def get_model(self, model_name: str) -> genai.GenerativeModel:
+        """Get the cached GenerativeModel for a model name, creating it on first use."""
+        model = self._models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            self._models[model_name] = model
+        return model
+
+    def _resolve_prompt(self, model_name: str, prompt: str, prefix=None) -> Tuple[genai.GenerativeModel, str]:
+        """
+        Pick the model object and the text to send.
+
+        If `prefix` (a PromptPrefix) has cached content for this model and the prompt starts
+        with its text, the prefix is served from the cache and only the rest is sent.
+        """
+        cached = prefix.cached_for(model_name) if prefix is not None else None
+        if cached is not None and prompt.startswith(prefix.text):
+            return genai.GenerativeModel.from_cached_content(cached_content=cached), prompt[len(prefix.text):].lstrip()
+        return self.get_model(model_name), prompt
+
+    @asynccontextmanager
+    async def _slot(self, tenant_id: Optional[str]):
+        """
+        Hold one global slot (and one tenant slot if tenant_id is given) for the duration of a call.
+
+        The tenant slot is taken first, so requests waiting on their own tenant's limit
+        don't sit on global slots other tenants could use.
+        """
+        tenant_slots = None
+        if tenant_id:
+            tenant_slots = self._tenant_slots.get(tenant_id)
+            if tenant_slots is None:
+                tenant_slots = asyncio.Semaphore(self.max_inflight_per_tenant)
+                self._tenant_slots[tenant_id] = tenant_slots
+            await tenant_slots.acquire()
+        try:
+            async with self._global_slots:
+                self._inflight += 1
+                if tenant_id:
+                    self._tenant_inflight[tenant_id] = self._tenant_inflight.get(tenant_id, 0) + 1
+                try:
+                    yield
+                finally:
+                    self._inflight -= 1
+                    if tenant_id:
+                        self._tenant_inflight[tenant_id] -= 1
+                        if not self._tenant_inflight[tenant_id]:
+                            del self._tenant_inflight[tenant_id]
+        finally:
+            if tenant_slots is not None:
+                tenant_slots.release()
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None, tenant_id: Optional[str] = None, prefix=None):
+        """
+        Run a single (non-streaming) Gemini call.
+
+        Args:
+            model_name: Gemini model name (see MODEL_CASCADE in ai_service)
+            prompt: Full prompt text
+            generation_config: Gemini generation config
+            tenant_id: Owner user id the call is made for, used for the per-tenant limit
+            prefix: Optional PromptPrefix the prompt starts with (system prompt)
+
+        Returns:
+            The Gemini response object
+
+        Raises:
+            CircuitOpenError: if the model's circuit breaker is open
+        """
+        # Resolve first: allow_request() may reserve the half-open probe, which only the try below gives back
+        model, prompt = self._resolve_prompt(model_name, prompt, prefix)
+        breaker = get_circuit_breaker(model_name)
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"Circuit open for {model_name}")
+        try:
+            async with self._slot(tenant_id):
+                start = time.monotonic()
+                response = await model.generate_content_async(prompt, generation_config=generation_config)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        latency = time.monotonic() - start
+        breaker.record_success(latency)
+        self.record_latency(model_name, latency)
+        return response
+
+    async def stream(self, model_name: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None, tenant_id: Optional[str] = None, prefix=None) -> AsyncIterator[str]:
+        """
+        Stream a Gemini call, yielding text chunks. The in-flight slot is held until the stream ends.
+
+        Args:
+            model_name: Gemini model name
+            prompt: Full prompt text
+            generation_config: Gemini generation config
+            tenant_id: Owner user id the call is made for
+            prefix: Optional PromptPrefix the prompt starts with (system prompt)
+
+        Yields:
+            Non-empty text chunks
+
+        Raises:
+            CircuitOpenError: if the model's circuit breaker is open
+        """
+        model, prompt = self._resolve_prompt(model_name, prompt, prefix)
+        breaker = get_circuit_breaker(model_name)
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"Circuit open for {model_name}")
+        first_chunk_latency = None
+        try:
+            async with self._slot(tenant_id):
+                start = time.monotonic()
+                response = await model.generate_content_async(prompt, generation_config=generation_config, stream=True)
+                async for chunk in response:
+                    text = getattr(chunk, "text", None)
+                    if text:
+                        if first_chunk_latency is None:
+                            first_chunk_latency = time.monotonic() - start
+                            self.record_latency(model_name, first_chunk_latency)
+                        yield text
+        except (asyncio.CancelledError, GeneratorExit):
+            # Abandoned by the caller (timeout or client gone): only count it if the model was slow
+            if first_chunk_latency is None:
+                breaker.release()
+            else:
+                breaker.record_success(first_chunk_latency)
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success(first_chunk_latency if first_chunk_latency is not None else time.monotonic() - start)
+
+    def record_latency(self, model_name: str, seconds: float) -> None:
+        """Record the latency of a successful call."""
+        samples = self._latencies.get(model_name)
+        if samples is None:
+            samples = deque(maxlen=LLM_LATENCY_WINDOW)
+            self._latencies[model_name] = samples
+        samples.append(seconds)
+
+    def latency_p95(self, model_name: str) -> Optional[float]:
+        """Observed p95 latency for a model, or None while there are too few samples."""
+        samples = self._latencies.get(model_name)
+        if not samples or len(samples) < LLM_LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def hedge_delay(self, model_name: str) -> float:
+        """How long to wait for a model before hedging to the next one."""
+        p95 = self.latency_p95(model_name)
+        return max(LLM_HEDGE_MIN_DELAY, p95 if p95 is not None else LLM_HEDGE_DEFAULT_DELAY)
+
+    async def generate_hedged(self,
+                              model_names: List[str],
+                              prompt: str,
+                              generation_config: Optional[Dict[str, Any]] = None,
+                              tenant_id: Optional[str] = None,
+                              timeout: Optional[float] = None,
+                              parse: Optional[Callable[[Any], Any]] = None,
+                              label: str = "LLM call",
+                              prefix=None) -> Tuple[Any, Optional[str]]:
+        """
+        Run a model cascade with hedging under a timeout.
+
+        The first model is called immediately. If it hasn't answered within its hedge delay
+        (observed p95), the next model is started as well; a failed or invalid answer starts
+        the next model right away. The first valid result wins and the other calls are cancelled.
+
+        Args:
+            model_names: Models in cascade order
+            prompt: Full prompt text
+            generation_config: Gemini generation config
+            tenant_id: Owner user id, for the per-tenant in-flight limit
+            timeout: Seconds to wait in total (None = no limit)
+            parse: Turns a response into a result; returning None or raising marks it invalid
+            label: Name used in log messages
+            prefix: Optional PromptPrefix the prompt starts with (system prompt)
+
+        Returns:
+            Tuple of (result, model_name), or (None, None) if nothing valid arrived in time
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        queue = list(model_names)
+        pending: Dict[asyncio.Task, str] = {}
+        last_launch = {"model": None, "at": 0.0}
+
+        def launch():
+            model_name = queue.pop(0)
+            task = asyncio.create_task(self.generate(model_name, prompt, generation_config=generation_config, tenant_id=tenant_id, prefix=prefix))
+            pending[task] = model_name
+            last_launch["model"] = model_name
+            last_launch["at"] = loop.time()
+
+        launch()
+        try:
+            while pending:
+                now = loop.time()
+                remaining = deadline - now if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    logger.warning(f"{label}: latency budget exhausted with {len(pending)} call(s) pending")
+                    break
+
+                hedge_in = None
+                if queue:
+                    hedge_in = max(0.0, last_launch["at"] + self.hedge_delay(last_launch["model"]) - now)
+                waits = [w for w in (remaining, hedge_in) if w is not None]
+                done, _ = await asyncio.wait(
+                    pending.keys(),
+                    timeout=min(waits) if waits else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if not done:
+                    if queue and hedge_in is not None and loop.time() >= last_launch["at"] + self.hedge_delay(last_launch["model"]):
+                        self.hedged_requests += 1
+                        logger.info(f"{label}: {last_launch['model']} slower than its p95, hedging to {queue[0]}")
+                        launch()
+                    continue
+
+                for task in done:
+                    model_name = pending.pop(task)
+                    try:
+                        response = task.result()
+                        result = parse(response) if parse else response
+                    except CircuitOpenError:
+                        logger.info(f"{label}: skipping {model_name}, circuit open")
+                        result = None
+                    except Exception as e:
+                        logger.warning(f"{label}: {model_name} failed: {str(e)}")
+                        result = None
+                    if result is not None:
+                        return result, model_name
+                    logger.warning(f"{label}: no valid answer from {model_name}")
+                    # Don't wait for the hedge timer of a call that may still be pending
+                    if queue:
+                        launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        return None, None
+
+    async def stream_with_fallback(self,
+                                   model_names: List[str],
+                                   prompt: str,
+                                   generation_config: Optional[Dict[str, Any]] = None,
+                                   tenant_id: Optional[str] = None,
+                                   timeout: Optional[float] = None,
+                                   label: str = "LLM stream",
+                                   prefix=None) -> AsyncIterator[str]:
+        """
+        Stream from the first model in the cascade that starts answering in time.
+
+        Each model gets at most its hedge delay (bounded by the remaining timeout) to
+        produce a first chunk; after that the next model is tried. Once text has been
+        emitted the stream is committed to that model. Yields nothing if no model
+        started in time, so callers can emit their fallback.
+
+        Raises:
+            asyncio.TimeoutError: If the committed model stalls for longer than
+                LLM_STREAM_IDLE_TIMEOUT between chunks
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+
+        for index, model_name in enumerate(model_names):
+            remaining = deadline - loop.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                logger.warning(f"{label}: latency budget exhausted before any model answered")
+                return
+            is_last = index == len(model_names) - 1
+            first_chunk_timeout = remaining if is_last else min(
+                w for w in (remaining, self.hedge_delay(model_name)) if w is not None
+            )
+
+            stream = self.stream(model_name, prompt, generation_config=generation_config, tenant_id=tenant_id, prefix=prefix)
+            try:
+                first = await asyncio.wait_for(stream.__anext__(), timeout=first_chunk_timeout)
+            except StopAsyncIteration:
+                logger.warning(f"{label}: empty stream from {model_name}")
+                continue
+            except asyncio.TimeoutError:
+                logger.warning(f"{label}: {model_name} gave no first chunk within {first_chunk_timeout:.2f}s")
+                await stream.aclose()
+                continue
+            except CircuitOpenError:
+                logger.info(f"{label}: skipping {model_name}, circuit open")
+                continue
+            except Exception as e:
+                logger.warning(f"{label}: {model_name} failed: {str(e)}")
+                await stream.aclose()
+                continue
+
+            yield first
+            while True:
+                try:
+                    text = await asyncio.wait_for(stream.__anext__(), timeout=LLM_STREAM_IDLE_TIMEOUT)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    logger.warning(f"{label}: {model_name} stalled for {LLM_STREAM_IDLE_TIMEOUT:.2f}s mid-stream")
+                    await stream.aclose()
+                    raise
+                yield text
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Current in-flight counts, limits and per-model latency."""
+        return {
+            "inflight": self._inflight,
+            "max_inflight": self.max_inflight,
+            "max_inflight_per_tenant": self.max_inflight_per_tenant,
+            "tenant_inflight": dict(self._tenant_inflight),
+            "models": list(self._models.keys()),
+            "latency_p95": {name: self.latency_p95(name) for name in self._latencies},
+            "hedged_requests": self.hedged_requests
+        }
+
+
+# Singleton client shared by all AIService instances
+_llm_client: Optional[GeminiClient] = None
+
+def get_llm_client() -> GeminiClient:
+    """Get or create the GeminiClient singleton"""
+    global _llm_client
+    if _llm_client is None:
+        _llm_client = GeminiClient()
+    return _llm_client
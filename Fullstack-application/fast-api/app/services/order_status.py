@@ -0,0 +1,110 @@
+"""
+Order status lookups for shoppers (chat widget).
+
+Lookups go by tenant + customer email + order number (platform_order_id or the display
+order_number) and are served from the compound indexes created in create_indexes.
+Results, including "not found", are cached per tenant for a short time since shoppers
+tend to ask again within minutes; the Shoptet webhook invalidates the tenant's entries
+for an order when it upserts it.
+"""
+
+import os
+from typing import Any, Dict, Optional
+from app.utils.logging_config import get_module_logger
+from app.utils.mongo import get_orders_collection, serialize_mongo_doc
+from app.utils.ttl_cache import TTLCache
+
+logger = get_module_logger(__name__)
+
+ORDER_STATUS_CACHE_TTL = int(os.getenv("ORDER_STATUS_CACHE_TTL", "60"))  # seconds
+# Misses are kept shorter: the order may simply not have arrived via webhook yet
+ORDER_STATUS_NOT_FOUND_TTL = 15
+ORDER_STATUS_CACHE_SIZE = 10000
+# Raw webhook payloads can be large and are never shown to shoppers
+ORDER_PROJECTION = {"raw_webhook_data": 0, "notes": 0}
+
+_NOT_FOUND = object()
+
+
+def order_status_summary(order: Dict[str, Any]) -> Dict[str, Any]:
+    """The shopper-facing status fields of a serialized order."""
+    return {
+        "platform_order_id": order.get("platform_order_id"),
+        "order_number": order.get("order_number") or order.get("platform_order_id"),
+        "status": order.get("status"),
+        "tracking_number": order.get("tracking_number"),
+        "carrier": order.get("carrier"),
+        "estimated_delivery_date": order.get("estimated_delivery_date"),
+        "order_date": order.get("order_date"),
+        "updated_at": order.get("updated_at"),
+        "total_amount": order.get("total_amount"),
+        "currency": order.get("currency")
+    }
+
+
+class OrderStatusService:
+    """
+    Cached order lookup by tenant, customer email and order number.
+    """
+
+    def __init__(self):
+        self.cache = TTLCache("order_status", maxsize=ORDER_STATUS_CACHE_SIZE, ttl=ORDER_STATUS_CACHE_TTL)
+
+    async def find_order(self, user_id: str, email: str, order_ref: str) -> Optional[Dict[str, Any]]:
+        """
+        Find a tenant's order for a shopper.
+
+        Args:
+            user_id: Owner (tenant) the order belongs to
+            email: Customer email the order was placed with
+            order_ref: platform_order_id or order_number as given by the shopper
+
+        Returns:
+            The serialized order (without the raw webhook payload), or None
+        """
+        key = (user_id, email.lower(), order_ref)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return None if cached is _NOT_FOUND else cached
+
+        orders_collection = await get_orders_collection()
+        order = await orders_collection.find_one({
+            "user_id": user_id, # Filter by the website owner
+            "customer_email": email.lower(), # Filter by customer email
+            "$or": [ # Match either platform_order_id or order_number
+                {"platform_order_id": order_ref},
+                {"order_number": order_ref}
+            ]
+        }, ORDER_PROJECTION)
+
+        if order is None:
+            self.cache.set(key, _NOT_FOUND, ttl=ORDER_STATUS_NOT_FOUND_TTL)
+            return None
+        order_data = serialize_mongo_doc(order)
+        self.cache.set(key, order_data)
+        return order_data
+
+    def invalidate(self, user_id: str, platform_order_id: Optional[str] = None, email: Optional[str] = None, order_number: Optional[str] = None) -> int:
+        """
+        Drop cached lookups that may refer to an order that was created or changed.
+
+        Without an email or order reference every cached lookup of the tenant is dropped.
+        """
+        refs = {ref for ref in (platform_order_id, order_number) if ref}
+        email = email.lower() if email else None
+        if not refs and not email:
+            return self.cache.invalidate_tenant(user_id)
+        return self.cache.invalidate_tenant(user_id, lambda key: key[1] == email or key[2] in refs)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
+
+
+_order_status_service: Optional[OrderStatusService] = None
+
+def get_order_status_service() -> OrderStatusService:
+    """Get or create the OrderStatusService singleton"""
+    global _order_status_service
+    if _order_status_service is None:
+        _order_status_service = OrderStatusService()
+    return _order_status_service
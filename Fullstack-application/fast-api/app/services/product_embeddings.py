@@ -0,0 +1,449 @@
+"""
+Semantic product retrieval over per-tenant embedding matrices.
+
+Every product is embedded from its name, brand, category, features, keywords and
+description with the sentence-transformers model of app.services.embeddings (CPU only).
+Product writes are queued and embedded in batches by a background process pool
+(EMBEDDING_WORKERS processes that each load the model once), so encoding a catalog never
+blocks the event loop or holds the GIL of the serving process. Vectors are L2-normalized
+and stored per tenant as rows of one contiguous float32 matrix: a batch of queries is
+ranked with a single matrix product (cosine similarity) and an argpartition top-k.
+
+Vectors are cached by the SHA-1 of the embedded text, so unchanged products aren't
+re-encoded on index rebuilds and repeated queries skip the model. With
+EMBEDDING_MATRIX_DIR set, each tenant's matrix is written there as .npy after updates and
+memory-mapped read-only on startup, so a restart (or a sibling worker) only encodes the
+products that changed.
+
+numpy and sentence-transformers are optional: without them the index stays empty, lookups
+return None and callers keep their lexical retrieval.
+"""
+
+import os
+import re
+import json
+import asyncio
+import hashlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from app.services.embeddings import EMBEDDINGS_ENABLED, EMBEDDING_MODEL_NAME, SentenceTransformer, embed_texts
+from app.utils.ttl_cache import TTLCache
+from app.utils.logging_config import get_module_logger
+
+logger = get_module_logger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logger.warning("numpy not installed, semantic product retrieval disabled")
+
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "1"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_DELAY = float(os.getenv("EMBEDDING_BATCH_DELAY", "0.5"))  # seconds to collect writes into one batch
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "20000"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))  # seconds
+# Directory for memory-mapped tenant matrices; empty keeps them in memory only
+EMBEDDING_MATRIX_DIR = os.getenv("EMBEDDING_MATRIX_DIR", "")
+# Cosine similarity below which a product isn't a semantic retrieval hit
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.35"))
+
+# The model loaded by each pool process (see _init_encoder_worker)
+_worker_model = None
+_encoder_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _init_encoder_worker(model_name: str) -> None:
+    """Load the model once per pool process, on the CPU."""
+    global _worker_model
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    from sentence_transformers import SentenceTransformer
+    _worker_model = SentenceTransformer(model_name, device="cpu")
+
+
+def _encode_in_worker(texts: List[str]) -> "np.ndarray":
+    return _worker_model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def _get_encoder_pool() -> ProcessPoolExecutor:
+    global _encoder_pool
+    if _encoder_pool is None:
+        # spawn, not fork: the serving process has an event loop, threads and open sockets
+        _encoder_pool = ProcessPoolExecutor(
+            max_workers=EMBEDDING_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_encoder_worker,
+            initargs=(EMBEDDING_MODEL_NAME,)
+        )
+        logger.info(f"Started {EMBEDDING_WORKERS} product embedding worker(s) for {EMBEDDING_MODEL_NAME}")
+    return _encoder_pool
+
+
+def shutdown_encoder_pool() -> None:
+    """Stop the embedding worker processes (pending batches are dropped)."""
+    global _encoder_pool
+    if _encoder_pool is not None:
+        _encoder_pool.shutdown(wait=False, cancel_futures=True)
+        _encoder_pool = None
+
+
+async def encode_in_pool(texts: List[str]) -> "np.ndarray":
+    """Embed texts in the background process pool."""
+    return await asyncio.get_running_loop().run_in_executor(_get_encoder_pool(), _encode_in_worker, texts)
+
+
+def _joined(value: Any) -> str:
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value if item)
+    return str(value) if value else ""
+
+
+def product_text(product: Dict[str, Any]) -> str:
+    """Text a product is embedded from."""
+    parts = (product.get(field) for field in ("product_name", "brand", "category", "features", "keywords", "description"))
+    return ". ".join(text for text in map(_joined, parts) if text)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _write_matrix(prefix: str, vectors: "np.ndarray", product_ids: List[str], text_hashes: List[str]) -> None:
+    """Write a matrix and its row ids, replacing the previous files atomically."""
+    with open(f"{prefix}.npy.tmp", "wb") as file:
+        np.save(file, vectors)
+    with open(f"{prefix}.json.tmp", "w") as file:
+        json.dump({"model": EMBEDDING_MODEL_NAME, "product_ids": product_ids, "text_hashes": text_hashes}, file)
+    os.replace(f"{prefix}.npy.tmp", f"{prefix}.npy")
+    os.replace(f"{prefix}.json.tmp", f"{prefix}.json")
+
+
+class EmbeddingMatrix:
+    """
+    One tenant's product vectors as rows of a contiguous float32 matrix.
+
+    Rows are appended into a buffer with spare capacity and a removed row is filled with
+    the last one, so the rows in use stay one contiguous block.
+    """
+
+    def __init__(self):
+        self.product_ids: List[str] = []
+        self.text_hashes: List[str] = []  # text_hash of the text each row was embedded from
+        self.rows: Dict[str, int] = {}    # product_id -> row
+        self._buffer = None               # (capacity, dim) float32
+        self._mapped = False              # _buffer is a read-only memmap
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    @property
+    def vectors(self) -> Optional["np.ndarray"]:
+        return None if self._buffer is None else self._buffer[:len(self.product_ids)]
+
+    def text_hash(self, product_id: str) -> Optional[str]:
+        row = self.rows.get(product_id)
+        return None if row is None else self.text_hashes[row]
+
+    def _reserve(self, dim: int, extra: int) -> None:
+        """Make room for `extra` rows, copying a memory-mapped buffer before the first write."""
+        size = len(self.product_ids)
+        capacity = 0 if self._buffer is None else len(self._buffer)
+        if self._buffer is not None and self._buffer.shape[1] != dim:
+            raise ValueError(f"Embedding dimension changed from {self._buffer.shape[1]} to {dim}")
+        if not self._mapped and size + extra <= capacity:
+            return
+        buffer = np.empty((max(16, size + extra, capacity * 2 if size + extra > capacity else capacity), dim), dtype=np.float32)
+        if size:
+            buffer[:size] = self._buffer[:size]
+        self._buffer, self._mapped = buffer, False
+
+    def set(self, product_id: str, digest: str, vector: "np.ndarray") -> None:
+        """Add or replace a product's vector."""
+        row = self.rows.get(product_id)
+        self._reserve(len(vector), 1 if row is None else 0)
+        if row is None:
+            row = len(self.product_ids)
+            self.rows[product_id] = row
+            self.product_ids.append(product_id)
+            self.text_hashes.append(digest)
+        else:
+            self.text_hashes[row] = digest
+        self._buffer[row] = vector
+
+    def remove(self, product_id: str) -> bool:
+        row = self.rows.pop(product_id, None)
+        if row is None:
+            return False
+        last = len(self.product_ids) - 1
+        if row != last:
+            self._reserve(self._buffer.shape[1], 0)
+            self._buffer[row] = self._buffer[last]
+            moved = self.product_ids[last]
+            self.product_ids[row], self.text_hashes[row] = moved, self.text_hashes[last]
+            self.rows[moved] = row
+        self.product_ids.pop()
+        self.text_hashes.pop()
+        return True
+
+    def top_k(self, queries: "np.ndarray", k: int, allowed: Optional[Set[str]] = None, min_score: float = -1.0) -> List[List[Tuple[str, float]]]:
+        """
+        Rank the rows against a batch of normalized query vectors.
+
+        Args:
+            queries: (number of queries, dim) matrix
+            k: Maximum results per query
+            allowed: Only consider these product ids
+            min_score: Minimum cosine similarity
+
+        Returns:
+            Per query, (product_id, similarity) pairs, best first
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+        scores = queries @ self.vectors.T
+        if allowed is not None:
+            mask = np.fromiter((product_id in allowed for product_id in self.product_ids), dtype=bool, count=len(self))
+            scores[:, ~mask] = -np.inf
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row_scores, row_candidates in zip(scores, candidates):
+            ordered = row_candidates[np.argsort(-row_scores[row_candidates], kind="stable")]
+            results.append([(self.product_ids[row], float(row_scores[row])) for row in ordered if row_scores[row] >= min_score])
+        return results
+
+    def similarities(self, query: "np.ndarray", product_ids: Iterable[str]) -> Dict[str, float]:
+        """Cosine similarity of one normalized query vector with the given products."""
+        rows = [self.rows[product_id] for product_id in product_ids if product_id in self.rows]
+        if not rows:
+            return {}
+        scores = self.vectors[rows] @ query
+        return {self.product_ids[row]: float(score) for row, score in zip(rows, scores)}
+
+    @classmethod
+    def load(cls, prefix: str) -> Optional["EmbeddingMatrix"]:
+        """Memory-map a matrix written by _write_matrix, or None if missing or from another model."""
+        try:
+            with open(f"{prefix}.json") as file:
+                meta = json.load(file)
+            if meta.get("model") != EMBEDDING_MODEL_NAME:
+                return None
+            vectors = np.load(f"{prefix}.npy", mmap_mode="r")
+            if len(vectors) != len(meta["product_ids"]) or vectors.dtype != np.float32:
+                return None
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable embedding matrix {prefix}: {e}")
+            return None
+        matrix = cls()
+        matrix.product_ids = list(meta["product_ids"])
+        matrix.text_hashes = list(meta["text_hashes"])
+        matrix.rows = {product_id: row for row, product_id in enumerate(matrix.product_ids)}
+        matrix._buffer, matrix._mapped = vectors, True
+        return matrix
+
+
+class SemanticProductIndex:
+    """
+    Per-tenant embedding matrices kept in step with product writes.
+
+    Args:
+        encoder: Coroutine embedding a list of texts into a normalized float32 matrix,
+            used for products and queries; by default products are embedded in the
+            process pool and queries in-process (app.services.embeddings)
+        matrix_dir: Directory for memory-mapped matrices (EMBEDDING_MATRIX_DIR)
+    """
+
+    def __init__(self, encoder: Optional[Callable[[List[str]], Awaitable["np.ndarray"]]] = None, matrix_dir: str = EMBEDDING_MATRIX_DIR):
+        self.encoder = encoder
+        self.matrix_dir = matrix_dir
+        self.matrices: Dict[str, EmbeddingMatrix] = {}  # user_id -> EmbeddingMatrix
+        # Vectors by (model, text_hash), shared by product texts and queries
+        self.vector_cache = TTLCache("embeddings", maxsize=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL)
+        self._pending: Dict[Tuple[str, str], Tuple[str, str]] = {}  # (user_id, product_id) -> (text_hash, text)
+        self._dirty: Set[str] = set()  # tenants whose matrix changed since it was written
+        self._flush_task: Optional[asyncio.Task] = None
+        self.encoded = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return np is not None and (self.encoder is not None or (SentenceTransformer is not None and EMBEDDINGS_ENABLED))
+
+    def _path(self, user_id: str) -> str:
+        return os.path.join(self.matrix_dir, re.sub(r"[^A-Za-z0-9_-]", "_", user_id))
+
+    def _matrix(self, user_id: str) -> EmbeddingMatrix:
+        matrix = self.matrices.get(user_id)
+        if matrix is None:
+            matrix = (EmbeddingMatrix.load(self._path(user_id)) if self.matrix_dir else None) or EmbeddingMatrix()
+            self.matrices[user_id] = matrix
+        return matrix
+
+    def _set(self, user_id: str, product_id: str, digest: str, vector: "np.ndarray") -> None:
+        try:
+            self._matrix(user_id).set(product_id, digest, vector)
+        except ValueError as e:
+            # The model changed under a memory-mapped matrix: start the tenant over
+            logger.warning(f"Resetting embedding matrix of user {user_id}: {e}")
+            self.matrices[user_id] = EmbeddingMatrix()
+            self.matrices[user_id].set(product_id, digest, vector)
+        self._dirty.add(user_id)
+
+    def update(self, user_id: str, product_id: str, product: Dict[str, Any]) -> None:
+        """Queue a written product for embedding unless its text is unchanged or cached."""
+        if not self.enabled:
+            return
+        text = product_text(product)
+        digest = text_hash(text)
+        if self._matrix(user_id).text_hash(product_id) == digest:
+            self._pending.pop((user_id, product_id), None)
+            return
+        cached = self.vector_cache.get((EMBEDDING_MODEL_NAME, digest))
+        if cached is not None:
+            self._pending.pop((user_id, product_id), None)
+            self._set(user_id, product_id, digest, cached)
+            return
+        self._pending[(user_id, product_id)] = (digest, text)
+        self._schedule_flush()
+
+    def remove(self, user_id: str, product_id: str) -> None:
+        self._pending.pop((user_id, product_id), None)
+        matrix = self.matrices.get(user_id)
+        if matrix is not None and matrix.remove(product_id):
+            self._dirty.add(user_id)
+            self._schedule_flush()
+
+    def prune(self, products_cache: Dict[str, Dict[str, Any]]) -> None:
+        """Drop vectors of products and tenants no longer in the product cache."""
+        for user_id in list(self.matrices):
+            user_products = products_cache.get(user_id)
+            if user_products is None:
+                del self.matrices[user_id]
+                continue
+            for product_id in [product_id for product_id in self.matrices[user_id].product_ids if product_id not in user_products]:
+                self.remove(user_id, product_id)
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+        except RuntimeError:
+            pass  # No event loop (yet): the next write or flush() picks the queue up
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(EMBEDDING_BATCH_DELAY)
+        await self.flush()
+
+    async def _encode_products(self, texts: List[str]) -> "np.ndarray":
+        if self.encoder is not None:
+            return await self.encoder(texts)
+        return await encode_in_pool(texts)
+
+    async def flush(self) -> int:
+        """
+        Embed the queued products in batches and write changed matrices to disk.
+
+        Returns:
+            Number of product vectors stored
+        """
+        stored = 0
+        while self._pending:
+            batch = list(itertools.islice(self._pending.items(), EMBEDDING_BATCH_SIZE))
+            try:
+                vectors = await self._encode_products([text for _, (_, text) in batch])
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Embedding {len(batch)} products failed: {e}")
+                for key, (digest, _) in batch:
+                    if self._pending.get(key, (None,))[0] == digest:
+                        del self._pending[key]
+                continue
+            for (key, (digest, _)), vector in zip(batch, vectors):
+                vector = np.array(vector, dtype=np.float32)
+                self.vector_cache.set((EMBEDDING_MODEL_NAME, digest), vector)
+                # Skip products rewritten (queued again) or removed while the batch was encoding
+                if self._pending.get(key, (None,))[0] == digest:
+                    del self._pending[key]
+                    self._set(*key, digest, vector)
+                    stored += 1
+            self.encoded += len(batch)
+
+        if self.matrix_dir:
+            os.makedirs(self.matrix_dir, exist_ok=True)
+            for user_id in list(self._dirty):
+                self._dirty.discard(user_id)
+                matrix = self.matrices.get(user_id)
+                if matrix is None or matrix.vectors is None:
+                    continue
+                try:
+                    await asyncio.to_thread(_write_matrix, self._path(user_id), matrix.vectors.copy(), list(matrix.product_ids), list(matrix.text_hashes))
+                except Exception as e:
+                    logger.error(f"Writing embedding matrix of user {user_id} failed: {e}")
+        else:
+            self._dirty.clear()
+        return stored
+
+    async def _encode_queries(self, texts: Sequence[str]) -> Optional["np.ndarray"]:
+        digests = [text_hash(text) for text in texts]
+        vectors = [self.vector_cache.get((EMBEDDING_MODEL_NAME, digest)) for digest in digests]
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        if missing:
+            missing_texts = [texts[index] for index in missing]
+            if self.encoder is not None:
+                encoded = await self.encoder(missing_texts)
+            else:
+                encoded = await embed_texts(missing_texts)
+                if encoded is None:
+                    return None
+            for index, vector in zip(missing, encoded):
+                vectors[index] = np.array(vector, dtype=np.float32)
+                self.vector_cache.set((EMBEDDING_MODEL_NAME, digests[index]), vectors[index])
+        return np.stack(vectors)
+
+    async def search(self, user_id: str, texts: Sequence[str], limit: int = 5, allowed: Optional[Set[str]] = None, min_score: float = SEMANTIC_MIN_SCORE) -> Optional[List[List[Tuple[str, float]]]]:
+        """
+        Rank a tenant's products against a batch of query texts.
+
+        Returns:
+            Per text, (product_id, similarity) pairs best first, or None if semantic
+            retrieval is unavailable or the tenant has no embedded products
+        """
+        matrix = self.matrices.get(user_id)
+        if not self.enabled or matrix is None or not len(matrix) or not texts:
+            return None
+        try:
+            queries = await self._encode_queries(texts)
+            return None if queries is None else matrix.top_k(queries, limit, allowed, min_score)
+        except Exception as e:
+            logger.error(f"Semantic search for user {user_id} failed: {e}")
+            return None
+
+    async def similarities(self, user_id: str, text: str, product_ids: Iterable[str]) -> Dict[str, float]:
+        """Cosine similarity of a query with each of the given (embedded) products."""
+        matrix = self.matrices.get(user_id)
+        if not self.enabled or matrix is None or not len(matrix) or not text:
+            return {}
+        try:
+            queries = await self._encode_queries([text])
+            return {} if queries is None else matrix.similarities(queries[0], product_ids)
+        except Exception as e:
+            logger.error(f"Semantic scoring for user {user_id} failed: {e}")
+            return {}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "model": EMBEDDING_MODEL_NAME,
+            "tenants": len(self.matrices),
+            "products": sum(len(matrix) for matrix in self.matrices.values()),
+            "pending": len(self._pending),
+            "encoded": self.encoded,
+            "failures": self.failures,
+            "memory_mapped": sorted(user_id for user_id, matrix in self.matrices.items() if matrix._mapped),
+            "cache": self.vector_cache.stats()
+        }
@@ -0,0 +1,115 @@
+"""
+Fuzzy resolution of product names mentioned by shoppers.
+
+Gemini passes product names on the way users typed them: with typos, without diacritics,
+or as partial model numbers ("marlin7", "iphone 15"). Each tenant gets a ProductNameTable
+of normalized names and aliases (the name without the brand, brand + name), and all
+product entities of a message are scored against it in one rapidfuzz `process.cdist`
+call (WRatio, which handles partial and reordered names). Scores below the cutoff are
+dropped and each product keeps its best alias.
+
+The KnowledgeBase keeps the tables in step with products_cache (see
+KnowledgeBase._index_product), so the choice list is only rebuilt after a product write.
+"""
+
+import os
+import re
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+import numpy as np
+from rapidfuzz import fuzz, process
+from app.utils.keyword_matcher import fold_text
+
+# Minimum WRatio score (0-100) for a name to resolve to a product
+PRODUCT_NAME_SCORE_CUTOFF = float(os.getenv("PRODUCT_NAME_SCORE_CUTOFF", "75"))
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+# "marlin7" -> "marlin 7", "15pro" -> "15 pro"
+_LETTER_DIGIT_BOUNDARY = re.compile(r"(?<=[a-z])(?=[0-9])|(?<=[0-9])(?=[a-z])")
+
+
+def normalize_name(text: str) -> str:
+    """Fold diacritics and case, split letters from digits and collapse punctuation."""
+    text = _NON_ALNUM.sub(" ", fold_text(text or ""))
+    return " ".join(_LETTER_DIGIT_BOUNDARY.sub(" ", text).split())
+
+
+def product_aliases(product: Dict[str, Any]) -> List[str]:
+    """Normalized names a product can be referred to by."""
+    name = normalize_name(product.get("product_name", ""))
+    brand = normalize_name(product.get("brand", ""))
+    aliases = [name]
+    if brand and name.startswith(brand + " "):
+        aliases.append(name[len(brand) + 1:])
+    elif brand and name:
+        aliases.append(f"{brand} {name}")
+    return [alias for alias in dict.fromkeys(aliases) if alias]
+
+
+class NameMatch(NamedTuple):
+    product_id: str
+    alias: str    # Normalized alias that matched
+    score: float  # WRatio score, 0-100
+
+
+class ProductNameTable:
+    """
+    One tenant's normalized product names and aliases.
+    """
+
+    def __init__(self):
+        self._aliases: Dict[str, List[str]] = {}  # product_id -> aliases
+        self._choices: Optional[List[str]] = None  # flattened aliases, rebuilt after writes
+        self._owners: List[str] = []               # product_id of each choice
+
+    def __len__(self) -> int:
+        return len(self._aliases)
+
+    def add(self, product_id: str, product: Dict[str, Any]) -> None:
+        self._aliases[product_id] = product_aliases(product)
+        self._choices = None
+
+    def remove(self, product_id: str) -> None:
+        if self._aliases.pop(product_id, None) is not None:
+            self._choices = None
+
+    def _compile(self) -> List[str]:
+        if self._choices is None:
+            self._choices, self._owners = [], []
+            for product_id, aliases in self._aliases.items():
+                self._choices.extend(aliases)
+                self._owners.extend([product_id] * len(aliases))
+        return self._choices
+
+    def resolve(self, names: Sequence[str], limit: int = 3, score_cutoff: float = PRODUCT_NAME_SCORE_CUTOFF) -> List[List[NameMatch]]:
+        """
+        Score every name against every alias in one vectorized call.
+
+        Args:
+            names: Product names as mentioned (one entry per entity)
+            limit: Maximum matches per name
+            score_cutoff: Minimum WRatio score
+
+        Returns:
+            Per name, up to `limit` NameMatches (best first, one per product)
+        """
+        choices = self._compile()
+        queries = [normalize_name(name) for name in names]
+        if not choices or not any(queries):
+            return [[] for _ in names]
+
+        scores = process.cdist(queries, choices, scorer=fuzz.WRatio, processor=None, score_cutoff=score_cutoff)
+        resolved = []
+        for query, row in zip(queries, scores):
+            matches: List[NameMatch] = []
+            seen = set()
+            if query:
+                for choice_index in np.argsort(-row, kind="stable"):
+                    score = float(row[choice_index])
+                    if score < score_cutoff or score <= 0 or len(matches) == limit:
+                        break
+                    product_id = self._owners[choice_index]
+                    if product_id not in seen:
+                        seen.add(product_id)
+                        matches.append(NameMatch(product_id, choices[choice_index], round(score, 1)))
+            resolved.append(matches)
+        return resolved
@@ -0,0 +1,101 @@
+"""
+Product queries answered from the KnowledgeBase's in-memory tenant indexes.
+
+A ProductQuery is the subset of product filters the indexes can evaluate: category
+(expanded with the KnowledgeBase synonyms), brands, features, price range and a minimum
+admin_priority, sorted by admin_priority. KnowledgeBase.query_products turns it into set
+operations over category_index, brand_index, feature_index and price_index and only
+reads the candidate products themselves for the exact price and priority checks.
+
+from_mongo_filter compiles the Mongo filters the find_products_* methods receive into a
+ProductQuery, or returns None for predicates the indexes can't answer, in which case the
+caller queries Mongo as before.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional
+
+
+class ProductQuery:
+    """
+    Filters over a tenant's cached products; None means "no constraint".
+    """
+
+    __slots__ = ("categories", "brands", "features", "price_min", "price_max", "min_admin_priority", "exclude_ids")
+
+    def __init__(self,
+                 categories: Optional[Iterable[str]] = None,
+                 brands: Optional[Iterable[str]] = None,
+                 features: Optional[Iterable[str]] = None,
+                 price_min: Optional[float] = None,
+                 price_max: Optional[float] = None,
+                 min_admin_priority: Optional[float] = None,
+                 exclude_ids: Optional[Iterable[str]] = None):
+        self.categories = [category.lower() for category in categories] if categories is not None else None  # any of
+        self.brands = [brand.lower() for brand in brands] if brands is not None else None  # any of
+        self.features = [feature.lower() for feature in features or []]  # all of
+        self.price_min = price_min
+        self.price_max = price_max
+        self.min_admin_priority = min_admin_priority  # admin_priority must be greater
+        self.exclude_ids = set(exclude_ids or [])
+
+    @property
+    def has_price_range(self) -> bool:
+        return self.price_min is not None or self.price_max is not None
+
+    def __repr__(self) -> str:
+        fields = {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) not in (None, [], set())}
+        return f"ProductQuery({fields})"
+
+
+def _string_values(condition: Any) -> Optional[List[str]]:
+    """Values of an equality or $in condition on a string field."""
+    if isinstance(condition, str):
+        return [condition]
+    if isinstance(condition, dict) and set(condition) == {"$in"} and all(isinstance(value, str) for value in condition["$in"]):
+        return list(condition["$in"])
+    return None
+
+
+def from_mongo_filter(query: Dict[str, Any]) -> Optional[ProductQuery]:
+    """
+    Compile a Mongo product filter into a ProductQuery.
+
+    Supported: `category` and `brand` (value or $in), `features` (value, $all or $in with
+    one value), `price` ($gte/$lte/$gt/$lt, compared with the price price_index uses) and
+    `admin_priority` ($gt/$gte).
+
+    Returns:
+        The ProductQuery, or None if the filter uses anything else
+    """
+    compiled: Dict[str, Any] = {}
+    for field, condition in query.items():
+        if field in ("category", "brand"):
+            values = _string_values(condition)
+            if values is None:
+                return None
+            compiled["categories" if field == "category" else "brands"] = values
+        elif field == "features":
+            if isinstance(condition, str):
+                compiled["features"] = [condition]
+            elif isinstance(condition, dict) and set(condition) == {"$all"}:
+                compiled["features"] = list(condition["$all"])
+            elif isinstance(condition, dict) and set(condition) == {"$in"} and len(condition["$in"]) == 1:
+                compiled["features"] = list(condition["$in"])
+            else:
+                return None
+        elif field == "price" and isinstance(condition, dict):
+            for operator, value in condition.items():
+                if operator not in ("$gte", "$gt", "$lte", "$lt") or not isinstance(value, (int, float)):
+                    return None
+                if operator in ("$gte", "$gt"):
+                    compiled["price_min"] = value if operator == "$gte" else value + 1e-9
+                else:
+                    compiled["price_max"] = value if operator == "$lte" else value - 1e-9
+        elif field == "admin_priority" and isinstance(condition, dict) and len(condition) == 1:
+            operator, value = next(iter(condition.items()))
+            if operator not in ("$gt", "$gte") or not isinstance(value, (int, float)):
+                return None
+            compiled["min_admin_priority"] = value if operator == "$gt" else value - 1e-9
+        else:
+            return None
+    return ProductQuery(**compiled)
@@ -0,0 +1,144 @@
+"""
+Per-tenant BM25 full-text index over products.
+
+Text is normalized for Czech: lowercased and diacritics-folded (fold_text), split into
+alphanumeric tokens, stop words dropped, and reduced by a light suffix-stripping stemmer
+so that inflected forms ("kolo", "kola", "kolem", "kolech") share a term. Queries go
+through the same analyzer.
+
+Each product is indexed over product_name, keywords, features and description, with the
+short, specific fields repeated (FIELD_WEIGHTS) so a name hit outranks a description hit.
+Documents are added and removed one at a time, so the KnowledgeBase keeps the index in
+step with products_cache on every write (see KnowledgeBase._index_product). A search only
+walks the postings of the query terms, so its cost depends on how common the terms are,
+not on the catalog size.
+"""
+
+import re
+import math
+import heapq
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
+from app.utils.keyword_matcher import fold_text
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# How many times each field's tokens count towards a product's term frequencies
+FIELD_WEIGHTS = {
+    "product_name": 3,
+    "keywords": 2,
+    "features": 2,
+    "description": 1
+}
+
+# Folded Czech and English words that carry no product meaning
+STOP_WORDS = {
+    "a", "i", "k", "o", "s", "u", "v", "z", "ze", "se", "si", "na", "je", "jsou", "to", "ta", "ten",
+    "do", "po", "od", "za", "pri", "ke", "ve", "nebo", "ale", "jak", "jaky", "jake", "jaka",
+    "mate", "mam", "chci", "bych", "by", "nejaky", "nejake", "the", "and", "or", "for", "with",
+    "of", "in", "on", "an", "is", "are", "you", "have", "any", "my", "me"
+}
+
+# Czech case and number endings (diacritics folded), longest first
+_SUFFIXES = sorted({
+    "atech", "etem", "atum", "aty", "ech", "ich", "ami", "emi", "ata", "ete", "ove", "ovi", "ymi",
+    "ych", "ymu", "imu", "eho", "iho", "em", "es", "is", "ym", "im", "om", "um", "ou", "mi",
+    "ho", "ch", "ov", "a", "e", "i", "o", "u", "y"
+}, key=len, reverse=True)
+_MIN_STEM_LENGTH = 3
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def stem(token: str) -> str:
+    """Strip one Czech inflection ending, keeping at least _MIN_STEM_LENGTH characters."""
+    if token.isdigit():
+        return token
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= _MIN_STEM_LENGTH:
+            return token[:-len(suffix)]
+    return token
+
+
+def analyze(text: str) -> List[str]:
+    """Fold, tokenize, drop stop words and stem."""
+    return [stem(token) for token in _TOKEN_PATTERN.findall(fold_text(text)) if token not in STOP_WORDS]
+
+
+def _field_text(value: Any) -> str:
+    if isinstance(value, (list, tuple)):
+        return " ".join(str(item) for item in value)
+    return str(value) if value else ""
+
+
+class ProductSearchIndex:
+    """
+    Inverted index of one tenant's products with BM25 scoring.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}  # term -> {product_id -> term frequency}
+        self.doc_terms: Dict[str, Counter] = {}        # product_id -> term frequencies
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, product_id: str, product: Dict[str, Any]) -> None:
+        """Index a product (replacing its previous entry, if any)."""
+        self.remove(product_id)
+        terms = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in analyze(_field_text(product.get(field))):
+                terms[term] += weight
+        length = sum(terms.values())
+        self.doc_terms[product_id] = terms
+        self.doc_lengths[product_id] = length
+        self.total_length += length
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[product_id] = frequency
+
+    def remove(self, product_id: str) -> None:
+        terms = self.doc_terms.pop(product_id, None)
+        if terms is None:
+            return
+        self.total_length -= self.doc_lengths.pop(product_id)
+        for term in terms:
+            documents = self.postings[term]
+            del documents[product_id]
+            if not documents:
+                del self.postings[term]
+
+    def search(self, query: str, limit: int = 10, allowed: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        """
+        Rank products against a free-text query.
+
+        Args:
+            query: Query text (analyzed like the products)
+            limit: Maximum number of results
+            allowed: Only consider these product ids (e.g. the result of a ProductQuery)
+
+        Returns:
+            (product_id, score) pairs, best first; products sharing no term are left out
+        """
+        document_count = len(self.doc_lengths)
+        if not document_count:
+            return []
+        average_length = self.total_length / document_count or 1
+        scores: Dict[str, float] = {}
+        for term in set(analyze(query)):
+            documents = self.postings.get(term)
+            if not documents:
+                continue
+            idf = math.log(1 + (document_count - len(documents) + 0.5) / (len(documents) + 0.5))
+            for product_id, frequency in documents.items():
+                if allowed is not None and product_id not in allowed:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[product_id] / average_length)
+                scores[product_id] = scores.get(product_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def stats(self) -> Dict[str, Any]:
+        return {"products": len(self.doc_lengths), "terms": len(self.postings)}
@@ -0,0 +1,183 @@
+"""
+Prompt assembly with token budgeting.
+
+Prompts are built from named sections with a priority. Sections whose text is already
+contained in an earlier section are dropped, and when the estimated size goes over the
+stage's token budget the lowest-priority sections are trimmed first: list sections
+(e.g. products) lose their last items, other optional sections are dropped entirely.
+Required sections (system prompt, query, instructions) are never trimmed.
+"""
+
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional
+from app.utils.logging_config import get_module_logger
+
+logger = get_module_logger(__name__)
+
+# Rough characters-per-token ratio for Gemini on mixed Czech/English text
+CHARS_PER_TOKEN = 4
+# Token budgets for the response generation prompt per intent
+PROMPT_TOKEN_BUDGETS = {
+    "product_recommendation": 3000,
+    "product_comparison": 3500,
+    "accessory_recommendation": 2500,
+    "technical_explanation": 2500,
+    "general_question": 1500,
+    "customer_service": 1500,
+    "store_navigation": 1200,
+    "shipping_payment": 1200,
+    "order_status": 1200
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+# Token budget for the intent/entity extraction prompt
+NLU_PROMPT_TOKEN_BUDGET = int(os.getenv("NLU_PROMPT_TOKEN_BUDGET", "1500"))
+# Longest string value kept in a list item (e.g. product descriptions)
+PROMPT_MAX_FIELD_CHARS = 400
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the token count of a text (about CHARS_PER_TOKEN characters per token)."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def get_prompt_budget(intent: Optional[str]) -> int:
+    """The generation prompt budget for an intent."""
+    return PROMPT_TOKEN_BUDGETS.get(intent, DEFAULT_PROMPT_TOKEN_BUDGET)
+
+def compact_value(value: Any, max_chars: int = PROMPT_MAX_FIELD_CHARS) -> Any:
+    """Truncate long strings and drop empty values from nested dicts/lists."""
+    if isinstance(value, str):
+        return value if len(value) <= max_chars else value[:max_chars].rstrip() + "…"
+    if isinstance(value, dict):
+        compacted = {key: compact_value(item, max_chars) for key, item in value.items()}
+        return {key: item for key, item in compacted.items() if item not in (None, "", [], {})}
+    if isinstance(value, (list, tuple)):
+        return [compact_value(item, max_chars) for item in value]
+    return value
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class PromptSection:
+    """A named part of a prompt."""
+
+    def __init__(self, name: str, text: str, priority: int, required: bool = False,
+                 items: Optional[List[Any]] = None, render: Optional[Callable[[List[Any]], str]] = None):
+        self.name = name
+        self.priority = priority
+        self.required = required
+        self.items = items
+        self.render = render
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.dropped_items = 0
+
+    def drop_last_item(self) -> bool:
+        """Remove the last list item and re-render; False if the section isn't trimmable."""
+        if self.items is None or self.render is None or len(self.items) <= 1:
+            return False
+        self.items = self.items[:-1]
+        self.dropped_items += 1
+        self.text = self.render(self.items)
+        self.tokens = estimate_tokens(self.text)
+        return True
+
+
+class PromptBuilder:
+    """
+    Collects prompt sections and renders them within a token budget.
+
+    Sections are rendered in the order they were added; priority only decides what
+    gets trimmed first.
+    """
+
+    def __init__(self, stage: str, budget_tokens: int):
+        self.stage = stage
+        self.budget_tokens = budget_tokens
+        self.sections: List[PromptSection] = []
+        self.duplicates: List[str] = []
+        self.stats: Dict[str, Any] = {}
+
+    def add(self, name: str, text: Optional[str], priority: int, required: bool = False) -> "PromptBuilder":
+        """
+        Add a text section. Empty text and text already present in an earlier section are skipped.
+
+        Args:
+            name: Section name, used in logs
+            text: Section text
+            priority: Higher priority sections are kept longer
+            required: Never trim this section
+        """
+        text = (text or "").strip()
+        if not text:
+            return self
+        normalized = _normalize(text)
+        for section in self.sections:
+            if normalized in _normalize(section.text):
+                self.duplicates.append(name)
+                logger.debug(f"Prompt [{self.stage}]: section '{name}' duplicates '{section.name}', skipped")
+                return self
+        self.sections.append(PromptSection(name, text, priority, required))
+        return self
+
+    def add_items(self, name: str, items: List[Any], render: Callable[[List[Any]], str], priority: int,
+                  empty_text: Optional[str] = None) -> "PromptBuilder":
+        """
+        Add a list section (e.g. products) that is trimmed item by item from the end.
+
+        Args:
+            name: Section name, used in logs
+            items: Items, most relevant first
+            render: Renders the (remaining) items into section text
+            priority: Higher priority sections are kept longer
+            empty_text: Text used when there are no items
+        """
+        if not items:
+            return self.add(name, empty_text, priority)
+        items = [compact_value(item) for item in items]
+        self.sections.append(PromptSection(name, render(items), priority, items=items, render=render))
+        return self
+
+    def total_tokens(self) -> int:
+        # Sections are joined with a blank line
+        return sum(section.tokens for section in self.sections) + max(len(self.sections) - 1, 0)
+
+    def _trim(self) -> List[str]:
+        trimmed = []
+        while self.total_tokens() > self.budget_tokens:
+            optional = [section for section in self.sections if not section.required]
+            if not optional:
+                break
+            lowest = min(optional, key=lambda section: section.priority)
+            if not lowest.drop_last_item():
+                self.sections.remove(lowest)
+                trimmed.append(lowest.name)
+        return trimmed
+
+    def build(self) -> str:
+        """Render the prompt, trimming it to the budget, and log the token count."""
+        before = self.total_tokens()
+        dropped_sections = self._trim()
+        total = self.total_tokens()
+
+        self.stats = {
+            "stage": self.stage,
+            "tokens": total,
+            "tokens_before_trim": before,
+            "budget": self.budget_tokens,
+            "sections": {section.name: section.tokens for section in self.sections},
+            "dropped_sections": dropped_sections,
+            "dropped_items": {section.name: section.dropped_items for section in self.sections if section.dropped_items},
+            "duplicates": self.duplicates
+        }
+        breakdown = ", ".join(f"{name}={tokens}" for name, tokens in self.stats["sections"].items())
+        message = f"Prompt [{self.stage}] ~{total} tokens (budget {self.budget_tokens}): {breakdown}"
+        if before != total:
+            message += f"; trimmed from ~{before}, dropped {dropped_sections or 'none'}, items {self.stats['dropped_items'] or 'none'}"
+        if total > self.budget_tokens:
+            logger.warning(message + " - required sections exceed the budget")
+        else:
+            logger.info(message)
+
+        return "\n\n".join(section.text for section in self.sections)
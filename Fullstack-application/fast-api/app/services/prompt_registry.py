@@ -0,0 +1,268 @@
+"""
+Per-tenant registry of compiled system prompts.
+
+The system prompt is built from the tenant's shop_info once per (tenant, language) and
+kept in memory, so the chat hot path never reads shop_info from Mongo. Entries are
+dropped when the tenant's shop info changes (AIService listens on update_shop_info) and
+also expire after PROMPT_REGISTRY_TTL as a safety net for other worker processes.
+
+Optionally (PROMPT_PROVIDER_CACHE) the compiled prompt is also stored as Gemini cached
+content per model, so the static prefix isn't re-sent and re-processed on every call.
+The cache is created in the background; until it exists, or for models where creating
+it failed, the full prompt is sent as before.
+"""
+
+import os
+import time
+import asyncio
+import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+from app.utils.logging_config import get_module_logger
+from app.utils.mongo import get_shop_info
+from app.utils.ttl_cache import TTLCache
+from app.services.prompt_builder import estimate_tokens
+
+logger = get_module_logger(__name__)
+
+try:
+    from google.generativeai import caching
+except ImportError:
+    caching = None
+
+PROMPT_REGISTRY_SIZE = int(os.getenv("PROMPT_REGISTRY_SIZE", "2000"))
+PROMPT_REGISTRY_TTL = int(os.getenv("PROMPT_REGISTRY_TTL", "3600"))  # seconds
+# Fallback prompts (shop info couldn't be loaded) are retried sooner
+PROMPT_REGISTRY_FALLBACK_TTL = 60
+# Gemini context caching for the system prompt prefix
+PROMPT_PROVIDER_CACHE = os.getenv("PROMPT_PROVIDER_CACHE", "false").lower() == "true"
+PROMPT_PROVIDER_CACHE_TTL = int(os.getenv("PROMPT_PROVIDER_CACHE_TTL", "3600"))  # seconds
+# Gemini only caches content above a minimum size; smaller prompts aren't worth a cache entry
+PROMPT_PROVIDER_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_PROVIDER_CACHE_MIN_TOKENS", "4096"))
+
+FALLBACK_SYSTEM_PROMPTS = {
+    "cs": """Jsme DvojkavIT, nová generace digitálních tvůrců, která vznikla v roce 2024. Spojuje nás vášeň pro online svět a touha dělat věci jinak, lépe. Jako stratégové a vizionáři vytváříme inovativní digitální řešení, která vám pomohou dosáhnout vašich online cílů. Odpovídáme stručně a výstižně, maximálně ve 100 slovech.""",
+    "en": """You are a concise and direct shopping assistant. Answer in a maximum of 60 words."""
+}
+
+
+def build_system_prompt(shop_info: Dict[str, Any], language: str = "cs") -> str:
+    """
+    Build the system prompt from a tenant's shop information.
+
+    Args:
+        shop_info: Shop info document (see get_shop_info)
+        language: Language code
+
+    Returns:
+        System prompt for AI
+    """
+    if language == "cs":
+        prompt = f"""{shop_info['ai_prompt_summary']}
+
+Základní informace:
+- Jmenujeme se {shop_info['shop_name']}
+- Byli jsme založeni v roce {shop_info['founded_year']}
+- Naše webové stránky jsou na {shop_info['website']}
+- Kontaktovat nás můžete na {shop_info['primary_email']} nebo telefonicky na {shop_info['primary_phone']}
+"""
+
+        # Add services if available
+        if shop_info.get('services'):
+            prompt += "\nNaše služby:\n"
+            for service in shop_info['services']:
+                prompt += f"- {service}\n"
+
+        # Add AI facts if available
+        if shop_info.get('ai_faq_facts'):
+            prompt += "\nDůležitá fakta:\n"
+            for fact in shop_info['ai_faq_facts']:
+                prompt += f"- {fact}\n"
+
+        # Add voice style if available
+        if shop_info.get('ai_voice_style'):
+            prompt += f"\nTón komunikace: {shop_info['ai_voice_style']}\n"
+        
+        prompt += """
+Tvé schopnosti:
+- Doporučuješ produkty na základě potřeb zákazníka  
+- Porovnáváš výhody a nevýhody různých možností
+- Vysvětluješ technické parametry srozumitelným způsobem
+- Doporučuješ kompatibilní příslušenství a související služby
+- Pomáháš s orientací v e-shopu
+- Odpovídáš na otázky o dopravě, platbách, reklamacích a doplňkových službách
+
+Buď vždy přátelský, profesionální a užitečný. Snaž se porozumět skutečným potřebám zákazníka.
+Odpovídej stručně a přímo, vždy česky. Pro údaje, které neznáš, upřímně přiznej neznalost.
+"""
+    else:  # English or other languages
+        prompt = f"""{shop_info.get('ai_prompt_summary', f"We are {shop_info['shop_name']}, founded in {shop_info['founded_year']}.")}
+
+Basic information:
+- Our name is {shop_info['shop_name']}
+- We were founded in {shop_info['founded_year']}
+- Our website is at {shop_info['website']}
+- You can contact us at {shop_info['primary_email']} or by phone at {shop_info['primary_phone']}
+"""
+
+        # Add services if available
+        if shop_info.get('services'):
+            prompt += "\nOur services:\n"
+            for service in shop_info['services']:
+                prompt += f"- {service}\n"
+
+        # Add AI facts if available
+        if shop_info.get('ai_faq_facts'):
+            prompt += "\nImportant facts:\n"
+            for fact in shop_info['ai_faq_facts']:
+                prompt += f"- {fact}\n"
+
+        # Add voice style if available
+        if shop_info.get('ai_voice_style'):
+            prompt += f"\nCommunication style: {shop_info['ai_voice_style']}\n"
+        
+        prompt += """
+Your capabilities:
+- Recommend products based on customer needs
+- Compare pros and cons of different options
+- Explain technical specifications in an accessible way
+- Recommend compatible accessories and related services
+- Help customers navigate the online store
+- Answer questions about shipping, payment methods, refunds, and complementary services
+
+Always be friendly, professional, and helpful. Try to understand the customer's real needs.
+Respond concisely and directly. For information you don't know, honestly admit your lack of knowledge.
+"""
+    return prompt.strip()
+
+
+class PromptPrefix:
+    """
+    A compiled system prompt and the Gemini cached content created for it, per model.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self._cached: Dict[str, Tuple[Any, float]] = {}  # model name -> (CachedContent, expires at)
+        self._pending: Set[str] = set()
+        self._failed: Set[str] = set()
+
+    def cached_for(self, model_name: str) -> Optional[Any]:
+        """The live cached content for a model, or None if the full prompt has to be sent."""
+        entry = self._cached.get(model_name)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def needs_cache(self, model_name: str) -> bool:
+        return (self.cached_for(model_name) is None
+                and model_name not in self._pending
+                and model_name not in self._failed)
+
+
+class SystemPromptRegistry:
+    """
+    Compiled system prompts keyed by (tenant, language).
+    """
+
+    def __init__(self, provider_cache_models: Optional[List[str]] = None, ttl: int = PROMPT_REGISTRY_TTL):
+        self.prompts = TTLCache("system_prompts", maxsize=PROMPT_REGISTRY_SIZE, ttl=ttl)
+        self.provider_cache_models = provider_cache_models or []
+        self._loading: Dict[Tuple[str, str], asyncio.Future] = {}
+        # Bumped on invalidation so a load that raced with an update isn't stored
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+
+    async def get(self, user_id: Optional[str], language: str = "cs") -> PromptPrefix:
+        """
+        Get the tenant's compiled system prompt, building it on first use.
+
+        Concurrent misses for the same key share one shop_info lookup.
+        """
+        key = (user_id or "", language)
+        prefix = self.prompts.get(key)
+        if prefix is None:
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = asyncio.ensure_future(self._load(key))
+                self._loading[key] = loading
+                loading.add_done_callback(lambda future: self._loading.pop(key, None) if self._loading.get(key) is future else None)
+            prefix = await asyncio.shield(loading)
+        self._ensure_provider_cache(prefix)
+        return prefix
+
+    async def _load(self, key: Tuple[str, str]) -> PromptPrefix:
+        user_id, language = key
+        version = self._versions.get(key, 0)
+        ttl = None
+        try:
+            shop_info = await get_shop_info(language, user_id or None)
+            prefix = PromptPrefix(build_system_prompt(shop_info, language))
+            logger.info(f"Compiled system prompt for user {user_id or '-'} ({language}), ~{prefix.tokens} tokens")
+        except Exception as e:
+            logger.error(f"Error loading shop info for prompt (user {user_id}, {language}): {str(e)}")
+            prefix = PromptPrefix(FALLBACK_SYSTEM_PROMPTS["cs" if language == "cs" else "en"])
+            ttl = PROMPT_REGISTRY_FALLBACK_TTL
+        if self._versions.get(key, 0) == version:
+            self.prompts.set(key, prefix, ttl=ttl)
+        return prefix
+
+    def invalidate(self, user_id: Optional[str], language: str) -> None:
+        """Drop the tenant's compiled prompt (and its provider caches) after a shop info change."""
+        key = (user_id or "", language)
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._loading.pop(key, None)
+        prefix = self.prompts.get(key)
+        self.prompts.delete(key)
+        if prefix is not None and prefix._cached:
+            self._spawn(self._delete_provider_cache(prefix))
+
+    def _spawn(self, coro) -> None:
+        try:
+            task = asyncio.get_running_loop().create_task(coro)
+        except RuntimeError:
+            coro.close()
+            return
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def _ensure_provider_cache(self, prefix: PromptPrefix) -> None:
+        """Start creating Gemini cached content for models that don't have it yet."""
+        if not PROMPT_PROVIDER_CACHE or caching is None or prefix.tokens < PROMPT_PROVIDER_CACHE_MIN_TOKENS:
+            return
+        for model_name in self.provider_cache_models:
+            if prefix.needs_cache(model_name):
+                prefix._pending.add(model_name)
+                self._spawn(self._create_provider_cache(prefix, model_name))
+
+    async def _create_provider_cache(self, prefix: PromptPrefix, model_name: str) -> None:
+        try:
+            cached = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=model_name,
+                system_instruction=prefix.text,
+                ttl=datetime.timedelta(seconds=PROMPT_PROVIDER_CACHE_TTL)
+            )
+            # Stop using it a little before Gemini expires it
+            prefix._cached[model_name] = (cached, time.monotonic() + PROMPT_PROVIDER_CACHE_TTL * 0.9)
+            logger.info(f"Created Gemini cached content for system prompt on {model_name}")
+        except Exception as e:
+            # Not retried for this prompt version; the full prompt is sent instead
+            prefix._failed.add(model_name)
+            logger.warning(f"Could not create Gemini cached content on {model_name}: {str(e)}")
+        finally:
+            prefix._pending.discard(model_name)
+
+    async def _delete_provider_cache(self, prefix: PromptPrefix) -> None:
+        cached_items = [cached for cached, _ in prefix._cached.values()]
+        prefix._cached.clear()
+        for cached in cached_items:
+            try:
+                await asyncio.to_thread(cached.delete)
+            except Exception as e:
+                logger.warning(f"Could not delete Gemini cached content: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.prompts.stats()
+        stats["provider_cache"] = PROMPT_PROVIDER_CACHE and caching is not None
+        return stats
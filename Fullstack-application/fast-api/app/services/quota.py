@@ -0,0 +1,189 @@
+"""
+Monthly conversation quota.
+
+A new conversation is counted with one conditional find_one_and_update on the user
+document, so the limit check and the increment happen atomically in Mongo and stay
+exact under concurrent requests (the user document read during auth can be stale).
+Period rollover is part of the same kind of update: when the usage period is older
+than USAGE_PERIOD the counter restarts at 1 for the conversation being opened.
+
+The counter state returned by each update is kept in memory, so the remaining quota
+can be read without a database round trip.
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+from pymongo import ReturnDocument
+from app.models.user import SubscriptionTier
+from app.utils.logging_config import get_module_logger
+from app.utils.mongo import get_user_collection
+from app.utils.ttl_cache import TTLCache
+
+logger = get_module_logger(__name__)
+
+USAGE_PERIOD = timedelta(days=30) # Approximation for a month
+# Monthly new conversation limit per tier (None = unlimited)
+CONVERSATION_LIMITS = {
+    SubscriptionTier.FREE: 0,
+    SubscriptionTier.BASIC: 500,
+    SubscriptionTier.PREMIUM: 1500,
+    SubscriptionTier.ENTERPRISE: None
+}
+# --- Temporary Fix: Map known Price ID to tier name ---
+# Ideally, the webhook should store the tier name directly.
+PRICE_ID_TO_TIER = {
+    "price_1RAIdbr4qkX0uO0aXoszn1Fs2": "basic"
+    # Add other Price IDs and their corresponding tier names here if needed
+}
+# How long a cached counter may be served to quota reads (seconds)
+QUOTA_CACHE_TTL = 60
+
+_COUNT_FIELD = "conversation_count_current_month"
+_PERIOD_FIELD = "usage_period_start_date"
+
+
+class QuotaExceededError(Exception):
+    """Raised when the monthly conversation limit has been reached."""
+
+    def __init__(self, tier: SubscriptionTier, limit: int):
+        self.tier = tier
+        self.limit = limit
+        super().__init__(f"Monthly conversation limit ({limit}) reached for your '{tier.value}' plan.")
+
+
+def resolve_tier(user: Dict[str, Any]) -> SubscriptionTier:
+    """The user's subscription tier, defaulting to FREE for unknown values."""
+    tier_str = user.get("subscription_tier", "free")
+    if tier_str in PRICE_ID_TO_TIER:
+        logger.debug(f"Mapped Price ID {tier_str} to tier '{PRICE_ID_TO_TIER[tier_str]}' for limit check.")
+        tier_str = PRICE_ID_TO_TIER[tier_str]
+    try:
+        return SubscriptionTier(tier_str)
+    except ValueError:
+        logger.warning(f"Invalid or unrecognized subscription_tier value '{tier_str}' for user {user.get('id')}. Defaulting to FREE.")
+        return SubscriptionTier.FREE
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class ConversationQuota:
+    """
+    Atomic check-and-increment of the monthly conversation counter.
+    """
+
+    def __init__(self):
+        # (user id,) -> {"count", "period_start"} as last written by this process
+        self.counters = TTLCache("conversation_quota", maxsize=10000, ttl=QUOTA_CACHE_TTL)
+
+    async def consume(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Count one new conversation for the user.
+
+        Args:
+            user: User document (only id and subscription_tier are used)
+
+        Returns:
+            Quota status after the increment (see status)
+
+        Raises:
+            QuotaExceededError: if the limit for the user's tier has been reached
+        """
+        user_id = user["id"]
+        tier = resolve_tier(user)
+        limit = CONVERSATION_LIMITS.get(tier, 0)
+        if limit is not None and limit <= 0:
+            raise QuotaExceededError(tier, limit)
+
+        user_collection = await get_user_collection()
+        projection = {_COUNT_FIELD: 1, _PERIOD_FIELD: 1}
+
+        # Two attempts: a concurrent rollover can make the first increment miss
+        for _ in range(2):
+            now = datetime.now(timezone.utc)
+            period_cutoff = now - USAGE_PERIOD
+
+            # Current period: increment only while under the limit
+            current_filter = {"id": user_id, _PERIOD_FIELD: {"$gt": period_cutoff}}
+            if limit is not None:
+                current_filter[_COUNT_FIELD] = {"$not": {"$gte": limit}}
+            updated = await user_collection.find_one_and_update(
+                current_filter,
+                {"$inc": {_COUNT_FIELD: 1}},
+                projection=projection,
+                return_document=ReturnDocument.AFTER
+            )
+            if updated is not None:
+                return self._remember(user_id, tier, limit, updated)
+
+            # No period yet or the period is over: start a new one with this conversation
+            updated = await user_collection.find_one_and_update(
+                {"id": user_id, "$or": [{_PERIOD_FIELD: None}, {_PERIOD_FIELD: {"$lte": period_cutoff}}]},
+                {"$set": {_COUNT_FIELD: 1, _PERIOD_FIELD: now}},
+                projection=projection,
+                return_document=ReturnDocument.AFTER
+            )
+            if updated is not None:
+                logger.info(f"Reset monthly conversation count for user {user_id}")
+                return self._remember(user_id, tier, limit, updated)
+
+            # Neither matched: either the limit is reached, or another request rolled the period over
+            current = await user_collection.find_one({"id": user_id}, projection)
+            if current is None:
+                logger.error(f"Quota check for unknown user {user_id}")
+                raise QuotaExceededError(tier, limit or 0)
+            period_start = _as_utc(current.get(_PERIOD_FIELD))
+            if period_start is not None and period_start > period_cutoff and limit is not None and current.get(_COUNT_FIELD, 0) >= limit:
+                self._remember(user_id, tier, limit, current)
+                logger.warning(f"User {user_id} (Tier: {tier.value}) tried to start new conversation but reached monthly limit ({limit})")
+                raise QuotaExceededError(tier, limit)
+
+        logger.warning(f"Could not count conversation for user {user_id} after retry, treating as limit reached")
+        raise QuotaExceededError(tier, limit or 0)
+
+    def _remember(self, user_id: str, tier: SubscriptionTier, limit: Optional[int], document: Dict[str, Any]) -> Dict[str, Any]:
+        counter = {"count": document.get(_COUNT_FIELD, 0), "period_start": _as_utc(document.get(_PERIOD_FIELD))}
+        self.counters.set((user_id,), counter)
+        logger.info(f"Monthly conversation count for user {user_id}: {counter['count']}")
+        return self._status(tier, limit, counter)
+
+    @staticmethod
+    def _status(tier: SubscriptionTier, limit: Optional[int], counter: Dict[str, Any]) -> Dict[str, Any]:
+        period_start = counter["period_start"]
+        period_over = period_start is None or period_start + USAGE_PERIOD <= datetime.now(timezone.utc)
+        used = 0 if period_over else counter["count"]
+        return {
+            "tier": tier.value,
+            "limit": limit,
+            "used": used,
+            "remaining": None if limit is None else max(limit - used, 0),
+            "period_start": None if period_over else period_start,
+            "period_end": None if period_over else period_start + USAGE_PERIOD
+        }
+
+    async def status(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Remaining quota for the user: from memory when this process counted recently,
+        otherwise from a projected read of the user document.
+        """
+        tier = resolve_tier(user)
+        limit = CONVERSATION_LIMITS.get(tier, 0)
+        counter = self.counters.get((user["id"],))
+        if counter is None:
+            user_collection = await get_user_collection()
+            document = await user_collection.find_one({"id": user["id"]}, {_COUNT_FIELD: 1, _PERIOD_FIELD: 1}) or {}
+            counter = {"count": document.get(_COUNT_FIELD, 0), "period_start": _as_utc(document.get(_PERIOD_FIELD))}
+            self.counters.set((user["id"],), counter)
+        return self._status(tier, limit, counter)
+
+
+_conversation_quota: Optional[ConversationQuota] = None
+
+def get_conversation_quota() -> ConversationQuota:
+    """Get or create the ConversationQuota singleton"""
+    global _conversation_quota
+    if _conversation_quota is None:
+        _conversation_quota = ConversationQuota()
+    return _conversation_quota
@@ -0,0 +1,127 @@
+"""
+Cache for generated chat replies.
+
+Entries are keyed on tenant, language, intent, the normalized query, the ids of the
+products passed to the prompt and a fingerprint of the prompt data (so a product edit
+changes the key even before its entries are invalidated). Optionally, a query that is
+not an exact match can still hit when its embedding is close enough to a cached query
+with the same tenant/language/intent/data.
+"""
+
+import os
+import json
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+from app.utils.logging_config import get_module_logger
+from app.utils.ttl_cache import TTLCache
+from app.services.embeddings import embed_texts, cosine_similarity
+
+logger = get_module_logger(__name__)
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "1800"))  # seconds
+# Near-duplicate matching with embeddings (needs sentence-transformers)
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "false").lower() == "true"
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))
+# Cached query embeddings kept per (tenant, language, intent, data) bucket
+RESPONSE_CACHE_MAX_VARIANTS = 50
+
+
+class ResponseCache:
+    """
+    Exact + optional semantic cache of generated replies.
+    """
+
+    def __init__(self,
+                 maxsize: int = RESPONSE_CACHE_SIZE,
+                 ttl: int = RESPONSE_CACHE_TTL,
+                 semantic: bool = RESPONSE_CACHE_SEMANTIC,
+                 similarity_threshold: float = RESPONSE_CACHE_SIMILARITY):
+        self.cache = TTLCache("response_generation", maxsize=maxsize, ttl=ttl)
+        self.semantic = semantic
+        self.similarity_threshold = similarity_threshold
+        # bucket key -> list of (query embedding, exact cache key)
+        self._variants: Dict[Tuple, List[Tuple[List[float], Tuple]]] = {}
+        self.semantic_hits = 0
+
+    @staticmethod
+    def _bucket(tenant: str, language: str, intent: str, relevant_data: List[Dict]) -> Tuple:
+        """Key part shared by all phrasings of a question over the same prompt data."""
+        product_ids = tuple(sorted(str(item["id"]) for item in relevant_data if isinstance(item, dict) and item.get("id")))
+        data_json = json.dumps(relevant_data, default=str, ensure_ascii=False, sort_keys=True)
+        fingerprint = hashlib.sha1(data_json.encode("utf-8")).hexdigest()
+        return (tenant, language, intent, product_ids, fingerprint)
+
+    @staticmethod
+    def _key(bucket: Tuple, normalized_query: str) -> Tuple:
+        tenant, language, intent, product_ids, fingerprint = bucket
+        return (tenant, language, intent, normalized_query, product_ids, fingerprint)
+
+    async def get(self, tenant: str, language: str, intent: str, normalized_query: str, relevant_data: List[Dict]) -> Optional[str]:
+        """
+        Look up a cached reply.
+
+        Returns:
+            The cached reply, or None on a miss
+        """
+        bucket = self._bucket(tenant, language, intent, relevant_data)
+        reply = self.cache.get(self._key(bucket, normalized_query))
+        if reply is not None or not self.semantic:
+            return reply
+
+        variants = self._variants.get(bucket)
+        if not variants:
+            return None
+        vectors = await embed_texts([normalized_query])
+        if not vectors:
+            return None
+
+        best_score, best_key = 0.0, None
+        for vector, key in variants:
+            score = cosine_similarity(vectors[0], vector)
+            if score > best_score:
+                best_score, best_key = score, key
+        if best_key is None or best_score < self.similarity_threshold:
+            return None
+
+        reply = self.cache.get(best_key)
+        if reply is None:
+            # Entry expired or was invalidated, forget its embedding as well
+            self._variants[bucket] = [variant for variant in variants if variant[1] != best_key]
+            return None
+        self.semantic_hits += 1
+        logger.debug(f"Semantic response cache hit ({best_score:.3f}) for '{normalized_query}' -> '{best_key[3]}'")
+        return reply
+
+    async def set(self, tenant: str, language: str, intent: str, normalized_query: str, relevant_data: List[Dict], reply: str) -> None:
+        """Store a generated reply."""
+        bucket = self._bucket(tenant, language, intent, relevant_data)
+        key = self._key(bucket, normalized_query)
+        self.cache.set(key, reply)
+
+        if self.semantic:
+            vectors = await embed_texts([normalized_query])
+            if vectors:
+                variants = [variant for variant in self._variants.get(bucket, []) if variant[1] != key]
+                variants.append((vectors[0], key))
+                self._variants[bucket] = variants[-RESPONSE_CACHE_MAX_VARIANTS:]
+
+    def invalidate_product(self, tenant: str, product_id: str) -> int:
+        """Drop every reply whose prompt included the product."""
+        removed = self.cache.invalidate_tenant(tenant, lambda key: product_id in key[4])
+        for bucket in [bucket for bucket in self._variants if bucket[0] == tenant and product_id in bucket[3]]:
+            del self._variants[bucket]
+        return removed
+
+    def invalidate_tenant(self, tenant: str, language: Optional[str] = None) -> int:
+        """Drop a tenant's replies (optionally only for one language)."""
+        removed = self.cache.invalidate_tenant(tenant, (lambda key: key[1] == language) if language else None)
+        for bucket in [bucket for bucket in self._variants if bucket[0] == tenant and (language is None or bucket[1] == language)]:
+            del self._variants[bucket]
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats()
+        stats["semantic"] = self.semantic
+        stats["semantic_hits"] = self.semantic_hits
+        return stats
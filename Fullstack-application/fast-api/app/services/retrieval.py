@@ -0,0 +1,102 @@
+"""
+Concurrent retrieval for the chat pipeline.
+
+Independent lookups (product names, category/price search, QA items, recommendation
+fallback, human chat availability) are started together and collected under one
+deadline. Branches that are still running at the deadline are cancelled and left out,
+so a slow lookup costs that branch's data instead of delaying the whole turn.
+
+Product lookups that the local pre-classifier can already predict (category, price
+range, general recommendations) are started speculatively while Gemini NLU runs and
+reused if the final entities ask for the same lookup (see SpeculativeRetrieval).
+"""
+
+import os
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from app.utils.logging_config import get_module_logger
+from app.services.llm_client import LatencyBudget
+
+logger = get_module_logger(__name__)
+
+# Upper bound (seconds) for the retrieval stage of one chat turn
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "2.0"))
+# Share of the remaining request latency budget retrieval may use
+RETRIEVAL_BUDGET_SHARE = 0.3
+# Start predictable product lookups while Gemini NLU is still running
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+
+
+def retrieval_timeout(budget: Optional[LatencyBudget] = None) -> float:
+    """Seconds the retrieval stage may take for this request."""
+    if budget is None:
+        return RETRIEVAL_TIMEOUT
+    return min(RETRIEVAL_TIMEOUT, budget.slice(RETRIEVAL_BUDGET_SHARE))
+
+async def gather_within(branches: Dict[str, Awaitable], timeout: float, label: str = "Retrieval") -> Dict[str, Any]:
+    """
+    Run named branches concurrently and collect what finishes within the timeout.
+
+    Args:
+        branches: Branch name -> coroutine or task
+        timeout: Seconds to wait for all branches
+        label: Name used in log messages
+
+    Returns:
+        Branch name -> result for branches that completed successfully; failed and
+        timed out branches are missing (and logged)
+    """
+    if not branches:
+        return {}
+    tasks = {name: asyncio.ensure_future(branch) for name, branch in branches.items()}
+    done, pending = await asyncio.wait(tasks.values(), timeout=max(timeout, 0.0))
+
+    for task in pending:
+        task.cancel()
+    if pending:
+        slow = [name for name, task in tasks.items() if task in pending]
+        logger.warning(f"{label}: deadline of {timeout:.2f}s reached, continuing without {slow}")
+
+    results = {}
+    for name, task in tasks.items():
+        if task not in done or task.cancelled():
+            continue
+        if task.exception() is not None:
+            logger.error(f"{label}: branch '{name}' failed: {task.exception()}")
+            continue
+        results[name] = task.result()
+    return results
+
+
+class SpeculativeRetrieval:
+    """
+    Lookups started from the local pre-classifier's guess while Gemini NLU is running.
+
+    Each lookup is keyed by a signature (e.g. ("category", "kola")). Once the real
+    entities are known, the retrieval stage takes the tasks whose signature it needs
+    and everything else is cancelled.
+    """
+
+    stats = {"started": 0, "used": 0, "discarded": 0}
+
+    def __init__(self, lookups: Dict[Tuple, Callable[[], Awaitable]]):
+        self._tasks: Dict[Tuple, asyncio.Task] = {}
+        for signature, factory in lookups.items():
+            self._tasks[signature] = asyncio.ensure_future(factory())
+        SpeculativeRetrieval.stats["started"] += len(self._tasks)
+
+    def take(self, signature: Tuple) -> Optional[asyncio.Task]:
+        """The speculative task for a lookup, or None if it wasn't started."""
+        task = self._tasks.pop(signature, None)
+        if task is not None:
+            SpeculativeRetrieval.stats["used"] += 1
+        return task
+
+    def discard(self) -> None:
+        """Cancel the lookups nobody took."""
+        for task in self._tasks.values():
+            task.cancel()
+        if self._tasks:
+            SpeculativeRetrieval.stats["discarded"] += len(self._tasks)
+            logger.debug(f"Discarded speculative lookups: {list(self._tasks)}")
+        self._tasks = {}
@@ -6,6 +6,7 @@ import re
 import json
 from collections import defaultdict
 from app.utils.logging_config import get_module_logger
+from app.utils.keyword_matcher import KeywordHits, match_keywords
 
 logger = get_module_logger(__name__)
 
@@ -147,7 +148,9 @@ class EnhancedConversationContext(BaseModel):
         """
         Applies domain-specific processing based on detected category
         """
-        category = self.category or self._detect_category_from_query(query)
+        # One pass over the query finds the category and all domain attribute keywords
+        hits = match_keywords(query)
+        category = self.category or hits.first("category")
         
         if not category:
             logger.debug("No category detected for domain-specific processing")
@@ -170,34 +173,16 @@ class EnhancedConversationContext(BaseModel):
         handler = domain_handlers.get(category, self._process_generic_domain)
         
         # Call the domain-specific handler
-        handler(query, entities)
+        handler(query, entities, hits)
         
     def _detect_category_from_query(self, query: str) -> Optional[str]:
         """
         Detects product category from query if not already present in context
         """
-        query_lower = query.lower()
-        
-        # Map of category keywords - extensible for any new domain
-        category_keywords = {
-            "kolo": ["kolo", "kola", "jízdní", "bicykl", "bike"],
-            "televize": ["televize", "tv", "televizor", "televizní"],
-            "notebook": ["notebook", "laptop", "notebooky", "počítač"],
-            "smartphone": ["smartphone", "telefon", "mobil", "iphone", "android"],
-            "pračka": ["pračka", "pračky", "prát", "praní"],
-            "lednička": ["lednička", "lednice", "chladnička", "chladit"],
-            "myčka": ["myčka", "myčky", "myčka nádobí", "nádobí"],
-            "vysavač": ["vysavač", "vysavače", "vysávat", "úklid"]
-        }
-        
-        # Check each category's keywords
-        for category, keywords in category_keywords.items():
-            if any(keyword in query_lower for keyword in keywords):
-                return category
-                
-        return None
+        # Category keywords are defined in KEYWORD_VOCABULARY["category"]
+        return match_keywords(query).first("category")
         
-    def _process_bike_domain(self, query: str, entities: Dict[str, Any]) -> None:
+    def _process_bike_domain(self, query: str, entities: Dict[str, Any], hits: KeywordHits) -> None:
         """
         Process bike-specific attributes and constraints
         """
@@ -205,21 +190,9 @@ class EnhancedConversationContext(BaseModel):
         
         # Extract bike type if not already present
         if "bike_type" not in self.attributes:
-            bike_types = {
-                "horské": "mountain",
-                "mtb": "mountain",
-                "silniční": "road",
-                "městské": "city",
-                "trekové": "trekking",
-                "dětské": "kids",
-                "elektro": "electric",
-                "gravel": "gravel"
-            }
-            
-            for keyword, bike_type in bike_types.items():
-                if keyword in query_lower:
-                    self.attributes["bike_type"] = bike_type
-                    break
+            bike_type = hits.first("bike_type")
+            if bike_type:
+                self.attributes["bike_type"] = bike_type
         
         # Extract wheel size
         wheel_patterns = [
@@ -235,41 +208,16 @@ class EnhancedConversationContext(BaseModel):
                 self.attributes[attr_name] = float(match.group(1).replace(",", "."))
         
         # Extract bike-specific features if not in entities
-        bike_features = {
-            "odpružení": ["odpružení", "odpružená vidlice", "tlumiče", "tlumič"],
-            "převody": ["převody", "přehazovačka", "řazení", "rychlosti"],
-            "brzdy": ["brzdy", "kotoučové brzdy", "diskové brzdy", "hydraulické brzdy"],
-            "rám": ["rám", "karbonový", "hliníkový", "ocelový", "karbon", "hliník"],
-            "hmotnost": ["hmotnost", "lehké", "váha", "těžké", "kilogramů"]
-        }
-        
-        for feature_name, keywords in bike_features.items():
-            if any(keyword in query_lower for keyword in keywords):
-                if "bike_features" not in self.attributes:
-                    self.attributes["bike_features"] = []
-                if feature_name not in self.attributes["bike_features"]:
-                    self.attributes["bike_features"].append(feature_name)
+        for feature_name in hits.values("bike_feature"):
+            if "bike_features" not in self.attributes:
+                self.attributes["bike_features"] = []
+            if feature_name not in self.attributes["bike_features"]:
+                self.attributes["bike_features"].append(feature_name)
         
         # Extract bike use case
-        bike_use_cases = {
-            "do města": "commuting",
-            "na dojíždění": "commuting",
-            "do práce": "commuting",
-            "do terénu": "off-road",
-            "do hor": "mountain",
-            "na hory": "mountain",
-            "na výlety": "touring",
-            "na dlouhé trasy": "touring",
-            "do sněhu": "winter",
-            "zimní": "winter",
-            "na triky": "freestyle",
-            "do závodu": "racing"
-        }
-        
-        for keyword, use_case in bike_use_cases.items():
-            if keyword in query_lower:
-                self.attributes["bike_use_case"] = use_case
-                break
+        bike_use_case = hits.first("bike_use_case")
+        if bike_use_case:
+            self.attributes["bike_use_case"] = bike_use_case
                 
         # Store size information from entities if available
         if "frame_size" in entities:
@@ -286,7 +234,7 @@ class EnhancedConversationContext(BaseModel):
             if "zimní pneumatiky" not in self.required_features:
                 self.required_features.append("zimní pneumatiky")
                 
-    def _process_tv_domain(self, query: str, entities: Dict[str, Any]) -> None:
+    def _process_tv_domain(self, query: str, entities: Dict[str, Any], hits: KeywordHits) -> None:
         """
         Process TV-specific attributes and constraints
         """
@@ -308,49 +256,24 @@ class EnhancedConversationContext(BaseModel):
                 break
         
         # Extract resolution
-        resolution_keywords = {
-            "4k": "4K", 
-            "ultra hd": "4K", 
-            "uhd": "4K",
-            "full hd": "Full HD", 
-            "fhd": "Full HD", 
-            "1080p": "Full HD",
-            "8k": "8K",
-            "hd ready": "HD Ready",
-            "720p": "HD Ready"
-        }
-        
-        for keyword, resolution in resolution_keywords.items():
-            if keyword in query_lower:
-                self.attributes["resolution"] = resolution
-                break
+        resolution = hits.first("tv_resolution")
+        if resolution:
+            self.attributes["resolution"] = resolution
         
         # Extract display technology
-        display_tech = {
-            "oled": "OLED",
-            "qled": "QLED",
-            "led": "LED",
-            "mini led": "Mini LED",
-            "lcd": "LCD",
-            "plasma": "Plasma"
-        }
-        
-        for keyword, tech in display_tech.items():
-            if keyword in query_lower:
-                self.attributes["display_technology"] = tech
-                break
+        display_technology = hits.first("display_technology")
+        if display_technology:
+            self.attributes["display_technology"] = display_technology
                 
         # Extract smart features
-        if "smart" in query_lower or "android" in query_lower:
+        if hits.has("smart_tv"):
             self.attributes["smart_tv"] = True
             
         # Extract HDR support
-        hdr_types = ["hdr", "hdr10", "hdr10+", "dolby vision", "hlg"]
-        for hdr_type in hdr_types:
-            if hdr_type in query_lower:
-                self.attributes["hdr_support"] = True
-                self.attributes["hdr_type"] = hdr_type.upper()
-                break
+        hdr_type = hits.first("hdr_type")
+        if hdr_type:
+            self.attributes["hdr_support"] = True
+            self.attributes["hdr_type"] = hdr_type
                 
         # Extract refresh rate
         refresh_patterns = [r'(\d+)\s*hz']
@@ -360,32 +283,26 @@ class EnhancedConversationContext(BaseModel):
                 self.attributes["refresh_rate"] = int(match.group(1))
                 break
                 
-    def _process_laptop_domain(self, query: str, entities: Dict[str, Any]) -> None:
+    def _process_laptop_domain(self, query: str, entities: Dict[str, Any], hits: KeywordHits) -> None:
         """Process laptop-specific attributes"""
         query_lower = query.lower()
         
         # Extract processor info
-        processor_brands = {
-            "intel": ["intel", "core i7", "core i5", "core i3", "pentium", "celeron"],
-            "amd": ["amd", "ryzen", "athlon"]
-        }
-        
-        for brand, keywords in processor_brands.items():
-            if any(keyword in query_lower for keyword in keywords):
-                self.attributes["processor_brand"] = brand
-                
-                # Try to extract processor model
-                processor_patterns = [
-                    r'i(\d)\s*-\s*(\d{4,5})',  # Intel pattern like i7-10750H
-                    r'ryzen\s*(\d)',  # AMD pattern like Ryzen 7
-                ]
-                
-                for pattern in processor_patterns:
-                    match = re.search(pattern, query_lower)
-                    if match:
-                        self.attributes["processor_model"] = match.group(0)
-                        break
-                break
+        processor_brand = hits.first("processor_brand")
+        if processor_brand:
+            self.attributes["processor_brand"] = processor_brand
+            
+            # Try to extract processor model
+            processor_patterns = [
+                r'i(\d)\s*-\s*(\d{4,5})',  # Intel pattern like i7-10750H
+                r'ryzen\s*(\d)',  # AMD pattern like Ryzen 7
+            ]
+            
+            for pattern in processor_patterns:
+                match = re.search(pattern, query_lower)
+                if match:
+                    self.attributes["processor_model"] = match.group(0)
+                    break
         
         # Extract RAM
         ram_patterns = [r'(\d+)\s*gb\s*ram', r'ram\s*(\d+)\s*gb']
@@ -433,36 +350,18 @@ class EnhancedConversationContext(BaseModel):
                 break
                 
         # Extract laptop type/purpose
-        laptop_types = {
-            "herní": "gaming",
-            "na hry": "gaming",
-            "pracovní": "business",
-            "na práci": "business",
-            "kancelářský": "office",
-            "do kanceláře": "office",
-            "studentský": "student",
-            "pro studenty": "student",
-            "na cesty": "travel",
-            "přenosný": "portable",
-            "konvertibilní": "convertible",
-            "2v1": "convertible"
-        }
-        
-        for keyword, laptop_type in laptop_types.items():
-            if keyword in query_lower:
-                self.attributes["laptop_type"] = laptop_type
-                break
+        laptop_type = hits.first("laptop_type")
+        if laptop_type:
+            self.attributes["laptop_type"] = laptop_type
                 
-    def _process_smartphone_domain(self, query: str, entities: Dict[str, Any]) -> None:
+    def _process_smartphone_domain(self, query: str, entities: Dict[str, Any], hits: KeywordHits) -> None:
         """Process smartphone-specific attributes"""
         query_lower = query.lower()
         
         # Common smartphone brands
-        brands = ["samsung", "apple", "iphone", "xiaomi", "huawei", "google", "pixel", "oneplus", "sony", "nokia"]
-        for brand in brands:
-            if brand in query_lower:
-                self.attributes["phone_brand"] = brand
-                break
+        phone_brand = hits.first("phone_brand")
+        if phone_brand:
+            self.attributes["phone_brand"] = phone_brand
                 
         # Extract storage capacity
         storage_patterns = [r'(\d+)\s*gb', r'(\d+)\s*tb']
@@ -496,12 +395,11 @@ class EnhancedConversationContext(BaseModel):
                 break
                 
         # Extract operating system
-        if "android" in query_lower:
-            self.attributes["os"] = "Android"
-        elif any(ios_term in query_lower for ios_term in ["ios", "iphone", "apple"]):
-            self.attributes["os"] = "iOS"
+        phone_os = hits.first("phone_os")
+        if phone_os:
+            self.attributes["os"] = phone_os
             
-    def _process_washer_domain(self, query: str, entities: Dict[str, Any]) -> None:
+    def _process_washer_domain(self, query: str, entities: Dict[str, Any], hits: KeywordHits) -> None:
         """Process washing machine specific attributes"""
         query_lower = query.lower()
         
@@ -540,26 +438,11 @@ class EnhancedConversationContext(BaseModel):
                 break
                 
         # Extract washing machine type
-        washer_types = {
-            "předem plněná": "front_load",
-            "předem": "front_load",
-            "zepředu": "front_load",
-            "vrchem plněná": "top_load",
-            "vrchem": "top_load",
-            "shora": "top_load",
-            "slim": "slim",
-            "úzká": "slim",
-            "pračka se sušičkou": "washer_dryer",
-            "kombinovaná": "washer_dryer",
-            "s funkcí sušičky": "washer_dryer"
-        }
-        
-        for phrase, washer_type in washer_types.items():
-            if phrase in query_lower:
-                self.attributes["washer_type"] = washer_type
-                break
+        washer_type = hits.first("washer_type")
+        if washer_type:
+            self.attributes["washer_type"] = washer_type
                 
-    def _process_generic_domain(self, query: str, entities: Dict[str, Any]) -> None:
+    def _process_generic_domain(self, query: str, entities: Dict[str, Any], hits: KeywordHits) -> None:
         """
         Process entities for any product domain with general attribute extraction
         """
@@ -606,40 +489,16 @@ class EnhancedConversationContext(BaseModel):
                 break
                 
         # Extract material
-        materials = {
-            "dřevěný": "wood",
-            "dřevo": "wood",
-            "kovový": "metal",
-            "kov": "metal",
-            "ocelový": "steel",
-            "ocel": "steel",
-            "plastový": "plastic",
-            "plast": "plastic",
-            "skleněný": "glass",
-            "sklo": "glass",
-            "hliníkový": "aluminum",
-            "hliník": "aluminum",
-            "karbonový": "carbon",
-            "karbon": "carbon"
-        }
-        
-        for keyword, material in materials.items():
-            if keyword in query_lower:
-                self.attributes["material"] = material
-                break
+        material = hits.first("material")
+        if material:
+            self.attributes["material"] = material
                 
         # Extract connectivity features
-        connectivity_features = [
-            "wifi", "wi-fi", "bluetooth", "nfc", "usb", "hdmi", 
-            "bezdrátové připojení", "bezdrátový", "online"
-        ]
-        
-        for feature in connectivity_features:
-            if feature in query_lower:
-                if "connectivity" not in self.attributes:
-                    self.attributes["connectivity"] = []
-                if feature not in self.attributes["connectivity"]:
-                    self.attributes["connectivity"].append(feature)
+        for feature in hits.values("connectivity"):
+            if "connectivity" not in self.attributes:
+                self.attributes["connectivity"] = []
+            if feature not in self.attributes["connectivity"]:
+                self.attributes["connectivity"].append(feature)
                     
     def _resolve_attribute_conflicts(self) -> None:
         """
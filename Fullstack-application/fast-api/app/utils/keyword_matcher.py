@@ -0,0 +1,396 @@
+"""
+Compiled keyword matching for query routing.
+
+Every keyword list used to route a chat message (order and product questions, product
+categories, pre-classifier intent rules, domain attributes) lives in KEYWORD_VOCABULARY.
+The lists are compiled into one Aho-Corasick automaton, so a message is scanned once and
+all hits come back with their type instead of each list running its own substring scan.
+
+Keywords and text are folded (lowercase, no diacritics) before matching and, as with the
+substring checks this replaces, a keyword matches anywhere in the text, except for the
+WHOLE_WORD_KEYWORDS, which must not touch a letter or digit on either side. The text is
+padded with a space on both sides so keywords written with surrounding spaces (" vs ") also
+match at the start and end of a message.
+
+Tenant matchers add the tenant's catalog vocabulary (category and brand names) on top of
+the shared vocabulary, see KnowledgeBase.keyword_matcher.
+"""
+
+import unicodedata
+from collections import deque
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+# keyword type -> value -> language -> keywords
+# Values are listed in priority order: KeywordHits.first() prefers the earlier value
+# (and the earlier keyword within a value), like the dict iteration it replaces.
+# A new language only needs its keywords added here.
+KEYWORD_VOCABULARY: Dict[str, Dict[str, Dict[str, List[str]]]] = {
+    # Order status questions (chat.py, answered from the orders collection)
+    "order": {
+        "order": {
+            "cs": ["objednávk", "zásilk", "balik", "doručení"],
+            "en": ["order", "tracking", "track", "package", "delivery"]
+        }
+    },
+    # Product questions misclassified as general ones (chat.py intent override)
+    "product_query": {
+        "product": {
+            "cs": ["produkt", "zboží", "sortiment", "nabídk", "máte", "prodáváte"],
+            "en": ["product", "goods", "assortment", "offer", "have", "sell", "inventory", "items"]
+        }
+    },
+    # Product domains (EnhancedConversationContext, pre-classifier)
+    "category": {
+        "kolo": {"cs": ["kolo", "kola", "jízdní", "bicykl"], "en": ["bike"]},
+        "televize": {"cs": ["televize", "tv", "televizor", "televizní"]},
+        "notebook": {"cs": ["notebook", "notebooky", "počítač"], "en": ["laptop"]},
+        "smartphone": {"cs": ["telefon", "mobil"], "en": ["smartphone", "iphone", "android"]},
+        "pračka": {"cs": ["pračka", "pračky", "prát", "praní"]},
+        "lednička": {"cs": ["lednička", "lednice", "chladnička", "chladit"]},
+        "myčka": {"cs": ["myčka", "myčky", "myčka nádobí", "nádobí"]},
+        "vysavač": {"cs": ["vysavač", "vysavače", "vysávat", "úklid"]}
+    },
+    # Terms that refer to products of the current category (AIService._infer_products_from_context)
+    "product_term": {
+        "smartphone": {"cs": ["telefon", "mobil"], "en": ["smartphone", "iphone", "samsung", "xiaomi"]},
+        "notebook": {"cs": ["počítač"], "en": ["notebook", "laptop", "macbook", "lenovo", "hp", "dell"]},
+        "televize": {"cs": ["televize", "televizor"], "en": ["tv", "smart tv", "led", "oled"]},
+        "kolo": {"cs": ["kolo", "bicykl", "elektrokolo"], "en": ["bike"]}
+    },
+    # Pre-classifier intent rules: strong keywords alone are enough for a confident
+    # prediction ("intent"), weak ones only add evidence ("intent_hint")
+    "intent": {
+        "shipping_payment": {
+            "cs": ["doprava", "doprav", "postovne", "dobirk", "platba", "platit", "zaplatit", "platebni"],
+            "en": ["shipping", "delivery cost", "payment", "pay by", "cash on delivery"]
+        },
+        "customer_service": {
+            "cs": ["reklamac", "reklamov", "vraceni", "vratit", "zaruk", "zarucni", "storno", "odstoupit"],
+            "en": ["complaint", "refund", "return", "warranty", "cancel"]
+        },
+        "store_navigation": {
+            "cs": ["oteviraci doba", "kde najdu", "kde je", "adresa", "kontakt", "pobock", "prodejn"],
+            "en": ["opening hours", "where can i find", "where is", "address", "contact", "store location"]
+        },
+        "product_comparison": {
+            "cs": ["porovn", "srovn", "rozdil mezi", "lepsi nez"],
+            "en": ["compare", "comparison", "difference between", "better than"]
+        },
+        "accessory_recommendation": {
+            "cs": ["prislusenstvi"],
+            "en": ["accessor"]
+        },
+        "technical_explanation": {
+            "cs": ["jak funguje", "co znamena", "vysvetli"],
+            "en": ["how does", "what does", "what is the difference", "explain"]
+        },
+        "product_recommendation": {
+            "cs": ["doporuc", "poradte", "poradit", "jake mate", "co mate", "mate nejak", "hledam", "chtel bych",
+                   "chtela bych", "sortiment", "nabidk", "prodavate"],
+            "en": ["recommend", "looking for", "do you have", "do you sell", "what products", "show me", "i want", "i need"]
+        },
+        "general_question": {
+            "cs": ["ahoj", "dobry den", "zdravim", "dekuji", "diky", "nashledanou"],
+            "en": ["hello", "hi", "good morning", "thank", "bye"]
+        }
+    },
+    "intent_hint": {
+        "shipping_payment": {
+            "cs": ["kartou", "prevodem", "zdarma", "zasilkovn", "ppl", "dpd", "gls"],
+            "en": ["free", "card"]
+        },
+        "customer_service": {
+            "cs": ["problem", "rozbit", "nefunguj", "servis"],
+            "en": ["broken", "not working", "service"]
+        },
+        "store_navigation": {
+            "cs": ["telefon na vas", "email na vas", "mapa"],
+            "en": ["map"]
+        },
+        "product_comparison": {
+            "cs": [" nebo "],
+            "en": [" vs ", " versus ", " or "]
+        },
+        "accessory_recommendation": {
+            "cs": ["k tomu", "pouzdro", "nabijeck", "obal", "kabel"],
+            "en": ["case", "charger", "cable"]
+        },
+        "technical_explanation": {
+            "cs": ["parametr", "specifikac", "technick"],
+            "en": ["spec", "technical"]
+        },
+        "product_recommendation": {
+            "cs": ["produkt", "zbozi", "mate ", "koupit", "levn", "nejlepsi"],
+            "en": ["product", "buy", "cheap", "best"]
+        }
+    },
+    # Domain attributes (EnhancedConversationContext domain handlers)
+    "bike_type": {
+        "mountain": {"cs": ["horské", "mtb"]},
+        "road": {"cs": ["silniční"]},
+        "city": {"cs": ["městské"]},
+        "trekking": {"cs": ["trekové"]},
+        "kids": {"cs": ["dětské"]},
+        "electric": {"cs": ["elektro"]},
+        "gravel": {"cs": ["gravel"]}
+    },
+    "bike_feature": {
+        "odpružení": {"cs": ["odpružení", "odpružená vidlice", "tlumiče", "tlumič"]},
+        "převody": {"cs": ["převody", "přehazovačka", "řazení", "rychlosti"]},
+        "brzdy": {"cs": ["brzdy", "kotoučové brzdy", "diskové brzdy", "hydraulické brzdy"]},
+        "rám": {"cs": ["rám", "karbonový", "hliníkový", "ocelový", "karbon", "hliník"]},
+        "hmotnost": {"cs": ["hmotnost", "lehké", "váha", "těžké", "kilogramů"]}
+    },
+    "bike_use_case": {
+        "commuting": {"cs": ["do města", "na dojíždění", "do práce"]},
+        "off-road": {"cs": ["do terénu"]},
+        "mountain": {"cs": ["do hor", "na hory"]},
+        "touring": {"cs": ["na výlety", "na dlouhé trasy"]},
+        "winter": {"cs": ["do sněhu", "zimní"]},
+        "freestyle": {"cs": ["na triky"]},
+        "racing": {"cs": ["do závodu"]}
+    },
+    "tv_resolution": {
+        "4K": {"en": ["4k", "ultra hd", "uhd"]},
+        "Full HD": {"en": ["full hd", "fhd", "1080p"]},
+        "8K": {"en": ["8k"]},
+        "HD Ready": {"en": ["hd ready", "720p"]}
+    },
+    "display_technology": {
+        "OLED": {"en": ["oled"]},
+        "QLED": {"en": ["qled"]},
+        "LED": {"en": ["led"]},
+        "Mini LED": {"en": ["mini led"]},
+        "LCD": {"en": ["lcd"]},
+        "Plasma": {"en": ["plasma"]}
+    },
+    "smart_tv": {
+        "smart": {"en": ["smart", "android"]}
+    },
+    "hdr_type": {
+        "HDR": {"en": ["hdr"]},
+        "HDR10": {"en": ["hdr10"]},
+        "HDR10+": {"en": ["hdr10+"]},
+        "DOLBY VISION": {"en": ["dolby vision"]},
+        "HLG": {"en": ["hlg"]}
+    },
+    "processor_brand": {
+        "intel": {"en": ["intel", "core i7", "core i5", "core i3", "pentium", "celeron"]},
+        "amd": {"en": ["amd", "ryzen", "athlon"]}
+    },
+    "laptop_type": {
+        "gaming": {"cs": ["herní", "na hry"]},
+        "business": {"cs": ["pracovní", "na práci"]},
+        "office": {"cs": ["kancelářský", "do kanceláře"]},
+        "student": {"cs": ["studentský", "pro studenty"]},
+        "travel": {"cs": ["na cesty"]},
+        "portable": {"cs": ["přenosný"]},
+        "convertible": {"cs": ["konvertibilní", "2v1"]}
+    },
+    "phone_brand": {
+        brand: {"en": [brand]}
+        for brand in ["samsung", "apple", "iphone", "xiaomi", "huawei", "google", "pixel", "oneplus", "sony", "nokia"]
+    },
+    "phone_os": {
+        "Android": {"en": ["android"]},
+        "iOS": {"en": ["ios", "iphone", "apple"]}
+    },
+    "washer_type": {
+        "front_load": {"cs": ["předem plněná", "předem", "zepředu"]},
+        "top_load": {"cs": ["vrchem plněná", "vrchem", "shora"]},
+        "slim": {"cs": ["úzká"], "en": ["slim"]},
+        "washer_dryer": {"cs": ["pračka se sušičkou", "kombinovaná", "s funkcí sušičky"]}
+    },
+    "material": {
+        "wood": {"cs": ["dřevěný", "dřevo"]},
+        "metal": {"cs": ["kovový", "kov"]},
+        "steel": {"cs": ["ocelový", "ocel"]},
+        "plastic": {"cs": ["plastový", "plast"]},
+        "glass": {"cs": ["skleněný", "sklo"]},
+        "aluminum": {"cs": ["hliníkový", "hliník"]},
+        "carbon": {"cs": ["karbonový", "karbon"]}
+    },
+    "connectivity": {
+        feature: {"cs" if "bezdrát" in feature else "en": [feature]}
+        for feature in ["wifi", "wi-fi", "bluetooth", "nfc", "usb", "hdmi", "bezdrátové připojení", "bezdrátový", "online"]
+    }
+}
+
+# Short keywords that only match as whole words ("hi" must not hit inside "sushi")
+WHOLE_WORD_KEYWORDS = {"hi"}
+
+# Languages with keywords in the vocabulary
+KEYWORD_LANGUAGES = sorted({
+    language for values in KEYWORD_VOCABULARY.values() for languages in values.values() for language in languages
+})
+
+
+def fold_text(text: str) -> str:
+    """Lowercase and strip diacritics (e.g. 'Jaké máte kola?' -> 'jake mate kola?')."""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in normalized if not unicodedata.combining(char))
+
+
+class KeywordEntry(NamedTuple):
+    pattern: str             # Folded keyword the automaton matches
+    type: str                # Keyword type (e.g. "category", "order", "brand")
+    value: Any               # What the keyword stands for (e.g. "kolo")
+    keyword: str             # Keyword as written in the vocabulary / catalog
+    language: Optional[str]  # None for catalog vocabulary
+    rank: int                # Priority within the type (lower wins)
+    whole_word: bool = False # Only match between non-alphanumeric characters
+
+
+class KeywordHit(NamedTuple):
+    type: str
+    value: Any
+    keyword: str
+    language: Optional[str]
+    start: int  # Offsets into the folded text
+    end: int
+    rank: int
+
+
+class KeywordHits(list):
+    """
+    All keyword hits of one text, in the order they end in the text.
+    """
+
+    def of_type(self, keyword_type: str, language: Optional[str] = None) -> List[KeywordHit]:
+        return [hit for hit in self if hit.type == keyword_type and (language is None or hit.language == language)]
+
+    def has(self, keyword_type: str, language: Optional[str] = None) -> bool:
+        return any(hit.type == keyword_type and (language is None or hit.language == language) for hit in self)
+
+    def first(self, keyword_type: str) -> Optional[Any]:
+        """The value of the highest priority hit of a type, or None."""
+        hits = self.of_type(keyword_type)
+        return min(hits, key=lambda hit: hit.rank).value if hits else None
+
+    def values(self, keyword_type: str) -> List[Any]:
+        """Distinct values hit for a type, in priority order."""
+        values = []
+        for hit in sorted(self.of_type(keyword_type), key=lambda hit: hit.rank):
+            if hit.value not in values:
+                values.append(hit.value)
+        return values
+
+    def keywords(self, keyword_type: str, value: Any = None) -> List[str]:
+        """Distinct keywords hit for a type (and value), in priority order."""
+        keywords = []
+        for hit in sorted(self.of_type(keyword_type), key=lambda hit: hit.rank):
+            if (value is None or hit.value == value) and hit.keyword not in keywords:
+                keywords.append(hit.keyword)
+        return keywords
+
+    def count(self, keyword_type: str, value: Any) -> int:
+        """Number of distinct keywords hit for a type and value."""
+        return len({hit.keyword for hit in self if hit.type == keyword_type and hit.value == value})
+
+
+def vocabulary_entries(vocabulary: Dict[str, Dict[str, Dict[str, List[str]]]] = KEYWORD_VOCABULARY) -> List[KeywordEntry]:
+    """Flatten a type -> value -> language -> keywords vocabulary into ranked entries."""
+    entries = []
+    for keyword_type, values in vocabulary.items():
+        rank = 0
+        for value, languages in values.items():
+            for language, keywords in languages.items():
+                for keyword in keywords:
+                    pattern = fold_text(keyword)
+                    entries.append(KeywordEntry(pattern, keyword_type, value, keyword, language, rank, pattern in WHOLE_WORD_KEYWORDS))
+                    rank += 1
+    return entries
+
+def catalog_entries(keyword_type: str, names: Iterable[str], min_length: int = 3) -> List[KeywordEntry]:
+    """Entries for catalog names (e.g. a tenant's categories), each name standing for itself."""
+    entries = []
+    for rank, name in enumerate(names):
+        if name and len(name.strip()) >= min_length:
+            entries.append(KeywordEntry(fold_text(name.strip()), keyword_type, name, name, None, rank))
+    return entries
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over a set of keyword entries.
+    """
+
+    def __init__(self, entries: Iterable[KeywordEntry]):
+        self.entries: List[KeywordEntry] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+
+        seen = set()
+        for entry in entries:
+            key = (entry.pattern, entry.type, entry.value)
+            if not entry.pattern or key in seen:
+                continue
+            seen.add(key)
+            self._insert(entry.pattern, len(self.entries))
+            self.entries.append(entry)
+        self._link()
+
+    def _insert(self, pattern: str, entry_index: int) -> None:
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append(entry_index)
+
+    def _link(self) -> None:
+        """Compute failure links breadth-first and merge outputs along them."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def match(self, text: str) -> KeywordHits:
+        """Scan text once and return every keyword hit."""
+        padded = f" {fold_text(text)} "
+        hits = KeywordHits()
+        node = 0
+        for position, char in enumerate(padded):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for entry_index in self._output[node]:
+                entry = self.entries[entry_index]
+                start = position + 1 - len(entry.pattern)
+                if entry.whole_word and (padded[start - 1].isalnum() or padded[position + 1:position + 2].isalnum()):
+                    continue
+                hits.append(KeywordHit(
+                    entry.type, entry.value, entry.keyword, entry.language,
+                    max(start - 1, 0), position, entry.rank
+                ))
+        return hits
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+_default_matcher: Optional[KeywordMatcher] = None
+
+def get_default_matcher() -> KeywordMatcher:
+    """Get or create the matcher for the shared vocabulary (no tenant catalog)"""
+    global _default_matcher
+    if _default_matcher is None:
+        _default_matcher = KeywordMatcher(vocabulary_entries())
+    return _default_matcher
+
+def match_keywords(text: str) -> KeywordHits:
+    """Match text against the shared vocabulary."""
+    return get_default_matcher().match(text)
@@ -5,7 +5,7 @@ from fastapi import HTTPException
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import ConnectionFailure, OperationFailure
 from dotenv import load_dotenv
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 from pymongo import ASCENDING, TEXT
 from app.utils.logging_config import get_module_logger
 from functools import lru_cache
@@ -609,6 +609,41 @@ async def update_contact_submission_status(submission_id: str, completed: bool,
         return False
 
 # Shop Info CRUD functions
+
+# Callbacks run when a tenant's shop info changes, e.g. to drop cached prompts or NLU results.
+# Signature: callback(user_id, language)
+_shop_info_listeners: List[Callable[[Optional[str], str], None]] = []
+
+def register_shop_info_listener(callback: Callable[[Optional[str], str], None]) -> None:
+    """Register a callback notified whenever shop info is updated or reset."""
+    if callback not in _shop_info_listeners:
+        _shop_info_listeners.append(callback)
+
+def notify_shop_info_changed(user_id: Optional[str], language: str) -> None:
+    """Notify registered listeners that shop info for (user_id, language) changed."""
+    for callback in _shop_info_listeners:
+        try:
+            callback(user_id, language)
+        except Exception as e:
+            logger.error(f"Shop info listener {getattr(callback, '__name__', callback)} failed: {e}")
+
+# Callbacks run when a product is created, updated or deleted.
+# Signature: callback(user_id, product_id) where product_id is the str of the document _id
+_product_listeners: List[Callable[[Optional[str], str], None]] = []
+
+def register_product_listener(callback: Callable[[Optional[str], str], None]) -> None:
+    """Register a callback notified whenever a product is written."""
+    if callback not in _product_listeners:
+        _product_listeners.append(callback)
+
+def notify_product_changed(user_id: Optional[str], product_id: str) -> None:
+    """Notify registered listeners that a product changed."""
+    for callback in _product_listeners:
+        try:
+            callback(user_id, product_id)
+        except Exception as e:
+            logger.error(f"Product listener {getattr(callback, '__name__', callback)} failed: {e}")
+
 async def get_shop_info(language: str = "cs", user_id: str = None) -> Dict:
     """
     Retrieves shop information for the specified language and user.
@@ -700,6 +735,8 @@ async def update_shop_info(shop_info_update: Dict, language: str = "cs", user_id
         upsert=True
     )
     
+    notify_shop_info_changed(user_id, language)
+
     # Retrieve and return the updated document
     updated_info = await collection.find_one(filter_query)
     return serialize_mongo_doc(updated_info) if updated_info else None
@@ -738,6 +775,7 @@ async def create_indexes():
         # Make product id index sparse to handle null values
         await product_collection.create_index("id", unique=True, sparse=True)
         await product_collection.create_index("user_id")  # For multi-tenancy filtering
+        await product_collection.create_index("updated_at")  # Change polling of the KnowledgeBase sync
         
         # Widget Config Collection Indexes
         widget_config_collection = await get_widget_config_collection()
@@ -783,6 +821,9 @@ async def create_indexes():
         # Compound index for unique order per user per platform
         await orders_collection.create_index([("user_id", ASCENDING), ("platform_order_id", ASCENDING)], name="user_platform_order_unique", unique=True)
         await orders_collection.create_index("customer_email") # For potential lookups by email
+        # Order status lookups from the chat widget: owner + customer email + either order identifier
+        await orders_collection.create_index([("user_id", ASCENDING), ("customer_email", ASCENDING), ("platform_order_id", ASCENDING)], name="user_email_platform_order")
+        await orders_collection.create_index([("user_id", ASCENDING), ("customer_email", ASCENDING), ("order_number", ASCENDING)], name="user_email_order_number")
 
         # Shop Info Collection Indexes
         shop_info_collection = await get_shop_info_collection()
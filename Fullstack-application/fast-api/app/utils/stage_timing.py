@@ -0,0 +1,226 @@
+"""
+Per-stage latency spans for requests.
+
+ServerTimingMiddleware starts a RequestTimer for every request and keeps it in a
+context variable, so any code running for the request (chat.py, AIService, ...) can
+record spans with `with stage("nlu"):` without passing the timer around. When the
+request finishes the spans are:
+- returned to the client in a `Server-Timing` header,
+- added to per-stage and per-tenant latency histograms (see get_stage_metrics),
+- dumped to the log and kept in a slow request list when the total is above
+  PerformanceConfig.slow_request_threshold.
+
+Spans recorded after the timer finished (background tasks such as conversation
+persistence) still go to the histograms.
+"""
+
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from app.config.manager import PerformanceConfig
+from app.utils.logging_config import get_module_logger
+
+logger = get_module_logger(__name__)
+
+_performance_defaults = PerformanceConfig()
+# Same environment variables as the config manager (APP_ prefix, __ for nesting)
+SLOW_REQUEST_THRESHOLD = float(os.getenv("APP_PERFORMANCE__SLOW_REQUEST_THRESHOLD", _performance_defaults.slow_request_threshold))
+MAX_TRACKED_SLOW_REQUESTS = int(os.getenv("APP_PERFORMANCE__MAX_TRACKED_SLOW_REQUESTS", _performance_defaults.max_tracked_slow_requests))
+# Histogram bucket upper bounds in milliseconds (the last bucket is open-ended)
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+_current_timer: ContextVar[Optional["RequestTimer"]] = ContextVar("request_timer", default=None)
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram in milliseconds.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        index = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                index = i
+                break
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile (max for the open bucket)."""
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.buckets):
+            cumulative += count
+            if cumulative >= target:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else round(self.max_ms, 1)
+        return round(self.max_ms, 1)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": {
+                **{f"le_{bound}": self.buckets[i] for i, bound in enumerate(LATENCY_BUCKETS_MS)},
+                "inf": self.buckets[-1]
+            }
+        }
+
+
+class StageMetrics:
+    """
+    Per-stage and per-tenant latency histograms plus the most recent slow requests.
+    """
+
+    def __init__(self, max_slow_requests: int = MAX_TRACKED_SLOW_REQUESTS):
+        self.stages: Dict[str, LatencyHistogram] = {}
+        self.tenants: Dict[str, Dict[str, LatencyHistogram]] = {}
+        self.slow_requests: deque = deque(maxlen=max_slow_requests)
+
+    def observe(self, stage_name: str, ms: float, tenant: Optional[str] = None) -> None:
+        self.stages.setdefault(stage_name, LatencyHistogram()).observe(ms)
+        if tenant:
+            self.tenants.setdefault(tenant, {}).setdefault(stage_name, LatencyHistogram()).observe(ms)
+
+    def snapshot(self, tenant: Optional[str] = None) -> Dict[str, Any]:
+        """Histogram snapshots for all stages, or for one tenant's stages."""
+        if tenant is not None:
+            return {
+                "tenant": tenant,
+                "stages": {name: histogram.snapshot() for name, histogram in self.tenants.get(tenant, {}).items()},
+                "slow_requests": [entry for entry in self.slow_requests if entry["tenant"] == tenant]
+            }
+        return {
+            "slow_request_threshold": SLOW_REQUEST_THRESHOLD,
+            "stages": {name: histogram.snapshot() for name, histogram in self.stages.items()},
+            "tenants": {
+                tenant_id: {name: histogram.snapshot() for name, histogram in stages.items()}
+                for tenant_id, stages in self.tenants.items()
+            },
+            "slow_requests": list(self.slow_requests)
+        }
+
+
+_stage_metrics: Optional[StageMetrics] = None
+
+def get_stage_metrics() -> StageMetrics:
+    """Get or create the StageMetrics singleton"""
+    global _stage_metrics
+    if _stage_metrics is None:
+        _stage_metrics = StageMetrics()
+    return _stage_metrics
+
+
+class RequestTimer:
+    """
+    Spans recorded for one request.
+    """
+
+    def __init__(self, route: str):
+        self.route = route
+        self.tenant: Optional[str] = None
+        self.started_at = time.monotonic()
+        self.spans: List[tuple] = []  # (stage name, milliseconds)
+        self.finished = False
+        # Set by streaming endpoints that finish the timer themselves when the stream ends
+        self.deferred = False
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.started_at) * 1000
+
+    def record(self, stage_name: str, ms: float) -> None:
+        if self.finished:
+            get_stage_metrics().observe(stage_name, ms, self.tenant)
+        else:
+            self.spans.append((stage_name, ms))
+
+    def totals(self) -> Dict[str, float]:
+        """Milliseconds per stage (repeated stages are summed)."""
+        totals: Dict[str, float] = {}
+        for stage_name, ms in self.spans:
+            totals[stage_name] = totals.get(stage_name, 0.0) + ms
+        return totals
+
+    def server_timing_header(self) -> str:
+        parts = [f"{stage_name};dur={ms:.1f}" for stage_name, ms in self.totals().items()]
+        parts.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(parts)
+
+    def finish(self) -> None:
+        """Record the spans into the histograms and dump the breakdown if the request was slow."""
+        if self.finished or not self.spans:
+            self.finished = True
+            return
+        self.finished = True
+        total_ms = self.elapsed_ms()
+        totals = self.totals()
+        metrics = get_stage_metrics()
+        for stage_name, ms in totals.items():
+            metrics.observe(stage_name, ms, self.tenant)
+        metrics.observe("total", total_ms, self.tenant)
+
+        if total_ms > SLOW_REQUEST_THRESHOLD * 1000:
+            breakdown = ", ".join(f"{stage_name}={ms:.0f}ms" for stage_name, ms in totals.items())
+            logger.warning(f"Slow request {self.route} for user {self.tenant}: {total_ms:.0f}ms ({breakdown})")
+            metrics.slow_requests.append({
+                "route": self.route,
+                "tenant": self.tenant,
+                "total_ms": round(total_ms, 1),
+                "stages": {stage_name: round(ms, 1) for stage_name, ms in totals.items()},
+                "spans": [(stage_name, round(ms, 1)) for stage_name, ms in self.spans],
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            })
+
+
+def start_request_timer(route: str) -> RequestTimer:
+    """Create the timer for the current request and make it current."""
+    timer = RequestTimer(route)
+    _current_timer.set(timer)
+    return timer
+
+def current_timer() -> Optional[RequestTimer]:
+    """The current request's timer, if any."""
+    return _current_timer.get()
+
+def record_stage(stage_name: str, ms: float) -> None:
+    """Record a span on the current request (no-op outside a request)."""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.record(stage_name, ms)
+
+def mark_request_start(tenant: str, stage_name: str = "auth") -> None:
+    """
+    Tag the current request with its tenant and record the time spent before the
+    handler body started (request parsing and auth dependencies) as `stage_name`.
+    """
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.tenant = tenant
+        timer.record(stage_name, timer.elapsed_ms())
+
+@contextmanager
+def stage(stage_name: str):
+    """Time a block as a span of the current request."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(stage_name, (time.monotonic() - start) * 1000)
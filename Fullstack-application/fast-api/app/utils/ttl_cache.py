@@ -0,0 +1,103 @@
+"""
+In-process LRU cache with per-entry TTL and per-tenant invalidation.
+
+Used for hot-path caches that must not cost a network round trip (unlike the Redis
+helpers in cache.py). Keys are tuples whose first element is the tenant (owner user
+id), so everything cached for a tenant can be dropped at once.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+
+class TTLCache:
+    """
+    Bounded LRU cache where every entry also expires after `ttl` seconds.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+        self._tenant_keys: Dict[Hashable, Set[Tuple]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _remove(self, key: Tuple) -> None:
+        self._data.pop(key, None)
+        keys = self._tenant_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tenant_keys[key[0]]
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        """Return the cached value, or None on a miss or expired entry."""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Tuple, value: Any, ttl: Optional[float] = None) -> None:
+        """Store a value, evicting the least recently used entry when full."""
+        if key in self._data:
+            self._data.move_to_end(key)
+        self._data[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+        self._tenant_keys.setdefault(key[0], set()).add(key)
+        while len(self._data) > self.maxsize:
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def delete(self, key: Tuple) -> None:
+        """Drop a single entry."""
+        if key in self._data:
+            self._remove(key)
+            self.invalidations += 1
+
+    def invalidate_tenant(self, tenant: Hashable, predicate=None) -> int:
+        """
+        Drop all entries of a tenant, or only those whose key matches `predicate`.
+
+        Returns:
+            Number of entries removed
+        """
+        keys = [key for key in self._tenant_keys.get(tenant, ()) if predicate is None or predicate(key)]
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._tenant_keys.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for metrics endpoints."""
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
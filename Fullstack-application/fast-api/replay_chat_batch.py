@@ -0,0 +1,51 @@
+"""
+Replay stored chat queries for offline evaluation.
+
+Reads JSON lines with user_id, query and optionally language, context and id, answers them
+through the chat pipeline with bounded concurrency and writes one JSON line per item (reply,
+intent, products and stage timings) as items finish. Items are not counted against
+conversation limits and are not persisted.
+
+    python replay_chat_batch.py queries.jsonl --concurrency 8 > results.jsonl
+"""
+import argparse
+import asyncio
+import json
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables from .env file in the current directory
+load_dotenv()
+
+from app.api.chat import run_chat_batch, ChatBatchItem, CHAT_BATCH_CONCURRENCY, CHAT_BATCH_MAX_CONCURRENCY
+
+
+def read_items(path: str):
+    source = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        return [ChatBatchItem(**json.loads(line)) for line in source if line.strip()]
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+
+async def main(args) -> int:
+    items = read_items(args.input)
+    print(f"Replaying {len(items)} queries with concurrency {args.concurrency}...", file=sys.stderr)
+    failed = 0
+    async for result in run_chat_batch(items, args.concurrency, args.use_response_cache):
+        failed += 1 if result.get("error") else 0
+        sys.stdout.write(json.dumps(result, default=str, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+    print(f"Done: {len(items) - failed} answered, {failed} failed.", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="JSON lines file with the items ('-' for stdin)")
+    parser.add_argument("--concurrency", type=int, default=CHAT_BATCH_CONCURRENCY,
+                        choices=range(1, CHAT_BATCH_MAX_CONCURRENCY + 1), metavar=f"1-{CHAT_BATCH_MAX_CONCURRENCY}")
+    parser.add_argument("--use-response-cache", action="store_true",
+                        help="Serve replies from the response cache when possible")
+    sys.exit(asyncio.run(main(parser.parse_args())))
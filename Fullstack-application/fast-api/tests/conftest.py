@@ -5,6 +5,7 @@ import os
 import sys
 import asyncio
 import mongomock
+from bson import ObjectId
 
 # Add the project root to the sys.path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -12,6 +13,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 # Correct import based on the project structure
 from app.main import app
 from app.utils.mongo import get_db
+from app.services.knowledge_base import KnowledgeBase
 
 @pytest.fixture(scope="session")
 def event_loop():
@@ -148,4 +150,30 @@ def test_client(test_db):
     app.dependency_overrides[get_db] = override_get_db
     client = TestClient(app)
     yield client
-    app.dependency_overrides.clear()
\ No newline at end of file
+    app.dependency_overrides.clear()
+
+@pytest.fixture
+def make_product():
+    """Factory for product documents (tenant "a" unless user_id is given); `price` fills pricing.one_time."""
+    def make(name, user_id="a", price=None, **fields):
+        product = {
+            "_id": ObjectId(), "user_id": user_id, "product_name": name, "description": "", "category": "kolo",
+            "features": [], "keywords": [], "pricing": {} if price is None else {"one_time": price}, "admin_priority": 0
+        }
+        product.update(fields)
+        return product
+    return make
+
+@pytest.fixture
+def indexed_knowledge_base():
+    """Builds a KnowledgeBase without a database whose products_cache and indexes hold the given products."""
+    def build(products, **attributes):
+        kb = KnowledgeBase(None)
+        for name, value in attributes.items():  # e.g. semantic_index
+            setattr(kb, name, value)
+        for product in products:
+            kb.products_cache.setdefault(product["user_id"], {})[str(product["_id"])] = product
+        kb.products_loaded = True
+        asyncio.run(kb.build_indexes())
+        return kb
+    return build
@@ -0,0 +1,51 @@
+# tests/test_admission.py
+import asyncio
+
+import pytest
+
+from app.models.user import SubscriptionTier
+from app.services.admission import AdmissionRejectedError, AdmissionScheduler
+
+
+def test_backlogged_tenants_are_served_by_weight():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrent=1, max_queue_per_tenant=10, max_wait=5)
+        scheduler.service_time = 0.01
+        blocker = await scheduler.acquire("blocker")
+        order = []
+
+        async def turn(tenant, tier):
+            async with scheduler.admit(tenant, tier):
+                order.append(tenant)
+
+        tasks = [asyncio.create_task(turn("free", SubscriptionTier.FREE)) for _ in range(3)]
+        tasks += [asyncio.create_task(turn("premium", SubscriptionTier.PREMIUM)) for _ in range(6)]
+        await asyncio.sleep(0)
+        assert scheduler.stats()["tenants"]["premium"]["queue_depth"] == 6
+        blocker.release()
+        await asyncio.gather(*tasks)
+        # Four premium turns per free turn while both are waiting
+        assert order[:5].count("premium") == 4
+        assert scheduler.stats()["inflight"] == 0 and scheduler.stats()["queue_depth"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_and_deadline_are_rejected_with_retry_after():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrent=1, max_queue_per_tenant=1, max_wait=0.05)
+        scheduler.service_time = 0.01
+        held = await scheduler.acquire("a")
+        waiting = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejectedError) as full:
+            await scheduler.acquire("b")
+        assert full.value.reason == "tenant queue full" and full.value.retry_after >= 1
+        with pytest.raises(AdmissionRejectedError) as late:
+            await waiting
+        assert late.value.reason == "queue deadline passed"
+        held.release()
+        stats = scheduler.stats("b")["tenants"]["b"]
+        assert stats["rejected"] == 2 and stats["timed_out"] == 1 and stats["queue_depth"] == 0
+
+    asyncio.run(scenario())
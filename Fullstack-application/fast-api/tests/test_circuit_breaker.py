@@ -0,0 +1,59 @@
+# tests/test_circuit_breaker.py
+import time
+
+from app.services.circuit_breaker import CircuitBreaker, STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN
+
+
+def make_breaker(**overrides):
+    settings = dict(window_seconds=60, min_calls=4, error_threshold=0.5, slow_call_seconds=5, open_seconds=0.05, half_open_probes=1)
+    settings.update(overrides)
+    return CircuitBreaker("test-model", **settings)
+
+
+def test_stays_closed_below_min_calls():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == STATE_CLOSED
+    assert breaker.allow_request()
+
+
+def test_opens_on_error_rate_and_rejects():
+    breaker = make_breaker()
+    breaker.record_success(0.1)
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    assert not breaker.allow_request()
+    assert breaker.snapshot()["rejected_calls"] == 1
+
+
+def test_slow_calls_count_as_errors():
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record_success(6.0)
+    assert breaker.state == STATE_OPEN
+
+
+def test_half_open_probe_closes_on_success():
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    assert breaker.state == STATE_HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.allow_request()
+    breaker.record_success(0.2)
+    assert breaker.state == STATE_CLOSED
+
+
+def test_half_open_probe_failure_reopens():
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == STATE_OPEN
+    assert breaker.snapshot()["times_opened"] == 2
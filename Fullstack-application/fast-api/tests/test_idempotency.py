@@ -0,0 +1,50 @@
+# tests/test_idempotency.py
+import asyncio
+
+import pytest
+
+from app.services.idempotency import IdempotencyKeyMismatchError, IdempotencyStore, request_fingerprint
+
+
+def test_duplicates_share_one_execution():
+    async def scenario():
+        store = IdempotencyStore(ttl=60)
+        calls = []
+
+        async def handler():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"reply": "hello"}
+
+        fingerprint = request_fingerprint({"query": "hi"})
+        first, second = await asyncio.gather(
+            store.run("tenant", "key-1", fingerprint, handler),
+            store.run("tenant", "key-1", fingerprint, handler)
+        )
+        third = await store.run("tenant", "key-1", fingerprint, handler)
+        assert first == second == third == {"reply": "hello"}
+        assert len(calls) == 1
+        assert store.stats()["joined"] == 1 and store.stats()["replayed"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_failures_are_not_stored_and_keys_are_per_body():
+    async def scenario():
+        store = IdempotencyStore(ttl=60)
+
+        async def failing():
+            raise RuntimeError("gemini down")
+
+        async def succeeding():
+            return "ok"
+
+        with pytest.raises(RuntimeError):
+            await store.run("tenant", "key-1", "a", failing)
+        assert await store.run("tenant", "key-1", "a", succeeding) == "ok"
+        with pytest.raises(IdempotencyKeyMismatchError):
+            await store.run("tenant", "key-1", "b", succeeding)
+        # Keys are scoped per tenant
+        assert await store.run("other-tenant", "key-1", "b", succeeding) == "ok"
+
+    asyncio.run(scenario())
@@ -0,0 +1,56 @@
+# tests/test_intent_classifier.py
+from app.services.intent_classifier import PRECLASSIFIER_THRESHOLD, ClassifierEvaluator, classify_query
+from app.utils.keyword_matcher import KeywordMatcher, catalog_entries, vocabulary_entries
+
+
+def test_prices_are_extracted_with_units_and_bounds():
+    cases = {
+        "televize do 15 tisíc": (None, 15000),
+        "kolo do 5000, 2 kusy": (None, 5000),
+        "Mate kolo od 5 do 10 tisic": (5000, 10000),
+        "kolo do 20k": (None, 20000),
+        "Máte kola do 20 000 Kč?": (None, 20000),
+        "kolo od 1,5 tisíce do 30.000 Kč": (1500, 30000),
+    }
+    for query, (price_min, price_max) in cases.items():
+        analysis = classify_query(query)
+        assert (analysis["entities"]["price_range"]["min"], analysis["entities"]["price_range"]["max"]) == (price_min, price_max), query
+        assert analysis["intent"] == "product_recommendation" and analysis["confidence"] >= PRECLASSIFIER_THRESHOLD, query
+
+
+def test_queries_needing_gemini_stay_below_the_threshold():
+    # Bare small amounts, model numbers and named products
+    for query in ["televize do 15", "kolo do 5 dnu", "Máte iPhone 15 Pro?", "Máte Galaxy S24?", "objednávka #1234 kolo"]:
+        assert classify_query(query)["confidence"] < PRECLASSIFIER_THRESHOLD, query
+
+    # A catalog brand followed by a number is a model too
+    matcher = KeywordMatcher(vocabulary_entries() + catalog_entries("brand", ["trek"]))
+    query = "jaké máte kolo trek marlin 7"
+    assert classify_query(query, hits=matcher.match(query))["confidence"] >= PRECLASSIFIER_THRESHOLD
+    query = "jaké máte kolo trek 7"
+    assert classify_query(query, hits=matcher.match(query))["confidence"] < PRECLASSIFIER_THRESHOLD
+
+    assert classify_query("this is sushi")["confidence"] == 0.0
+    assert classify_query("Máte 2 kola?")["confidence"] >= PRECLASSIFIER_THRESHOLD
+
+
+def test_report_gives_precision_and_recall_per_threshold():
+    evaluator = ClassifierEvaluator()
+    samples = [
+        ("product_recommendation", 0.95, "product_recommendation"),
+        ("product_recommendation", 0.9, "product_comparison"),
+        ("product_recommendation", 0.6, "product_recommendation"),
+        ("shipping_payment", 0.9, "shipping_payment"),
+    ]
+    for predicted, confidence, actual in samples:
+        evaluator.record("a", predicted, confidence, actual)
+    evaluator.record_skip("a")
+
+    report = evaluator.report("a", thresholds=[0.5, 0.85])
+    assert report["samples"] == 4 and report["skipped_nlu_calls"] == 1
+    low, high = report["thresholds"]
+    assert low["coverage"] == 1.0 and low["intents"]["product_recommendation"]["precision"] == 0.667
+    assert high["coverage"] == 0.75 and high["accuracy"] == 0.667
+    assert high["intents"]["product_recommendation"] == {"precision": 0.5, "recall": 0.5, "predicted": 2, "actual": 2}
+    assert high["intents"]["product_comparison"]["recall"] == 0.0
+    assert evaluator.report("b")["thresholds"][0]["accuracy"] is None
@@ -0,0 +1,86 @@
+# tests/test_kb_sync.py
+import asyncio
+from datetime import datetime, timedelta
+
+from app.services.kb_sync import KnowledgeBaseSync
+
+UPDATED_AT = datetime(2026, 1, 1)
+
+
+def _indexes(kb):
+    return {
+        name: {user: {key: sorted(ids) for key, ids in keys.items()} for user, keys in getattr(kb, name).items()}
+        for name in ("feature_index", "brand_index", "price_index", "category_index")
+    }
+
+
+def test_incremental_changes_match_a_full_rebuild(make_product, indexed_knowledge_base):
+    bike = make_product("Trek X", brand="Trek", features=["Hydraulic brakes"], price=25000)
+    tv = make_product("Bravia", category="televize", brand="Sony", features=["HDR"], price=18000)
+    phone = make_product("Pixel", user_id="b", category="smartphone", brand="Google", features=["5G"], price=15000)
+    kb = indexed_knowledge_base([bike, tv, phone])
+    version = kb.cache_version("a")
+
+    moved = dict(tv, brand="Samsung", features=["HDR", "OLED"], pricing={"one_time": 31000})
+    assert kb.upsert_product(moved)
+    assert not kb.upsert_product(dict(moved))  # unchanged: no version bump
+    assert kb.remove_product(str(bike["_id"]))
+    added = make_product("Cube", brand="Cube", features=["Carbon"], price=40000)
+    assert kb.upsert_product(added)
+
+    assert _indexes(kb) == _indexes(indexed_knowledge_base([moved, phone, added]))
+    assert kb.cache_version("a") == version + 3 and kb.cache_version("b") == 1
+    assert "trek" not in kb.brand_index["a"] and kb.category_index["a"]["bike"] == [str(added["_id"])]
+
+
+class _Cursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, field, direction):
+        self.documents = sorted(self.documents, key=lambda document: document[field])
+        return self
+
+    def __aiter__(self):
+        self.iterator = iter(self.documents)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class _Collection:
+    def __init__(self, documents):
+        self.documents = {document["_id"]: document for document in documents}
+
+    def find(self, query, projection=None):
+        documents = list(self.documents.values())
+        if "updated_at" in query and "$gte" in query["updated_at"]:
+            documents = [d for d in documents if d.get("updated_at") and d["updated_at"] >= query["updated_at"]["$gte"]]
+        if "_id" in query:
+            documents = [d for d in documents if d["_id"] in query["_id"]["$in"]]
+        return _Cursor(documents)
+
+
+def test_polling_applies_updates_and_reconcile_drops_deletes(make_product, indexed_knowledge_base):
+    bike = make_product("Trek X", brand="Trek", features=["Hydraulic brakes"], price=25000, updated_at=UPDATED_AT)
+    tv = make_product("Bravia", category="televize", brand="Sony", features=["HDR"], price=18000, updated_at=UPDATED_AT)
+    kb = indexed_knowledge_base([bike, tv])
+    collection = _Collection([bike, tv])
+    kb.product_collection = collection
+    sync = KnowledgeBaseSync(kb)
+    sync.watermark = sync._cached_watermark()
+
+    collection.documents[tv["_id"]] = dict(tv, brand="LG", updated_at=tv["updated_at"] + timedelta(minutes=5))
+    del collection.documents[bike["_id"]]
+    unstamped = make_product("Cube", brand="Cube", price=40000, updated_at=None)
+    collection.documents[unstamped["_id"]] = unstamped
+
+    assert asyncio.run(sync.poll_once()) == 1
+    assert "lg" in kb.brand_index["a"] and "sony" not in kb.brand_index["a"]
+    assert asyncio.run(sync.reconcile()) == 2
+    assert set(kb.products_cache["a"]) == {str(tv["_id"]), str(unstamped["_id"])}
+    assert "trek" not in kb.brand_index["a"] and sync.stats()["removed"] == 1
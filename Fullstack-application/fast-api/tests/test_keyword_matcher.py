@@ -0,0 +1,52 @@
+# tests/test_keyword_matcher.py
+import re
+
+from app.utils.keyword_matcher import (
+    KEYWORD_VOCABULARY, KeywordMatcher, catalog_entries, fold_text, match_keywords, vocabulary_entries
+)
+
+
+def test_overlapping_keywords_are_all_found():
+    matcher = KeywordMatcher(catalog_entries("word", ["he", "she", "his", "hers"], min_length=1))
+    hits = matcher.match("ushers")
+    assert sorted(hit.keyword for hit in hits) == ["he", "hers", "she"]
+    she = next(hit for hit in hits if hit.keyword == "she")
+    assert "ushers"[she.start:she.end] == "she"
+
+
+def test_hits_match_substring_scans_of_the_vocabulary():
+    queries = [
+        "Jaké máte horské kolo do 20 000 Kč?",
+        "Where is my order #1234? Tracking says delivered",
+        "Porovnej OLED a mini LED televize 4K s HDR10+",
+        "Chtěla bych pračku se sušičkou, úzká, předem plněná",
+        "hi, do you have a laptop with wifi or bluetooth",
+    ]
+    for query in queries:
+        folded = f" {fold_text(query)} "
+        expected = {
+            (entry.type, entry.value, entry.keyword) for entry in vocabulary_entries()
+            if (re.search(rf"(?<![a-z0-9]){re.escape(entry.pattern)}(?![a-z0-9])", folded) if entry.whole_word else entry.pattern in folded)
+        }
+        assert {(hit.type, hit.value, hit.keyword) for hit in match_keywords(query)} == expected
+
+
+def test_first_prefers_earlier_vocabulary_entries():
+    hits = match_keywords("televize mini led")
+    # "led" is listed before "mini led", as in the keyword dict it replaced
+    assert hits.first("display_technology") == "LED"
+    assert hits.first("category") == "televize"
+    assert hits.has("product_query", "cs") is False
+    assert list(KEYWORD_VOCABULARY["category"])[0] == match_keywords("kolo a televize").first("category")
+
+
+def test_catalog_vocabulary_is_matched_with_its_own_type():
+    matcher = KeywordMatcher(vocabulary_entries() + catalog_entries("brand", ["Shimano", "hp"]))
+    hits = matcher.match("Máte řazení Shimano?")
+    assert hits.values("brand") == ["Shimano"]
+    assert hits.has("product_query", "cs")
+
+
+def test_short_greetings_only_match_whole_words():
+    assert match_keywords("hi, do you have bikes").keywords("intent", "general_question") == ["hi"]
+    assert not match_keywords("this is sushi").of_type("intent", "en")
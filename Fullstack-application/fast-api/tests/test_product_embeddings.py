@@ -0,0 +1,83 @@
+# tests/test_product_embeddings.py
+import asyncio
+
+import numpy as np
+from app.services.product_embeddings import EmbeddingMatrix, SemanticProductIndex, _write_matrix
+
+VOCABULARY = ["bike", "mountain", "kids", "helmet", "tv", "winter", "jacket", "warm"]
+
+
+class BagOfWordsEncoder:
+    """Stands in for the sentence-transformers model: word counts over VOCABULARY, normalized."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, texts):
+        self.calls.append(list(texts))
+        vectors = np.array([[text.lower().count(word) for word in VOCABULARY] for text in texts], dtype=np.float32) + 1e-3
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_matrix_stays_contiguous_and_survives_memory_mapping(tmp_path):
+    rng = np.random.default_rng(7)
+    vectors = rng.normal(size=(40, 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    matrix = EmbeddingMatrix()
+    for index, vector in enumerate(vectors):
+        matrix.set(f"p{index}", f"h{index}", vector)
+    for index in range(0, 40, 3):
+        matrix.remove(f"p{index}")
+    assert matrix.vectors.flags["C_CONTIGUOUS"] and len(matrix) == 26
+
+    queries = vectors[:2]
+    expected = [
+        sorted(((f"p{index}", float(vectors[index] @ query)) for index in range(40) if index % 3), key=lambda item: -item[1])[:5]
+        for query in queries
+    ]
+    ranked = matrix.top_k(queries, 5)
+    assert [[product_id for product_id, _ in row] for row in ranked] == [[product_id for product_id, _ in row] for row in expected]
+    assert matrix.top_k(queries, 5, allowed={"p1", "p2"})[0][0][0] in {"p1", "p2"}
+
+    _write_matrix(str(tmp_path / "a"), matrix.vectors.copy(), matrix.product_ids, matrix.text_hashes)
+    mapped = EmbeddingMatrix.load(str(tmp_path / "a"))
+    assert isinstance(mapped.vectors, np.memmap) and mapped.top_k(queries, 5) == ranked
+    mapped.remove("p1")  # first write copies the mapped rows into memory
+    assert not isinstance(mapped.vectors, np.memmap) and "p1" not in mapped.rows and len(mapped) == 25
+
+
+def test_writes_are_embedded_in_batches_and_cached_by_text(make_product):
+    encoder = BagOfWordsEncoder()
+    index = SemanticProductIndex(encoder=encoder, matrix_dir="")
+    bike, helmet, same_text = (make_product(name, category="") for name in ("Mountain bike", "Kids helmet", "Mountain bike"))
+
+    async def scenario():
+        index.update("a", str(bike["_id"]), bike)
+        index.update("a", str(helmet["_id"]), helmet)
+        assert await index.flush() == 2
+        index.update("a", str(bike["_id"]), bike)  # unchanged text: nothing to encode
+        index.update("a", str(same_text["_id"]), same_text)  # already encoded text: served from the cache
+        assert await index.flush() == 0
+        return await index.search("a", ["bike for the mountains", "helmet for kids"], limit=1)
+
+    ranked = asyncio.run(scenario())
+    assert [row[0][0] for row in ranked] in ([str(bike["_id"]), str(helmet["_id"])], [str(same_text["_id"]), str(helmet["_id"])])
+    # One batch for both products, one for both queries
+    assert [len(texts) for texts in encoder.calls] == [2, 2] and len(index.matrices["a"]) == 3
+
+
+def test_knowledge_base_retrieves_and_forgets_by_meaning(make_product, indexed_knowledge_base):
+    jacket = make_product("Alpine parka", description="Warm winter jacket", category="")
+    tv = make_product("Bravia", description="4K tv", category="")
+    kb = indexed_knowledge_base([jacket, tv], semantic_index=SemanticProductIndex(encoder=BagOfWordsEncoder(), matrix_dir=""))
+
+    async def scenario():
+        await kb.semantic_index.flush()
+        found = await kb.find_products_semantic("something warm for winter", user_id="a", limit=2)
+        scores = await kb.semantic_scores("a", "something warm for winter", [str(jacket["_id"]), str(tv["_id"])])
+        kb.remove_product(str(jacket["_id"]), "a")
+        return found, scores, await kb.find_products_semantic("something warm for winter", user_id="a")
+
+    found, scores, after_delete = asyncio.run(scenario())
+    assert found == [jacket] and scores[str(jacket["_id"])] > 0.5 > scores[str(tv["_id"])]
+    assert after_delete == []
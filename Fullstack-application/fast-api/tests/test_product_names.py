@@ -0,0 +1,37 @@
+# tests/test_product_names.py
+import asyncio
+
+from app.services.product_names import ProductNameTable, normalize_name, product_aliases
+
+
+def test_names_are_normalized_and_aliased(make_product):
+    assert normalize_name("Marlin7") == normalize_name("marlin-7") == "marlin 7"
+    assert normalize_name("Pračka Bosch  Série 6") == "pracka bosch serie 6"
+    assert product_aliases(make_product("Trek Marlin 7", brand="Trek")) == ["trek marlin 7", "marlin 7"]
+    assert product_aliases(make_product("Bravia XR", brand="Sony")) == ["bravia xr", "sony bravia xr"]
+
+
+def test_all_names_resolve_in_one_batch(make_product):
+    trek = make_product("Trek Marlin 7", brand="Trek")
+    cube, bravia = make_product("Cube Aim Race", brand="Cube"), make_product("Bravia XR", brand="Sony")
+    table = ProductNameTable()
+    for product in (trek, cube, bravia):
+        table.add(str(product["_id"]), product)
+
+    resolved = table.resolve(["marlin7", "sony bravia", "kube aim rase", "lednice"], limit=2)
+    assert [match.product_id for match in resolved[0]] == [str(trek["_id"])]
+    assert resolved[1][0].product_id == str(bravia["_id"]) and resolved[1][0].score >= 90
+    assert resolved[2][0].product_id == str(cube["_id"])
+    assert resolved[3] == []
+
+    table.remove(str(trek["_id"]))
+    assert table.resolve(["marlin 7"]) == [[]]
+
+
+def test_knowledge_base_falls_back_to_text_search_for_unmatched_names(make_product, indexed_knowledge_base):
+    trek, helmet = make_product("Trek Marlin 7", brand="Trek"), make_product("Helma Abus", description="Přilba na kolo")
+    kb = indexed_knowledge_base([trek, helmet])
+
+    assert kb.resolve_product_names("a", ["trek marlin"])[0][0][0] is trek
+    # "přilba" matches no name, BM25 finds it in the description; duplicates are dropped
+    assert asyncio.run(kb.find_products_by_names(["marlin 7", "přilba", "Trek Marlin 7"], user_id="a")) == [trek, helmet]
@@ -0,0 +1,40 @@
+# tests/test_product_query.py
+import asyncio
+
+from app.services.product_query import ProductQuery, from_mongo_filter
+
+
+def test_mongo_filters_compile_or_fall_back():
+    query = from_mongo_filter({"features": {"$all": ["GPS", "NFC"]}, "price": {"$gte": 1000, "$lte": 5000}})
+    assert query.features == ["gps", "nfc"] and (query.price_min, query.price_max) == (1000, 5000)
+    assert from_mongo_filter({"brand": {"$in": ["Sony", "LG"]}}).brands == ["sony", "lg"]
+    assert from_mongo_filter({"description": {"$regex": "kolo"}}) is None
+    assert from_mongo_filter({"features": {"$size": 2}}) is None
+
+
+def test_index_queries_match_a_scan_of_the_cache(make_product, indexed_knowledge_base):
+    trek = make_product("Trek", brand="Trek", features=["Hydraulic brakes", "Carbon"], price=25000, admin_priority=3)
+    cube = make_product("Cube", category="bicykl", brand="Cube", features=["Carbon"], price=40999, admin_priority=5)
+    bravia = make_product("Bravia", category="televize", brand="Sony", features=["HDR"], price=18000)
+    other = make_product("Other tenant", user_id="b", brand="Trek", features=["Carbon"], price=20000, admin_priority=9)
+    kb = indexed_knowledge_base([trek, cube, bravia, other])
+
+    # "bike" is a synonym of "kolo", and the group also contains "bicykl"
+    assert kb.query_products("a", ProductQuery(categories=["bike"])) == [cube, trek]
+    assert kb.query_products("a", ProductQuery(features=["carbon"], price_max=30000)) == [trek]
+    assert kb.query_products("a", ProductQuery(features=["carbon"], price_min=40500)) == [cube]
+    assert kb.query_products("a", ProductQuery(brands=["sony", "trek"]), limit=1) == [trek]
+    assert kb.query_products("a", ProductQuery(min_admin_priority=0)) == [cube, trek]
+    assert kb.query_products("a", ProductQuery(features=["gps"])) == []
+    assert kb.query_products("c", ProductQuery(categories=["kolo"])) == []
+
+    kb.products_loaded = False
+    assert kb.query_products("a", ProductQuery(categories=["kolo"])) is None
+
+
+def test_recommendations_fill_up_with_popular_products_from_memory(make_product, indexed_knowledge_base):
+    trek = make_product("Trek", brand="Trek", price=25000, admin_priority=3)
+    liked = make_product("Liked", brand="Cube", price=20000, metrics={"user_satisfaction": 4.5})
+    plain = make_product("Plain", brand="Cube", price=20000)
+    kb = indexed_knowledge_base([plain, liked, trek])
+    assert asyncio.run(kb.get_recommended_products("a", limit=3)) == [trek, liked, plain]
@@ -0,0 +1,61 @@
+# tests/test_product_search.py
+import asyncio
+
+from app.services.product_search import ProductSearchIndex, analyze
+
+
+def test_inflected_and_unaccented_forms_share_terms():
+    assert analyze("Horská kola") == analyze("horske kolo")
+    assert analyze("pračkou se sušičkou") == analyze("pracka susicka")
+    assert analyze("iPhone 15 Pro") == ["iphon", "15", "pro"]
+
+
+def test_name_hits_rank_above_description_hits(make_product):
+    index = ProductSearchIndex()
+    named = make_product("Dětské kolo Kubikes", description="Lehké kolo pro nejmenší")
+    described = make_product("Helma Abus", description="Přilba vhodná na horské kolo a koloběžku")
+    unrelated = make_product("Pumpa Sks", description="Ruční pumpa")
+    for product in (described, named, unrelated):
+        index.add(str(product["_id"]), product)
+
+    ranked = [product_id for product_id, _ in index.search("dětská kola")]
+    assert ranked == [str(named["_id"]), str(described["_id"])]
+    assert index.search("kola", allowed={str(described["_id"])})[0][0] == str(described["_id"])
+
+
+def test_incremental_updates_match_a_fresh_index(make_product):
+    first, second = make_product("Trek Marlin 7", features=["Hydraulické brzdy"]), make_product("Cube Aim")
+    index = ProductSearchIndex()
+    index.add(str(first["_id"]), first)
+    index.add(str(second["_id"]), second)
+    renamed = dict(first, product_name="Trek Marlin 8")
+    index.add(str(first["_id"]), renamed)
+    index.remove(str(second["_id"]))
+
+    fresh = ProductSearchIndex()
+    fresh.add(str(first["_id"]), renamed)
+    assert index.postings == fresh.postings and index.total_length == fresh.total_length
+    assert index.search("marlin 7") == fresh.search("marlin 7")
+
+
+def test_knowledge_base_searches_names_in_memory(make_product, indexed_knowledge_base):
+    trek, cube = make_product("Trek Marlin 7", admin_priority=1), make_product("Cube Aim Race")
+    kb = indexed_knowledge_base([trek, cube])
+
+    assert asyncio.run(kb.find_products_by_name("trek marlin", user_id="a")) == [trek]
+    added = make_product("Trek Fuel Ex")  # same length: admin_priority breaks the tie
+    kb.upsert_product(added)
+    assert asyncio.run(kb.find_products_by_name("trek", user_id="a")) == [trek, added]
+    assert asyncio.run(kb.search_products("trek", filters={"admin_priority": {"$gt": 0}}, user_id="a")) == [trek]
+
+
+def test_cached_products_keep_the_fields_prompts_read(make_product, indexed_knowledge_base):
+    kb = indexed_knowledge_base([])
+    bike = make_product(
+        "Trek Marlin 7", technical_specifications={"Rám": "Hliník"}, pros=["Lehké"], cons=["Bez blatníků"], internal_notes="x"
+    )
+    kb.upsert_product(bike)
+
+    found = asyncio.run(kb.find_products_by_name("marlin", user_id="a"))[0]
+    assert found["technical_specifications"] == {"Rám": "Hliník"} and found["pros"] == ["Lehké"] and found["cons"] == ["Bez blatníků"]
+    assert "internal_notes" not in found
@@ -0,0 +1,42 @@
+# tests/test_prompt_builder.py
+import json
+
+from app.services.prompt_builder import PromptBuilder, compact_value, estimate_tokens
+
+
+def render_products(items):
+    return "Products:\n" + json.dumps(items)
+
+
+def test_duplicate_sections_are_skipped():
+    builder = PromptBuilder("test", budget_tokens=1000)
+    builder.add("system", "You are a helpful shop assistant.\nBe friendly.", priority=100, required=True)
+    builder.add("tone", "Be   friendly.", priority=50)
+    prompt = builder.build()
+    assert prompt.count("Be friendly.") == 1
+    assert builder.stats["duplicates"] == ["tone"]
+
+
+def test_list_sections_are_trimmed_before_higher_priority_ones():
+    products = [{"name": f"Product {i}", "description": "x" * 200} for i in range(10)]
+    builder = PromptBuilder("test", budget_tokens=300)
+    builder.add("system", "System prompt", priority=100, required=True)
+    builder.add("context", "Context " * 20, priority=30)
+    builder.add_items("products", products, render_products, priority=70)
+    prompt = builder.build()
+    assert builder.total_tokens() <= 300
+    assert "context" in builder.stats["dropped_sections"]
+    assert "Product 0" in prompt and "Product 9" not in prompt
+
+
+def test_required_sections_are_never_trimmed():
+    builder = PromptBuilder("test", budget_tokens=5)
+    builder.add("system", "A long required system prompt", priority=100, required=True)
+    builder.add("extra", "optional", priority=10)
+    assert builder.build() == "A long required system prompt"
+
+
+def test_compact_value_truncates_and_drops_empty_fields():
+    compacted = compact_value({"description": "y" * 1000, "tags": [], "price_range": {"min": None, "max": None}}, max_chars=10)
+    assert compacted == {"description": "y" * 10 + "…"}
+    assert estimate_tokens("abcd" * 3) == 3
@@ -0,0 +1,46 @@
+# tests/test_stage_timing.py
+import time
+
+from app.utils import stage_timing
+from app.utils.stage_timing import LatencyHistogram, StageMetrics, stage, start_request_timer
+
+
+def test_histogram_quantiles_use_bucket_bounds():
+    histogram = LatencyHistogram()
+    for ms in [3, 7, 20, 40, 400]:
+        histogram.observe(ms)
+    assert histogram.count == 5
+    assert histogram.quantile(0.5) == 25.0
+    assert histogram.quantile(1.0) == 500.0
+
+
+def test_spans_reach_header_and_histograms(monkeypatch):
+    metrics = StageMetrics()
+    monkeypatch.setattr(stage_timing, "_stage_metrics", metrics)
+    timer = start_request_timer("POST /api/chat/message")
+    timer.tenant = "tenant-1"
+    with stage("nlu"):
+        time.sleep(0.01)
+    with stage("nlu"):
+        pass
+    header = timer.server_timing_header()
+    assert header.startswith("nlu;dur=") and "total;dur=" in header
+
+    timer.finish()
+    assert metrics.stages["nlu"].count == 1
+    assert metrics.tenants["tenant-1"]["total"].count == 1
+
+    # Spans recorded after the request finished (background tasks) still count
+    with stage("persistence"):
+        pass
+    assert metrics.tenants["tenant-1"]["persistence"].count == 1
+
+
+def test_slow_requests_are_kept(monkeypatch):
+    metrics = StageMetrics()
+    monkeypatch.setattr(stage_timing, "_stage_metrics", metrics)
+    monkeypatch.setattr(stage_timing, "SLOW_REQUEST_THRESHOLD", 0.0)
+    timer = start_request_timer("POST /api/chat/message")
+    timer.record("retrieval", 12.0)
+    timer.finish()
+    assert metrics.slow_requests[0]["stages"] == {"retrieval": 12.0}